@@ -0,0 +1,71 @@
+"""Per-update cost of webhook deduplication.
+
+Measures reading the `update_id` from a raw update and checking it against
+the local window, for new and for repeated ids, and optionally against a
+shared Redis window.
+
+    python -m benchmarks.dedup
+    python -m benchmarks.dedup --redis-url redis://localhost:6379/0
+"""
+import argparse
+import itertools
+import json
+import timeit
+
+from spotigram.dedup import (
+    RedisUpdateWindow,
+    update_id_of,
+    UpdateWindow,
+)
+
+NUMBER = 10000
+
+
+def _raw_update(update_id):
+    return json.dumps({
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': 1546300800,
+            'chat': {'id': 1000, 'type': 'private'},
+            'from': {'id': 1000, 'is_bot': False, 'first_name': 'bench'},
+            'text': '/next',
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': 5}],
+        },
+    }).encode('utf-8')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--window', type=int, default=4096)
+    parser.add_argument('--redis-url')
+    args = parser.parse_args()
+
+    data = _raw_update(123456789)
+    window = UpdateWindow(args.window)
+    new_ids = itertools.count()
+    window.add(-1)
+
+    cases = [
+        ('parse update_id', lambda: update_id_of(data)),
+        ('json.loads', lambda: json.loads(data)),
+        ('local, new id', lambda: window.add(next(new_ids))),
+        ('local, duplicate', lambda: window.add(-1)),
+    ]
+    if args.redis_url:
+        import redis
+        shared = RedisUpdateWindow(
+            redis.Redis.from_url(args.redis_url), ttl=60,
+            prefix='update:benchmark')
+        shared_ids = itertools.count()
+        cases.append(('redis, new id', lambda: shared.add(next(shared_ids))))
+
+    for name, func in cases:
+        number = NUMBER if not name.startswith('redis') else NUMBER // 10
+        seconds = min(timeit.repeat(func, number=number, repeat=5))
+        print(f'{name:<20} {seconds / number * 1e6:10.2f} us/update')
+    print(f'local window of {args.window} ids: {len(window)} held')
+
+
+if __name__ == '__main__':
+    main()
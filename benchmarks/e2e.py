@@ -0,0 +1,333 @@
+"""End-to-end load benchmark for RandomGenreBot and ListenTogetherBot.
+
+Replays synthetic webhook traffic against `create_app()` with a fake
+Telegram Bot API, a fake Spotify Web API and a throwaway redislite
+database, then reports the time until the first update is served after
+startup, throughput, p50/p99 latency per command (webhook POST until the
+reply reaches Telegram) and Redis and Spotify calls per update.
+
+    python -m benchmarks.e2e                      # run and compare
+    python -m benchmarks.e2e --save-baseline      # record a new baseline
+
+The baseline also stores the load it was recorded with and the tolerance
+to compare against it, which `--tolerance` overrides.
+
+Each bot runs in its own subprocess, as `create_app` forks a dispatcher
+and reads its configuration from the environment at import time.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from pathlib import Path
+from threading import (
+    Event,
+    Thread,
+)
+
+from benchmarks.fakes import (
+    FakeSpotify,
+    FakeTelegram,
+)
+
+BASELINE_FILE = Path(__file__).parent / 'baseline_e2e.json'
+BOTS = ('random_genre', 'listen_together')
+TOKEN = '123456:benchmark'
+TRACK = 'https://open.spotify.com/track/4uLU6hMCjMI75M1A2tKUQC?si=abc'
+DEFAULT_TOLERANCE = 0.25
+# Answered without Spotify, so it measures startup alone.
+WARMUP_CHAT_ID = 999
+
+SCRIPTS = {
+    'random_genre': (
+        ('/genres', '/genres'),
+        ('choose', '1'),
+        ('/next', '/next'),
+        ('/pause', '/pause'),
+        ('/play', '/play'),
+    ),
+    'listen_together': (
+        ('link', TRACK),
+        ('uri', 'spotify:track:4uLU6hMCjMI75M1A2tKUQC'),
+        ('/next', '/next'),
+        ('/pause', '/pause'),
+        ('/play', '/play'),
+    ),
+}
+
+
+def _percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def _update(update_id, chat_id, text):
+    message = {
+        'message_id': update_id,
+        'date': int(time.time()),
+        'chat': {'id': chat_id, 'type': 'private'},
+        'from': {'id': chat_id, 'is_bot': False, 'first_name': 'bench'},
+        'text': text,
+    }
+    if text.startswith('/'):
+        message['entities'] = [
+            {'type': 'bot_command', 'offset': 0, 'length': len(text)}]
+    return {'update_id': update_id, 'message': message}
+
+
+def _configure_env(telegram_api, spotify, workdir):
+    (workdir / 'metrics').mkdir()
+    os.environ.update({
+        'TELEGRAM_TOKEN': TOKEN,
+        'TELEGRAM_API_URL': telegram_api.api_url,
+        'SPOTIFY_API_URL': spotify.api_url,
+        'API_LOCATION': 'http://127.0.0.1',
+        'SECRET_KEY': 'benchmark',
+        'REDISLITE_PATH': str(workdir / 'redis.db'),
+        'prometheus_multiproc_dir': str(workdir / 'metrics'),
+        'TELEGRAM_CHAT_RATE': '1000',
+        'TELEGRAM_GLOBAL_RATE': '100000',
+    })
+
+
+def run_bot(name, chats, rounds, users, latency, rate_limit_ratio):
+    telegram_api = FakeTelegram()
+    spotify = FakeSpotify(latency=latency, rate_limit_ratio=rate_limit_ratio)
+    workdir = Path(tempfile.mkdtemp(prefix='spotigram-bench-'))
+    _configure_env(telegram_api, spotify, workdir)
+
+    from bots import (
+        ListenTogetherBot,
+        RandomGenreBot,
+    )
+    from spotigram.authorization import CACHE
+
+    bot_cls = {
+        'random_genre': RandomGenreBot,
+        'listen_together': ListenTogetherBot,
+    }[name]
+
+    chat_ids = list(range(1000, 1000 + chats))
+    for chat_id in chat_ids:
+        CACHE.set_many(chat_id, {
+            f'user{user}': {
+                'access_token': f'token-{chat_id}-{user}',
+                'refresh_token': 'refresh',
+                'token_type': 'Bearer',
+                'expires_at': int(time.time()) + 3600,
+            }
+            for user in range(users)
+        })
+
+    replies = {chat_id: Event() for chat_id in chat_ids + [WARMUP_CHAT_ID]}
+    reply_times = {}
+
+    def on_reply(chat_id, method, at):
+        if chat_id in replies:
+            reply_times[chat_id] = at
+            replies[chat_id].set()
+    telegram_api.listeners.append(on_reply)
+
+    hook = f'/hook/{TOKEN}'
+    startup = time.perf_counter()
+    app = bot_cls.create_app()
+    app_seconds = time.perf_counter() - startup
+    app.test_client().post(hook, data=json.dumps(
+        _update(0, WARMUP_CHAT_ID, '/users')))
+    if not replies[WARMUP_CHAT_ID].wait(30):
+        raise RuntimeError('The first update was not served.')
+    first_update_seconds = reply_times[WARMUP_CHAT_ID] - startup
+
+    latencies = defaultdict(list)
+    timeouts = defaultdict(int)
+
+    def chat_loop(chat_id):
+        client = app.test_client()
+        for round_ in range(rounds):
+            for step, (command, text) in enumerate(SCRIPTS[name]):
+                update_id = (chat_id * rounds + round_) * 100 + step
+                replies[chat_id].clear()
+                start = time.perf_counter()
+                client.post(hook, data=json.dumps(
+                    _update(update_id, chat_id, text)))
+                if replies[chat_id].wait(10):
+                    latencies[command].append(reply_times[chat_id] - start)
+                else:
+                    timeouts[command] += 1
+
+    redis_before = CACHE.redis.info('stats')['total_commands_processed']
+    spotify_before = sum(spotify.calls.values())
+
+    start = time.perf_counter()
+    threads = [Thread(target=chat_loop, args=(c,)) for c in chat_ids]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    # Subtract the INFO command itself.
+    redis_calls = (
+        CACHE.redis.info('stats')['total_commands_processed']
+        - redis_before - 1
+    )
+    spotify_calls = sum(spotify.calls.values()) - spotify_before
+    updates = chats * rounds * len(SCRIPTS[name])
+
+    for child in multiprocessing.active_children():
+        child.terminate()
+    telegram_api.stop()
+    spotify.stop()
+
+    return {
+        'startup_ms': app_seconds * 1e3,
+        'first_update_ms': first_update_seconds * 1e3,
+        'updates': updates,
+        'seconds': elapsed,
+        'throughput': updates / elapsed,
+        'redis_calls_per_update': redis_calls / updates,
+        'spotify_calls_per_update': spotify_calls / updates,
+        'commands': {
+            command: {
+                'count': len(values),
+                'timeouts': timeouts[command],
+                'p50_ms': _percentile(values, .5) * 1e3,
+                'p99_ms': _percentile(values, .99) * 1e3,
+            }
+            for command, values in latencies.items()
+        },
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Regressions of `results` against `baseline` beyond `tolerance`."""
+    regressions = []
+    for bot, result in results.items():
+        base = baseline.get(bot)
+        if not base:
+            continue
+        if result['first_update_ms'] > (
+            base.get('first_update_ms', float('inf')) * (1 + tolerance)
+        ):
+            regressions.append(
+                f'{bot}: first update after {result["first_update_ms"]:.1f}ms '
+                f'> {base["first_update_ms"]:.1f}ms')
+        if result['throughput'] < base['throughput'] * (1 - tolerance):
+            regressions.append(
+                f'{bot}: throughput {result["throughput"]:.1f}/s '
+                f'< {base["throughput"]:.1f}/s')
+        for key in ('redis_calls_per_update', 'spotify_calls_per_update'):
+            if result[key] > base[key] * (1 + tolerance):
+                regressions.append(
+                    f'{bot}: {key} {result[key]:.2f} > {base[key]:.2f}')
+        for command, stats in result['commands'].items():
+            base_stats = base['commands'].get(command)
+            if base_stats and (
+                stats['p99_ms'] > base_stats['p99_ms'] * (1 + tolerance)
+            ):
+                regressions.append(
+                    f'{bot} {command}: p99 {stats["p99_ms"]:.1f}ms '
+                    f'> {base_stats["p99_ms"]:.1f}ms')
+    return regressions
+
+
+def report(results):
+    for bot, result in results.items():
+        print(
+            f'{bot}: ready after {result["startup_ms"]:.1f}ms, '
+            f'first update served after {result["first_update_ms"]:.1f}ms'
+        )
+        print(
+            f'{bot}: {result["updates"]} updates, '
+            f'{result["throughput"]:.1f} updates/s, '
+            f'{result["redis_calls_per_update"]:.2f} Redis and '
+            f'{result["spotify_calls_per_update"]:.2f} Spotify calls/update'
+        )
+        for command, stats in result['commands'].items():
+            print(
+                f'  {command:<10} p50 {stats["p50_ms"]:8.2f}ms  '
+                f'p99 {stats["p99_ms"]:8.2f}ms  '
+                f'({stats["count"]} ok, {stats["timeouts"]} timed out)'
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--bot', choices=BOTS)
+    parser.add_argument('--chats', type=int, default=20)
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--users', type=int, default=2)
+    parser.add_argument('--spotify-latency', type=float, default=0.02)
+    parser.add_argument('--rate-limit-ratio', type=float, default=0.0)
+    parser.add_argument('--baseline', type=Path, default=BASELINE_FILE)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float)
+    args = parser.parse_args()
+
+    load = {
+        'chats': args.chats,
+        'rounds': args.rounds,
+        'users': args.users,
+        'spotify_latency': args.spotify_latency,
+        'rate_limit_ratio': args.rate_limit_ratio,
+    }
+    load_args = [
+        arg for name, value in load.items()
+        for arg in (f'--{name.replace("_", "-")}', str(value))
+    ]
+
+    if args.bot:
+        result = run_bot(
+            args.bot, args.chats, args.rounds, args.users,
+            args.spotify_latency, args.rate_limit_ratio)
+        print(json.dumps(result))
+        return
+
+    baseline = None
+    if not args.save_baseline and args.baseline.exists():
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        if baseline['load'] != load:
+            sys.exit(
+                f'The baseline was recorded with {baseline["load"]}; '
+                'use the same load or record a new baseline.')
+
+    results = {}
+    for bot in BOTS:
+        output = subprocess.run(
+            [sys.executable, '-m', 'benchmarks.e2e', '--bot', bot,
+             *load_args],
+            stdout=subprocess.PIPE, check=True,
+        ).stdout.decode('utf-8')
+        results[bot] = json.loads(output.strip().splitlines()[-1])
+    report(results)
+
+    tolerance = args.tolerance
+    if args.save_baseline:
+        baseline = {
+            'tolerance': DEFAULT_TOLERANCE if tolerance is None else tolerance,
+            'load': load,
+            'results': results,
+        }
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2)
+            f.write('\n')
+        print(f'Saved baseline to {args.baseline}')
+    elif baseline is not None:
+        if tolerance is None:
+            tolerance = baseline['tolerance']
+        regressions = compare(results, baseline['results'], tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
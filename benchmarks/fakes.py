@@ -0,0 +1,242 @@
+"""Local stand-ins for the Telegram Bot API and the Spotify Web API."""
+import json
+import random
+import time
+from collections import Counter
+from http.server import (
+    BaseHTTPRequestHandler,
+    HTTPServer,
+)
+from socketserver import ThreadingMixIn
+from threading import (
+    Lock,
+    Thread,
+)
+from urllib.parse import (
+    parse_qsl,
+    urlsplit,
+)
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeServer:
+    """Threaded HTTP server that counts calls and delegates to `handle`.
+
+    `connections` counts the TCP connections accepted so far.
+    """
+
+    def __init__(self):
+        self.calls = Counter()
+        self.connections = 0
+        self.lock = Lock()
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                super().setup()
+                with fake.lock:
+                    fake.connections += 1
+
+            def _dispatch(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                parts = urlsplit(self.path)
+                status, headers, payload = fake.handle(
+                    self.command, parts.path, self.headers, body,
+                    dict(parse_qsl(parts.query)))
+                data = json.dumps(payload).encode() if payload else b''
+                self.send_response(status)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST = do_PUT = do_DELETE = _dispatch
+
+            def log_message(self, *args):
+                pass
+
+        self.server = _ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return f'http://{host}:{port}'
+
+    def count(self, name):
+        with self.lock:
+            self.calls[name] += 1
+
+    def handle(self, method, path, headers, body, query):
+        raise NotImplementedError
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class FakeTelegram(FakeServer):
+    """Bot API stand-in; records when each chat got a message."""
+
+    def __init__(self):
+        super().__init__()
+        self.message_id = 0
+        self.listeners = []
+        self.webhook_url = ''
+
+    @property
+    def api_url(self):
+        return f'{self.url}/bot'
+
+    def handle(self, method, path, headers, body, query):
+        api_method = path.rsplit('/', 1)[-1]
+        self.count(api_method)
+        try:
+            params = json.loads(body.decode('utf-8')) if body else {}
+        except ValueError:
+            params = {}
+
+        if api_method in ('sendMessage', 'editMessageText'):
+            with self.lock:
+                self.message_id += 1
+                message_id = self.message_id
+            chat_id = int(params.get('chat_id', 0))
+            for listener in self.listeners:
+                listener(chat_id, api_method, time.perf_counter())
+            result = {
+                'message_id': params.get('message_id', message_id),
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'text': params.get('text', ''),
+            }
+        elif api_method == 'getMe':
+            result = {
+                'id': 1, 'is_bot': True, 'first_name': 'bench',
+                'username': 'bench_bot',
+            }
+        elif api_method == 'getWebhookInfo':
+            result = {
+                'url': self.webhook_url,
+                'has_custom_certificate': False,
+                'pending_update_count': 0,
+            }
+        elif api_method == 'setWebhook':
+            self.webhook_url = params.get('url', '')
+            result = True
+        else:
+            result = True
+        return 200, {}, {'ok': True, 'result': result}
+
+
+class FakeSpotify(FakeServer):
+    """Web API stand-in with configurable latency and 429 injection.
+
+    `latency_by_token` overrides `latency` for requests authorized with a
+    given access token. Responses passed to `inject` are returned, in
+    order, before any other handling. `playlists` maps user names to the
+    playlists `user_playlists` lists for them. Half of the latency is spent
+    before a request is handled and half after, like a symmetric network
+    path. Playback is tracked per token, so `origins` tells when each
+    player was at position 0.
+    """
+
+    def __init__(self, latency=0.0, rate_limit_ratio=0.0, retry_after=0,
+                 latency_by_token=None, playlists=None):
+        super().__init__()
+        self.latency = latency
+        self.rate_limit_ratio = rate_limit_ratio
+        self.retry_after = retry_after
+        self.latency_by_token = latency_by_token or {}
+        self.playback = {}
+        self.injected = []
+        self.playlists = playlists or {}
+
+    def inject(self, status, headers=None, payload=None, times=1):
+        with self.lock:
+            self.injected.extend([(status, headers or {}, payload)] * times)
+
+    @property
+    def api_url(self):
+        return f'{self.url}/v1/'
+
+    def handle(self, method, path, headers, body, query):
+        token = headers.get('Authorization', '').replace('Bearer ', '')
+        latency = self.latency_by_token.get(token, self.latency)
+        time.sleep(latency / 2)
+        try:
+            return self._handle(method, path, token, body, query)
+        finally:
+            time.sleep(latency / 2)
+
+    def origins(self):
+        """perf_counter() time at which each token's playback was at 0."""
+        with self.lock:
+            return {
+                token: started - position_ms / 1000
+                for token, (started, position_ms) in self.playback.items()
+            }
+
+    def skew_ms(self, tokens=None):
+        origins = [
+            origin for token, origin in self.origins().items()
+            if tokens is None or token in tokens
+        ]
+        return (max(origins) - min(origins)) * 1000 if origins else None
+
+    def _handle(self, method, path, token, body, query):
+        endpoint = path[len('/v1/'):].rstrip('/')
+        if endpoint.startswith('tracks/'):
+            endpoint = 'tracks/{id}'
+        self.count(f'{method} {endpoint}')
+
+        with self.lock:
+            injected = self.injected.pop(0) if self.injected else None
+        if injected is not None:
+            return injected
+        if random.random() < self.rate_limit_ratio:
+            return 429, {'Retry-After': str(self.retry_after)}, {
+                'error': {'status': 429, 'message': 'API rate limit exceeded'}
+            }
+
+        if endpoint == 'me':
+            return 200, {}, {'id': token or 'user'}
+        if endpoint.startswith('users/') and endpoint.endswith('/playlists'):
+            playlists = self.playlists.get(endpoint.split('/')[1], [])
+            limit = int(query.get('limit', 50))
+            offset = int(query.get('offset', 0))
+            return 200, {}, {
+                'items': playlists[offset:offset + limit],
+                'total': len(playlists),
+                'limit': limit,
+                'offset': offset,
+                'next': None,
+            }
+        if endpoint == 'tracks/{id}':
+            track_id = path.rsplit('/', 1)[-1]
+            return 200, {}, {'uri': f'spotify:track:{track_id}'}
+        if method == 'PUT' and endpoint == 'me/player/play':
+            try:
+                params = json.loads(body.decode('utf-8')) if body else {}
+            except ValueError:
+                params = {}
+            with self.lock:
+                self.playback[token] = (
+                    time.perf_counter(), params.get('position_ms') or 0)
+            return 204, {}, None
+        if method == 'GET' and endpoint == 'me/player':
+            with self.lock:
+                started, position_ms = self.playback.get(
+                    token, (time.perf_counter(), 0))
+            progress_ms = position_ms + (time.perf_counter() - started) * 1e3
+            return 200, {}, {
+                'is_playing': True, 'progress_ms': int(progress_ms)}
+        return 204, {}, None
@@ -0,0 +1,53 @@
+"""Compare the array-backed genre catalog with the plain dict lookup.
+
+Run with `python -m benchmarks.genre_sampling`.
+"""
+import json
+import random
+import timeit
+
+from genres import (
+    catalog,
+    GenrePlaylist,
+    PLAYLISTS_FILE,
+)
+
+NUMBER = 2000
+
+
+def _dict_random_genres(playlists, k=3):
+    genres = random.sample(list(playlists), k)
+    choices = {
+        genre: random.choice(list(playlists[genre].items()))
+        for genre in genres
+    }
+    return [
+        GenrePlaylist(uri, genre, pl_type)
+        for (genre, (pl_type, uri)) in choices.items()
+    ]
+
+
+def main():
+    with open(PLAYLISTS_FILE, 'r') as f:
+        playlists = json.load(f)
+    by_uri = {
+        uri: (pl_type, genre)
+        for genre, outer_v in playlists.items()
+        for pl_type, uri in outer_v.items()
+    }
+    compiled = catalog()
+    uris = random.sample(list(by_uri), 1000)
+
+    cases = (
+        ('sample, dict', lambda: _dict_random_genres(playlists)),
+        ('sample, catalog', lambda: compiled.sample(3)),
+        ('lookup, dict', lambda: [by_uri[uri] for uri in uris]),
+        ('lookup, catalog', lambda: [compiled[uri] for uri in uris]),
+    )
+    for name, func in cases:
+        seconds = min(timeit.repeat(func, number=NUMBER, repeat=5))
+        print(f'{name:<20} {seconds / NUMBER * 1e6:10.2f} us/call')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+"""Measure genre search latency over the full catalog.
+
+Inline queries are answered while the user types, so every lookup has to
+stay well below a millisecond. Run with `python -m benchmarks.genre_search`.
+"""
+import time
+import timeit
+
+from genres import search_index
+
+NUMBER = 200
+
+QUERIES = (
+    'a',
+    'me',
+    'metal',
+    'hip hop',
+    'slav met',
+    'jaz',
+    'tecno',
+    'rok',
+    'qwertz',
+)
+
+
+def main():
+    start = time.perf_counter()
+    index = search_index()
+    print(f'{"build":<12} {(time.perf_counter() - start) * 1e3:10.2f} ms')
+
+    worst = 0.0
+    for query in QUERIES:
+        seconds = min(timeit.repeat(
+            lambda: index.search(query), number=NUMBER, repeat=5))
+        per_call = seconds / NUMBER * 1e6
+        worst = max(worst, per_call)
+        print(f'{query!r:<12} {per_call:10.2f} us/call')
+    print(f'{"worst":<12} {worst:10.2f} us/call')
+
+
+if __name__ == '__main__':
+    main()
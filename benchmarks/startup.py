@@ -0,0 +1,77 @@
+"""Cold start benchmark: import time and memory of a fresh bot process.
+
+Each sample runs in a new interpreter, which imports the bot module and
+then builds the Flask app, like a gunicorn worker does before it serves
+its first request. Reports the median wall time of both phases and the
+peak RSS after each.
+
+Run with `python -m benchmarks.startup`.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+from spotigram.startup import BOTS
+
+SAMPLE = '''
+import json, resource, sys, time
+start = time.perf_counter()
+import {module} as bot_module
+imported = time.perf_counter()
+import_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+from spotigram.app import _build_app_and_bot_for
+_build_app_and_bot_for(bot_module.{cls})
+built = time.perf_counter()
+print(json.dumps({{
+    'import_ms': (imported - start) * 1e3,
+    'app_ms': (built - imported) * 1e3,
+    'import_rss_mb': import_rss / 1024,
+    'app_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+}}))
+'''
+
+
+def sample(bot, env):
+    module, cls = BOTS[bot]
+    output = subprocess.run(
+        [sys.executable, '-c', SAMPLE.format(module=module, cls=cls)],
+        stdout=subprocess.PIPE, check=True, env=env,
+    ).stdout.decode('utf-8')
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--bot', choices=BOTS, default='random_genre')
+    parser.add_argument('--samples', type=int, default=10)
+    args = parser.parse_args()
+
+    workdir = Path(tempfile.mkdtemp(prefix='spotigram-startup-'))
+    (workdir / 'metrics').mkdir()
+    env = dict(
+        os.environ,
+        TELEGRAM_TOKEN='123:startup-benchmark',
+        REDISLITE_PATH=str(workdir / 'redis.db'),
+        prometheus_multiproc_dir=str(workdir / 'metrics'),
+    )
+
+    samples = [sample(args.bot, env) for _ in range(args.samples)]
+    for key, unit in (
+        ('import_ms', 'ms'),
+        ('app_ms', 'ms'),
+        ('import_rss_mb', 'MB'),
+        ('app_rss_mb', 'MB'),
+    ):
+        values = [s[key] for s in samples]
+        print(
+            f'{key:<14} median {statistics.median(values):8.1f}{unit}  '
+            f'max {max(values):8.1f}{unit}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""Compare plain and synchronized playback starts across several listeners.
+
+Each listener's requests to the fake Spotify Web API get a different
+latency. The skew is measured by the fake server, from when each player
+was at position 0, so it does not depend on the bot's own estimate.
+
+Run with `python -m benchmarks.sync_start`.
+"""
+import argparse
+import os
+import statistics
+
+from benchmarks.fakes import FakeSpotify
+
+URIS = ['spotify:track:4uLU6hMCjMI75M1A2tKUQC']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(
+        '--latencies', type=float, nargs='+',
+        default=[0.02, 0.08, 0.15, 0.3],
+        help='Round-trip latency of each listener in seconds.')
+    parser.add_argument('--rounds', type=int, default=10)
+    args = parser.parse_args()
+
+    latency_by_token = {
+        f'listener-{pos}': latency
+        for pos, latency in enumerate(args.latencies)
+    }
+    spotify = FakeSpotify(latency_by_token=latency_by_token)
+    # Read by spotigram.spotify_http at import time.
+    os.environ['SPOTIFY_API_URL'] = spotify.api_url
+
+    from spotigram.actions import SpotifyClientProxy
+    from spotigram.spotify_http import spotify_client
+
+    proxy = SpotifyClientProxy(
+        [spotify_client(token) for token in latency_by_token])
+
+    plain, synced, reported = [], [], []
+    for _ in range(args.rounds):
+        proxy.start_playback(uris=URIS)
+        plain.append(spotify.skew_ms())
+
+        result = proxy.sync_start_playback(uris=URIS)
+        synced.append(spotify.skew_ms())
+        reported.append(result.skew_ms)
+    spotify.stop()
+
+    for name, values in (
+        ('plain', plain),
+        ('synchronized', synced),
+        ('reported', reported),
+    ):
+        print(
+            f'{name:<14} median {statistics.median(values):8.2f}ms  '
+            f'max {max(values):8.2f}ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""Compare JSON and TokenCodec encodings of stored Spotify tokens.
+
+Builds a synthetic token store of 100k chats and reports the encoded
+size and decode times per chat. With `--redis`, the values are also
+written to a throwaway redislite database to compare `used_memory`.
+
+    python -m benchmarks.token_encoding [--chats N] [--redis]
+"""
+import argparse
+import os
+import secrets
+import tempfile
+import time
+
+from spotigram.codecs import (
+    JSONCodec,
+    TokenCodec,
+)
+
+
+def _token_info(now):
+    return {
+        'access_token': secrets.token_urlsafe(150),
+        'refresh_token': secrets.token_urlsafe(100),
+        'token_type': 'Bearer',
+        'expires_in': 3600,
+        'expires_at': now + 3600,
+        'scope': (
+            'user-modify-playback-state user-read-currently-playing '
+            'user-read-playback-state'
+        ),
+    }
+
+
+def _timed(func, values):
+    start = time.perf_counter()
+    for value in values:
+        func(value)
+    return (time.perf_counter() - start) / len(values)
+
+
+def _redis_memory(values):
+    import redislite
+
+    path = os.path.join(tempfile.mkdtemp(), 'tokens.db')
+    client = redislite.Redis(path)
+    before = client.info('memory')['used_memory']
+    pipe = client.pipeline(transaction=False)
+    for chat_id, value in enumerate(values):
+        pipe.hset(f'token-{chat_id}', 'user', value)
+    pipe.execute()
+    used = client.info('memory')['used_memory'] - before
+    client.shutdown()
+    return used
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--chats', type=int, default=100000)
+    parser.add_argument('--redis', action='store_true')
+    args = parser.parse_args()
+
+    now = int(time.time())
+    tokens = [_token_info(now) for _ in range(args.chats)]
+
+    for codec in (JSONCodec, TokenCodec):
+        encoded = [codec.dumps(token) for token in tokens]
+        if isinstance(encoded[0], str):
+            encoded = [value.encode('utf-8') for value in encoded]
+        size = sum(len(value) for value in encoded) / len(encoded)
+        decode = _timed(codec.loads, encoded)
+        if hasattr(codec, 'expires_at'):
+            expiry = _timed(codec.expires_at, encoded)
+        else:
+            expiry = _timed(lambda v: codec.loads(v)['expires_at'], encoded)
+
+        print(
+            f'{codec.__name__:<10} {size:7.1f} bytes/chat  '
+            f'decode {decode * 1e6:6.2f}us  '
+            f'expires_at {expiry * 1e6:6.2f}us'
+        )
+        if args.redis:
+            used = _redis_memory(encoded)
+            print(f'{"":<10} {used / len(encoded):7.1f} bytes/chat in Redis')
+
+
+if __name__ == '__main__':
+    main()
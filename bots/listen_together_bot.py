@@ -1,4 +1,3 @@
-from spotipy import SpotifyException
 from telegram.ext import (
     Filters,
     MessageHandler,
@@ -8,6 +7,9 @@ from spotigram import (
     SpotigramBot,
     spotify_multi_action,
 )
+from spotigram.links import resolve
+from spotigram.sender import outbox
+from spotigram.sync import ENABLED as SYNC_START
 
 
 class ListenTogetherBot(SpotigramBot):
@@ -15,24 +17,26 @@ class ListenTogetherBot(SpotigramBot):
     @staticmethod
     @spotify_multi_action
     def select(multi_client, bot, update):
-
-        text = update.message.text
-
-        if text.startswith('https://open.spotify.com/'):
-            try:
-                track = multi_client.single_client.track(text)
-                uri = track['uri']
-            except SpotifyException:
-                uri = None
-        elif text.startswith('spotify:'):
-            uri = text
+        link = resolve(update.message.text)
+
+        if link is None:
+            outbox(bot).send_message(
+                chat_id=update.message.chat_id,
+                text='Send a Spotify link or URI to listen together.'
+            )
+            return
+
+        sync = None
+        if SYNC_START:
+            sync = multi_client.sync_start_playback(**link.playback_kwargs())
         else:
-            uri = None
-
-        multi_client.start_playback(uris=[uri])
-        bot.send_message(
+            multi_client.start_playback(**link.playback_kwargs())
+        text = f'Now listening to: {link.uri}'
+        if sync is not None and sync.skew_ms is not None:
+            text += f' (in sync within {sync.skew_ms:.0f} ms)'
+        outbox(bot).send_message(
             chat_id=update.message.chat_id,
-            text=f'Now listening to: {uri}'
+            text=text
         )
 
     @classmethod
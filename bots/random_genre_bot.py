@@ -2,29 +2,40 @@ import telegram
 from telegram.ext import (
     CommandHandler,
     Filters,
+    InlineQueryHandler,
     MessageHandler,
 )
 
 from spotigram import (
     SpotigramBot,
-    spotify_multi_action,
+    spotify_multi_action_with,
+)
+from spotigram.sender import outbox
+from spotigram.store import (
+    get_bitset_from_env_for,
+    get_store_from_env_for,
+    LazyStore,
 )
-from spotigram.store import get_store_from_env_for
 from genres import (
     GenrePlaylist,
     random_genres,
+    search_genres,
+    search_index,
+    watch_catalog,
 )
 
-CHAT_DATA = get_store_from_env_for('chat')
+CHAT_DATA = LazyStore(get_store_from_env_for, 'chat')
+# Stable ids of the genres each chat has been offered.
+HISTORY = LazyStore(get_bitset_from_env_for, 'history')
+
+CHOICES = 3
+INLINE_RESULTS = 10
 
 
 class RandomGenreBot(SpotigramBot):
 
     @staticmethod
-    def genres(bot, update):
-        chat_id = update.message.chat_id
-        playlists = random_genres(3)
-
+    def offer(bot, chat_id, playlists):
         CHAT_DATA.set(chat_id, 'playlists', [pl._uri for pl in playlists])
 
         response = 'Choose a genre:\n\n' + '\n'.join([
@@ -34,29 +45,93 @@ class RandomGenreBot(SpotigramBot):
         keyboard = telegram.ReplyKeyboardMarkup(
             [[str(pos)] for pos in range(1, len(playlists) + 1)]
         )
-        bot.send_message(
+        outbox(bot).send_message(
             chat_id=chat_id,
             text=response,
             reply_markup=keyboard
         )
 
+    @classmethod
+    def genres(cls, bot, update):
+        chat_id = update.message.chat_id
+        playlists = random_genres(CHOICES, HISTORY.get(chat_id))
+        if len(playlists) < CHOICES:
+            # Every genre has been offered, start over.
+            HISTORY.clear(chat_id)
+            playlists = random_genres(CHOICES)
+        HISTORY.set_bits(chat_id, [pl.genre_id for pl in playlists])
+
+        cls.offer(bot, chat_id, playlists)
+
+    @classmethod
+    def genre(cls, bot, update, args):
+        chat_id = update.message.chat_id
+        query = ' '.join(args)
+        playlists = search_genres(query, CHOICES) if query else []
+
+        if not playlists:
+            outbox(bot).send_message(
+                chat_id=chat_id,
+                text=(
+                    f'No genre matches "{query}".' if query
+                    else 'Usage: /genre <name>'
+                ),
+            )
+            return
+
+        cls.offer(bot, chat_id, playlists)
+
+    @staticmethod
+    def inline_genres(bot, update):
+        query = update.inline_query.query.strip()
+        if not query:
+            return
+
+        # Choosing a result sends the /genre command for that genre.
+        results = [
+            telegram.InlineQueryResultArticle(
+                id=str(pl.genre_id),
+                title=pl.genre,
+                input_message_content=telegram.InputTextMessageContent(
+                    f'/genre {pl.genre}'),
+            )
+            for pl in search_genres(query, INLINE_RESULTS)
+        ]
+        # Answered directly: inline results are only useful while the user
+        # is still typing, so they must not wait behind queued messages.
+        bot.answer_inline_query(
+            update.inline_query.id, results, cache_time=300)
+
     @staticmethod
-    @spotify_multi_action
-    def choose(multi_client, bot, update):
+    @spotify_multi_action_with('chat')
+    def choose(multi_client, bot, update, prefetched=None):
         try:
             choice = int(update.message.text)
         except ValueError:
             choice = None
 
         chat_id = update.message.chat_id
-        playlist_uris = CHAT_DATA.get(chat_id, 'playlists')
+        if prefetched is not None:
+            playlist_uris = prefetched.get('playlists')
+        else:
+            playlist_uris = CHAT_DATA.get(chat_id, 'playlists')
 
-        if choice and playlist_uris:
-            pl = GenrePlaylist(playlist_uris[choice - 1])
+        if choice and playlist_uris and choice <= len(playlist_uris):
+            try:
+                pl = GenrePlaylist(playlist_uris[choice - 1])
+            except KeyError:
+                # The catalog was reloaded without this playlist.
+                outbox(bot).send_message(
+                    chat_id=chat_id,
+                    text='The genres have changed, please run the '
+                         'command again.',
+                    reply_markup=telegram.ReplyKeyboardRemove(),
+                )
+                return
             multi_client.start_playback(
                 context_uri=pl.uri)
 
-            bot.send_message(
+            outbox(bot).send_message(
                 chat_id=chat_id,
                 text=f'Now listening to: [{pl.name}]({pl.link})',
                 reply_markup=telegram.ReplyKeyboardRemove(),
@@ -64,10 +139,20 @@ class RandomGenreBot(SpotigramBot):
                 disable_web_page_preview=True,
             )
 
+    @classmethod
+    def start_background_tasks(cls):
+        super().start_background_tasks()
+        # Build the search index up front, so the first inline query does
+        # not pay for it. Reloads rebuild it with the catalog.
+        search_index()
+        watch_catalog()
+
     @classmethod
     def custom_handlers(cls):
         return (
             CommandHandler('genres', cls.genres),
+            CommandHandler('genre', cls.genre, pass_args=True),
+            InlineQueryHandler(cls.inline_genres),
             MessageHandler(Filters.regex(r'^\s*\d\s*$'), cls.choose),
         )
 
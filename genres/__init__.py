@@ -1,27 +1,207 @@
 import json
+import logging
+import os
 import random
+import sys
+import time
+from array import array
+from bisect import bisect_left
 from pathlib import Path
+from threading import (
+    Lock,
+    Thread,
+)
 
 
+logger = logging.getLogger(__name__)
+
 MODULE_PATH = Path(__file__).parent
 PLAYLISTS_FILE = MODULE_PATH / 'genre_playlists.json'
+COMPILED_FILE = MODULE_PATH / 'genre_playlists.bin'
+GENRE_IDS_FILE = MODULE_PATH / 'genre_ids.json'
 
 PLAYLIST_TAG = 'spotify:playlist:'
 
-with open(PLAYLISTS_FILE, 'r') as f:
-    PLAYLISTS = json.load(f)
+PLAYLIST_TYPES = ('Sound', 'Pulse', 'Edge')
+
+RELOAD_INTERVAL = float(os.getenv('GENRE_CATALOG_RELOAD_INTERVAL', 60))
+
+# Random picks per requested genre before an unseen-first sample falls
+# back to listing all unseen genres.
+MAX_ATTEMPTS = 16
+
+
+def load_genre_ids(path=GENRE_IDS_FILE):
+    """Stable ids of all genres ever seen, as a name to id dict.
+
+    The file is an append-only JSON list of names, so ids survive catalog
+    refreshes that add or remove genres.
+    """
+    try:
+        with open(path, 'r') as f:
+            names = json.load(f)
+    except FileNotFoundError:
+        names = []
+    return {name: genre_id for genre_id, name in enumerate(names)}
+
+
+def is_seen(seen, genre_id):
+    """Whether bit `genre_id` is set in the big-endian bitset `seen`."""
+    byte = genre_id >> 3
+    return byte < len(seen) and bool(seen[byte] & (0x80 >> (genre_id & 7)))
+
+
+class GenreCatalog:
+    """Compact, read-only index over the genre playlists.
+
+    Playlists are stored in parallel arrays sorted by playlist id, so a
+    URI is found by bisection. `_by_genre` lists playlist positions grouped
+    by genre, with `_genre_offsets` marking where each genre starts.
+    `genre_ids` holds the stable id of every genre.
+    """
+
+    __slots__ = (
+        'genres',
+        'genre_ids',
+        '_ids',
+        '_genre_of',
+        '_type_of',
+        '_by_genre',
+        '_genre_offsets',
+    )
+
+    def __init__(self, genres, genre_ids, ids, genre_of, type_of, by_genre,
+                 offsets):
+        self.genres = genres
+        self.genre_ids = genre_ids
+        self._ids = ids
+        self._genre_of = genre_of
+        self._type_of = type_of
+        self._by_genre = by_genre
+        self._genre_offsets = offsets
+
+    @classmethod
+    def from_dict(cls, playlists, known_ids=None):
+        genres = tuple(sys.intern(genre) for genre in playlists)
+
+        # Genres missing from the ids file get ids after the known ones,
+        # in catalog order, so every process assigns the same ids.
+        known_ids = known_ids or {}
+        next_id = max(known_ids.values(), default=-1) + 1
+        genre_ids = array('I')
+        for genre in genres:
+            if genre not in known_ids:
+                known_ids[genre] = next_id
+                next_id += 1
+            genre_ids.append(known_ids[genre])
+
+        entries = sorted(
+            (uri, genre_idx, PLAYLIST_TYPES.index(pl_type))
+            for genre_idx, genre in enumerate(genres)
+            for pl_type, uri in playlists[genre].items()
+        )
+        ids = [uri for uri, _, _ in entries]
+        genre_of = array('I', (genre_idx for _, genre_idx, _ in entries))
+        type_of = array('B', (type_idx for _, _, type_idx in entries))
 
-PLAYLISTS_BY_URI = {
-    uri: (pl_type, genre)
-    for genre, outer_v in PLAYLISTS.items()
-    for pl_type, uri in outer_v.items()
-}
+        by_genre = array('I', sorted(
+            range(len(entries)), key=genre_of.__getitem__))
+        offsets = array('I', [0] * (len(genres) + 1))
+        for genre_idx in genre_of:
+            offsets[genre_idx + 1] += 1
+        for genre_idx in range(len(genres)):
+            offsets[genre_idx + 1] += offsets[genre_idx]
+
+        return cls(
+            genres, genre_ids, ids, genre_of, type_of, by_genre, offsets)
+
+    @classmethod
+    def from_file(cls, path, ids_path=GENRE_IDS_FILE):
+        with open(path, 'r') as f:
+            return cls.from_dict(json.load(f), load_genre_ids(ids_path))
+
+    def _position(self, uri):
+        ids = self._ids
+        if not isinstance(ids, list):
+            # Memory-mapped ids bisect their raw bytes.
+            return ids.position(uri)
+        pos = bisect_left(ids, uri)
+        if pos == len(ids) or ids[pos] != uri:
+            raise KeyError(uri)
+        return pos
+
+    def _entry(self, pos):
+        return (
+            PLAYLIST_TYPES[self._type_of[pos]],
+            self.genres[self._genre_of[pos]],
+        )
+
+    def __getitem__(self, uri):
+        return self._entry(self._position(uri))
+
+    def __contains__(self, uri):
+        try:
+            self._position(uri)
+        except KeyError:
+            return False
+        return True
+
+    def __len__(self):
+        return len(self._ids)
+
+    def random_playlist(self, genre_idx):
+        """One random playlist of the genre at `genre_idx`."""
+        pos = self._by_genre[random.randrange(
+            self._genre_offsets[genre_idx],
+            self._genre_offsets[genre_idx + 1],
+        )]
+        pl_type, genre = self._entry(pos)
+        return GenrePlaylist(
+            self._ids[pos], genre, pl_type,
+            genre_id=self.genre_ids[genre_idx],
+        )
+
+    def _sample_unseen(self, k, seen):
+        chosen = []
+        for _ in range(k * MAX_ATTEMPTS):
+            if len(chosen) == k:
+                return chosen
+            genre_idx = random.randrange(len(self.genres))
+            if genre_idx not in chosen and not is_seen(
+                seen, self.genre_ids[genre_idx]
+            ):
+                chosen.append(genre_idx)
+
+        # Most genres have been seen, pick from the rest directly.
+        unseen = [
+            genre_idx for genre_idx in range(len(self.genres))
+            if genre_idx not in chosen
+            and not is_seen(seen, self.genre_ids[genre_idx])
+        ]
+        return chosen + random.sample(
+            unseen, min(k - len(chosen), len(unseen)))
+
+    def sample(self, k, seen=None):
+        """Pick `k` distinct genres and one random playlist for each.
+
+        Genres whose stable id is set in the bitset `seen` are skipped;
+        fewer than `k` playlists are returned if not enough are unseen.
+        """
+        if seen:
+            genre_idxs = self._sample_unseen(k, seen)
+        else:
+            genre_idxs = random.sample(
+                range(len(self.genres)), min(k, len(self.genres)))
+        return [self.random_playlist(genre_idx) for genre_idx in genre_idxs]
 
 
 class GenrePlaylist:
 
-    def __init__(self, uri, genre=None, pl_type=None):
+    __slots__ = ('_uri', 'genre', 'pl_type', 'genre_id')
+
+    def __init__(self, uri, genre=None, pl_type=None, genre_id=None):
         self._uri = uri
+        self.genre_id = genre_id
 
         if not genre or not pl_type:
             self.pl_type, self.genre = PLAYLISTS_BY_URI[uri]
@@ -52,19 +232,140 @@ class GenrePlaylist:
         return f'{self.__class__.__name__}({self.name})'
 
 
-def random_genres(k=3):
-    genres = random.sample(list(PLAYLISTS), 3)
-    choices = {
-        genre: random.choice(list(PLAYLISTS[genre].items()))
-        for genre in genres
-    }
+_catalog = None
+_catalog_lock = Lock()
+_search_index = None
+
+
+def _load_catalog():
+    from genres.compiled import (
+        compile_catalog,
+        load_catalog,
+        StaleCatalogError,
+    )
+
+    try:
+        return load_catalog(GenreCatalog, PLAYLISTS_FILE, COMPILED_FILE)
+    except (OSError, StaleCatalogError) as e:
+        logger.info(f'Rebuilding compiled genre catalog: {e}')
+
+    catalog = GenreCatalog.from_file(PLAYLISTS_FILE)
+    try:
+        compile_catalog(catalog, PLAYLISTS_FILE, COMPILED_FILE)
+        return load_catalog(GenreCatalog, PLAYLISTS_FILE, COMPILED_FILE)
+    except (OSError, StaleCatalogError):
+        logger.exception('Using the uncompiled genre catalog.')
+        return catalog
+
+
+def catalog():
+    """The genre catalog, memory-mapped on first use."""
+    global _catalog
+    if _catalog is None:
+        with _catalog_lock:
+            if _catalog is None:
+                _catalog = _load_catalog()
+    return _catalog
+
+
+def reload_catalog():
+    """Load the genre files again and swap the new catalog in.
+
+    Readers keep using the previous catalog until the assignment, which is
+    atomic, so requests are never blocked by a reload.
+    """
+    global _catalog, _search_index
+    new_catalog = _load_catalog()
+    new_index = _build_index(new_catalog) if _search_index else None
+    with _catalog_lock:
+        _catalog = new_catalog
+        _search_index = new_index
+    return new_catalog
+
+
+def _build_index(catalog):
+    from genres.search import GenreIndex
+    return GenreIndex(catalog)
+
+
+def search_index():
+    """Search index over the current catalog, built on first use.
+
+    Once built, it is rebuilt together with the catalog on every reload.
+    """
+    global _search_index
+    current = catalog()
+    index = _search_index
+    if index is None or index.catalog is not current:
+        with _catalog_lock:
+            if _search_index is None or _search_index.catalog is not _catalog:
+                _search_index = _build_index(_catalog)
+            index = _search_index
+    return index
+
+
+def search_genres(query, limit=10):
+    """Playlists of the genres best matching `query`, one per genre."""
+    index = search_index()
     return [
-        GenrePlaylist(uri, genre, pl_type)
-        for (genre, (pl_type, uri)) in choices.items()
+        index.catalog.random_playlist(genre_idx)
+        for genre_idx in index.search(query, limit)
     ]
 
 
+def _source_version():
+    stat = os.stat(PLAYLISTS_FILE)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def watch_catalog(interval=RELOAD_INTERVAL):
+    """Reload the catalog whenever the genre JSON file is replaced."""
+    def watch():
+        version = _source_version()
+        while True:
+            time.sleep(interval)
+            try:
+                current = _source_version()
+                if current != version:
+                    reload_catalog()
+                    version = current
+                    logger.info('Reloaded genre catalog.')
+            except Exception:
+                logger.exception('Reloading genre catalog failed.')
+
+    thread = Thread(target=watch, name='catalog-watcher', daemon=True)
+    thread.start()
+    return thread
+
+
+class _PlaylistsByUri:
+
+    __slots__ = ()
+
+    def __getitem__(self, uri):
+        return catalog()[uri]
+
+    def __contains__(self, uri):
+        return uri in catalog()
+
+    def __len__(self):
+        return len(catalog())
+
+
+PLAYLISTS_BY_URI = _PlaylistsByUri()
+
+
+def random_genres(k=3, seen=None):
+    return catalog().sample(k, seen)
+
+
 __all__ = [
+    'catalog',
     'random_genres',
+    'reload_catalog',
+    'search_genres',
+    'search_index',
+    'watch_catalog',
+    'GenreCatalog',
     'GenrePlaylist',
 ]
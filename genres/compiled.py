@@ -0,0 +1,197 @@
+"""Binary, memory-mapped form of `genre_playlists.json`.
+
+Layout (little endian, every section padded to 4 bytes):
+
+    header          magic, version, source crc32 and size, counts
+    genre_names     u32[n_genres + 1] offsets into the string table
+    genre_offsets   u32[n_genres + 1] offsets into by_genre
+    genre_ids       u32[n_genres] stable genre ids
+    genre_of        u32[n_playlists]
+    by_genre        u32[n_playlists]
+    type_of         u8[n_playlists]
+    ids             n_playlists * id_len ascii bytes, sorted
+    strings         utf-8 genre names
+
+The JSON file stays the source of truth; the header records its crc32 and
+size so a stale compiled file is detected and rebuilt.
+"""
+import mmap
+import os
+import struct
+import sys
+import zlib
+from array import array
+
+MAGIC = b'RGBC'
+VERSION = 2
+HEADER = struct.Struct('<4sHHIIIII')
+
+
+class StaleCatalogError(Exception):
+    pass
+
+
+class _FixedStrings:
+    """Sequence of fixed-width ascii strings inside a buffer."""
+
+    __slots__ = ('_buf', '_width', '_len')
+
+    def __init__(self, buf, width):
+        self._buf = buf
+        self._width = width
+        self._len = len(buf) // width if width else 0
+
+    def __getitem__(self, idx):
+        if not 0 <= idx < self._len:
+            raise IndexError(idx)
+        start = idx * self._width
+        return str(self._buf[start:start + self._width], 'ascii')
+
+    def __len__(self):
+        return self._len
+
+    def position(self, value):
+        """Index of `value` in the sorted strings, or KeyError.
+
+        Bisects the raw bytes, so only the query is encoded.
+        """
+        try:
+            key = value.encode('ascii')
+        except UnicodeEncodeError:
+            raise KeyError(value) from None
+        buf, width = self._buf, self._width
+        if len(key) != width:
+            raise KeyError(value)
+
+        lo, hi = 0, self._len
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = mid * width
+            if buf[start:start + width].tobytes() < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        start = lo * width
+        if lo == self._len or buf[start:start + width] != key:
+            raise KeyError(value)
+        return lo
+
+
+class _StringTable:
+    """Sequence of variable-width utf-8 strings addressed by offsets."""
+
+    __slots__ = ('_buf', '_offsets')
+
+    def __init__(self, buf, offsets):
+        self._buf = buf
+        self._offsets = offsets
+
+    def __getitem__(self, idx):
+        if not 0 <= idx < len(self):
+            raise IndexError(idx)
+        return str(
+            self._buf[self._offsets[idx]:self._offsets[idx + 1]], 'utf-8')
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+
+def _padded(data):
+    return data + b'\0' * (-len(data) % 4)
+
+
+def source_checksum(source_path):
+    with open(source_path, 'rb') as f:
+        data = f.read()
+    return zlib.crc32(data), len(data)
+
+
+def compile_catalog(catalog, source_path, target_path):
+    """Write `catalog` (a GenreCatalog) in binary form next to its source."""
+    crc, size = source_checksum(source_path)
+
+    id_len = len(catalog._ids[0]) if len(catalog) else 0
+    ids = b''.join(uri.encode('ascii') for uri in catalog._ids)
+    if len(ids) != id_len * len(catalog):
+        raise ValueError('Playlist ids must all have the same length.')
+
+    names = [genre.encode('utf-8') for genre in catalog.genres]
+    name_offsets = array('I', [0])
+    for name in names:
+        name_offsets.append(name_offsets[-1] + len(name))
+
+    def u32(values):
+        data = array('I', values)
+        if sys.byteorder != 'little':
+            data.byteswap()
+        return data.tobytes()
+
+    sections = (
+        u32(name_offsets),
+        u32(catalog._genre_offsets),
+        u32(catalog.genre_ids),
+        u32(catalog._genre_of),
+        u32(catalog._by_genre),
+        bytes(catalog._type_of),
+        ids,
+        b''.join(names),
+    )
+    header = HEADER.pack(
+        MAGIC, VERSION, id_len, crc, size,
+        len(catalog.genres), len(catalog), 0,
+    )
+
+    tmp_path = f'{target_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(header)
+        for section in sections:
+            f.write(_padded(section))
+    os.replace(tmp_path, target_path)
+
+
+def load_catalog(catalog_cls, source_path, target_path):
+    """Map a compiled catalog, raising StaleCatalogError if it is outdated."""
+    if sys.byteorder != 'little':
+        raise StaleCatalogError('Compiled catalogs are little endian.')
+
+    with open(target_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size < HEADER.size:
+            raise StaleCatalogError(f'{target_path} is truncated.')
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    view = memoryview(buf)
+    magic, version, id_len, crc, size, n_genres, n_playlists, _ = (
+        HEADER.unpack_from(view))
+    if magic != MAGIC or version != VERSION:
+        raise StaleCatalogError(f'{target_path} has an unknown format.')
+    if (crc, size) != source_checksum(source_path):
+        raise StaleCatalogError(f'{target_path} is older than its source.')
+
+    pos = HEADER.size
+
+    def take(length, fmt='B'):
+        nonlocal pos
+        if pos + length > len(view):
+            raise StaleCatalogError(f'{target_path} is truncated.')
+        section = view[pos:pos + length]
+        pos += length + (-length % 4)
+        return section.cast(fmt) if fmt != 'B' else section
+
+    name_offsets = take(4 * (n_genres + 1), 'I')
+    genre_offsets = take(4 * (n_genres + 1), 'I')
+    genre_ids = take(4 * n_genres, 'I')
+    genre_of = take(4 * n_playlists, 'I')
+    by_genre = take(4 * n_playlists, 'I')
+    type_of = take(n_playlists)
+    ids = take(id_len * n_playlists)
+    strings = take(name_offsets[-1])
+
+    return catalog_cls(
+        _StringTable(strings, name_offsets),
+        genre_ids,
+        _FixedStrings(ids, id_len),
+        genre_of,
+        type_of,
+        by_genre,
+        genre_offsets,
+    )
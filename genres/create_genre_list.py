@@ -1,12 +1,30 @@
+import hashlib
 import json
+import os
 import re
+import time
+from concurrent.futures import (
+    as_completed,
+    ThreadPoolExecutor,
+)
 
-from genres import PLAYLISTS_FILE, PLAYLIST_TAG
+from spotipy import SpotifyException
+
+from genres import (
+    COMPILED_FILE,
+    GENRE_IDS_FILE,
+    GenreCatalog,
+    load_genre_ids,
+    MODULE_PATH,
+    PLAYLISTS_FILE,
+    PLAYLIST_TAG,
+)
+from genres.compiled import compile_catalog
 
 try:
     from tqdm import tqdm
 except ImportError:
-    def tqdm(iterable):
+    def tqdm(iterable, **kwargs):
         return iterable
 
 try:
@@ -20,42 +38,246 @@ except ImportError:
 PLAYLIST_REGEX = re.compile('^The (Sound|Pulse|Edge) of ')
 
 LIMIT = 50
+WORKERS = 8
+USERS = ('thesoundsofspotify', 'particledetector')
+CHECKPOINT_DIR = MODULE_PATH / '.crawl'
+STATE_FILE = MODULE_PATH / 'crawl_state.json'
+
+
+def _with_retry(func, *args, **kwargs):
+    while True:
+        try:
+            return func(*args, **kwargs)
+        except SpotifyException as e:
+            if e.http_status != 429:
+                raise
+            headers = getattr(e, 'headers', None) or {}
+            time.sleep(int(headers.get('Retry-After', 1)))
+
+
+class _Checkpoint:
+    """Pages of one user's playlists fetched so far, persisted to disk."""
+
+    def __init__(self, path):
+        self.path = path
+        self.total = None
+        self.pages = {}
+        if path.exists():
+            with open(path, 'r') as f:
+                data = json.load(f)
+            self.total = data['total']
+            self.pages = {int(k): v for k, v in data['pages'].items()}
+
+    def offsets(self):
+        # The sequential crawler never read the last page, keep it that way
+        # so the genre map stays the same.
+        return range(0, self.total - LIMIT, LIMIT)
+
+    def save(self, offset, page):
+        self.total = page['total']
+        self.pages[offset] = [
+            {
+                'name': playlist['name'],
+                'uri': playlist['uri'],
+                'snapshot_id': playlist.get('snapshot_id'),
+            }
+            for playlist in page['items']
+        ]
+        tmp_path = self.path.with_suffix('.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump({'total': self.total, 'pages': self.pages}, f)
+        os.replace(tmp_path, self.path)
+
+    def playlists(self):
+        for offset in self.offsets():
+            yield from self.pages[offset]
+
+    def fingerprints(self):
+        fingerprints = {}
+        for offset in self.offsets():
+            digest = hashlib.sha1()
+            for playlist in self.pages[offset]:
+                digest.update(
+                    f'{playlist["uri"]} {playlist["snapshot_id"]} '
+                    f'{playlist["name"]}\n'.encode('utf-8'))
+            fingerprints[str(offset)] = digest.hexdigest()
+        return fingerprints
 
+    def remove(self):
+        if self.path.exists():
+            self.path.unlink()
 
-def _fetch_playlist_batches(client, genres, user):
-    playlists = client.user_playlists(user)
+
+def _fetch_pages(client, checkpoints, workers):
+    def fetch(user, offset):
+        return _with_retry(
+            client.user_playlists, user, limit=LIMIT, offset=offset)
+
+    for user, checkpoint in checkpoints.items():
+        if checkpoint.total is None:
+            checkpoint.save(0, fetch(user, 0))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(fetch, user, offset): (user, offset)
+            for user, checkpoint in checkpoints.items()
+            for offset in checkpoint.offsets()
+            if offset not in checkpoint.pages
+        }
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            user, offset = futures[future]
+            checkpoints[user].save(offset, future.result())
+
+
+def _collect_genres(genres, playlists):
     previous_genre_name = ''
-    for _ in tqdm(range(LIMIT, playlists['total'], LIMIT)):
-        for playlist in playlists['items']:
-            name = playlist['name']
-            match = PLAYLIST_REGEX.match(name)
-            if match:
-                genre_name = re.sub(PLAYLIST_REGEX, '', name)
+    for playlist in playlists:
+        name = playlist['name']
+        match = PLAYLIST_REGEX.match(name)
+        if match:
+            genre_name = re.sub(PLAYLIST_REGEX, '', name)
+
+            # Skip city and country playlists from thesoundofspotify
+            if (
+                previous_genre_name and
+                (previous_genre_name > genre_name)
+                and genre_name.endswith(alpha2_country_codes)
+            ):
+                return
+
+            playlist_type = match.group(1)
+            genre_entry = genres.setdefault(genre_name, {})
+            genre_entry[playlist_type] = playlist['uri'].replace(
+                PLAYLIST_TAG, '')
+
+            previous_genre_name = genre_name
+
 
-                # Skip city and country playlists from thesoundofspotify
-                if (
-                    previous_genre_name and
-                    (previous_genre_name > genre_name)
-                    and genre_name.endswith(alpha2_country_codes)
-                ):
-                    return
+def _crawl(client, workers, checkpoint_dir):
+    checkpoint_dir.mkdir(parents=True, exist_ok=True)
+    checkpoints = {
+        user: _Checkpoint(checkpoint_dir / f'{user}.json')
+        for user in USERS
+    }
 
-                playlist_type = match.group(1)
-                genre_entry = genres.setdefault(genre_name, {})
-                genre_entry[playlist_type] = playlist['uri'].replace(
-                    PLAYLIST_TAG, '')
+    print(f'Fetching for {", ".join(USERS)}...')
+    _fetch_pages(client, checkpoints, workers)
+    return checkpoints
 
-                previous_genre_name = genre_name
 
-        playlists = client.next(playlists)
+def _crawl_state(checkpoints):
+    return {
+        'pages': {
+            user: checkpoint.fingerprints()
+            for user, checkpoint in checkpoints.items()
+        },
+    }
 
 
-def create_genre_file(client):
+def _write_json(path, data, **kwargs):
+    tmp_path = path.with_suffix('.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, **kwargs)
+    os.replace(tmp_path, path)
+
+
+def _write_genre_files(genres, checkpoints, state_file):
+    # Genre ids are append-only: new genres get the next free ids and
+    # removed ones keep theirs, so per-chat histories stay valid.
+    known_ids = load_genre_ids()
+    catalog = GenreCatalog.from_dict(genres, known_ids)
+    _write_json(
+        GENRE_IDS_FILE, sorted(known_ids, key=known_ids.get), indent=2)
+
+    # Replace the JSON file atomically, running bots may be watching it.
+    _write_json(PLAYLISTS_FILE, genres, indent=2)
+    compile_catalog(catalog, PLAYLISTS_FILE, COMPILED_FILE)
+    _write_json(state_file, _crawl_state(checkpoints))
+
+
+def _genre_diff(old, new):
+    return {
+        'added': sorted(set(new) - set(old)),
+        'removed': sorted(set(old) - set(new)),
+        'changed': sorted(
+            genre for genre in set(old) & set(new)
+            if old[genre] != new[genre]
+        ),
+    }
+
+
+def create_genre_file(
+    client,
+    workers=WORKERS,
+    checkpoint_dir=CHECKPOINT_DIR,
+    state_file=STATE_FILE,
+):
+    """Crawl the genre playlists and write the genre files.
+
+    Pages are fetched concurrently and checkpointed to `checkpoint_dir`,
+    so an interrupted crawl resumes where it stopped.
+    """
+    checkpoints = _crawl(client, workers, checkpoint_dir)
+
     genres = {}
+    for checkpoint in checkpoints.values():
+        _collect_genres(genres, checkpoint.playlists())
+
+    _write_genre_files(genres, checkpoints, state_file)
+
+    for checkpoint in checkpoints.values():
+        checkpoint.remove()
+
+
+def update_genre_file(
+    client,
+    workers=WORKERS,
+    checkpoint_dir=CHECKPOINT_DIR,
+    state_file=STATE_FILE,
+):
+    """Refresh the genre files from the last crawl state.
+
+    Every page is fetched, as snapshot ids are only listed with the
+    pages. Their fingerprints (playlist ids, names and snapshot ids) are
+    compared with the previous crawl; genres are only collected again if a
+    page changed, and the files are only rewritten if a genre changed.
+    Returns the diff of added, removed and changed genres.
+    """
+    if not state_file.exists():
+        create_genre_file(client, workers, checkpoint_dir, state_file)
+        return None
+
+    with open(state_file, 'r') as f:
+        previous_pages = json.load(f)['pages']
+    with open(PLAYLISTS_FILE, 'r') as f:
+        old_genres = json.load(f)
+
+    checkpoints = _crawl(client, workers, checkpoint_dir)
+
+    pages_changed = any(
+        previous_pages.get(user) != checkpoint.fingerprints()
+        for user, checkpoint in checkpoints.items()
+    )
+    if pages_changed:
+        # The city/country cut-off depends on page order, so genres are
+        # collected over all pages; the page data is already local.
+        new_genres = {}
+        for checkpoint in checkpoints.values():
+            _collect_genres(new_genres, checkpoint.playlists())
+    else:
+        new_genres = old_genres
+
+    diff = _genre_diff(old_genres, new_genres)
+    if any(diff.values()):
+        _write_genre_files(new_genres, checkpoints, state_file)
+    else:
+        _write_json(state_file, _crawl_state(checkpoints))
 
-    for user in ('thesoundsofspotify', 'particledetector'):
-        print(f'Fetching for {user}...')
-        _fetch_playlist_batches(client, genres, user)
+    for checkpoint in checkpoints.values():
+        checkpoint.remove()
 
-    with open(PLAYLISTS_FILE, 'w') as f:
-        json.dump(genres, f, indent=2)
+    for kind, names in diff.items():
+        print(f'{kind}: {len(names)} genres')
+        for name in names:
+            print(f'  {name}')
+    return diff
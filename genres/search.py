@@ -0,0 +1,139 @@
+"""Search over the genre names of a GenreCatalog.
+
+Prefix matches come from a sorted array of (word, genre) pairs, where the
+words sharing a prefix form one contiguous range found by bisection.
+Fuzzy matches come from a trigram index ranked by trigram similarity.
+"""
+import heapq
+import re
+import unicodedata
+from array import array
+from bisect import bisect_left
+from collections import defaultdict
+
+# Minimum Jaccard similarity of the trigram sets for a fuzzy match.
+MIN_SIMILARITY = 0.25
+
+_NON_ALNUM = re.compile(r'[^0-9a-z]+')
+
+
+def normalize(text):
+    """Lower case ascii words of `text`, without accents and punctuation."""
+    text = unicodedata.normalize('NFKD', text.casefold())
+    text = text.encode('ascii', 'ignore').decode('ascii')
+    return _NON_ALNUM.sub(' ', text).strip()
+
+
+def trigrams(text):
+    padded = f'  {text} '
+    return {padded[pos:pos + 3] for pos in range(len(padded) - 2)}
+
+
+class GenreIndex:
+    """Prefix and trigram index over the genres of `catalog`.
+
+    `search` returns genre indexes of the catalog, best match first.
+    """
+
+    __slots__ = (
+        'catalog',
+        '_names',
+        '_rank',
+        '_words',
+        '_word_genres',
+        '_trigrams',
+    )
+
+    def __init__(self, catalog):
+        self.catalog = catalog
+        self._names = [normalize(genre) for genre in catalog.genres]
+
+        # Shorter names first, so "Jazz" comes before "Jazz Funk".
+        self._rank = array('I', bytes(4 * len(self._names)))
+        by_length = sorted(
+            range(len(self._names)),
+            key=lambda genre_idx: (
+                len(self._names[genre_idx]), self._names[genre_idx]),
+        )
+        for rank, genre_idx in enumerate(by_length):
+            self._rank[genre_idx] = rank
+
+        words = sorted(
+            (word, genre_idx)
+            for genre_idx, name in enumerate(self._names)
+            for word in name.split()
+        )
+        self._words = [word for word, _ in words]
+        self._word_genres = array('I', (genre_idx for _, genre_idx in words))
+
+        postings = defaultdict(lambda: array('I'))
+        for genre_idx, name in enumerate(self._names):
+            for trigram in trigrams(name):
+                postings[trigram].append(genre_idx)
+        self._trigrams = dict(postings)
+
+    def prefix_matches(self, query, limit=None):
+        """Genres with words starting with every word of `query`.
+
+        Names starting with the query come first, then shorter names.
+        """
+        words = normalize(query).split()
+        if not words:
+            return []
+
+        matches = None
+        for word in words:
+            pos = bisect_left(self._words, word)
+            found = set()
+            while pos < len(self._words) and (
+                self._words[pos].startswith(word)
+            ):
+                found.add(self._word_genres[pos])
+                pos += 1
+            matches = found if matches is None else matches & found
+            if not matches:
+                return []
+
+        first = words[0]
+        rank = self._rank
+        names = self._names
+
+        def key(genre_idx):
+            return (not names[genre_idx].startswith(first), rank[genre_idx])
+
+        if limit is None:
+            return sorted(matches, key=key)
+        return heapq.nsmallest(limit, matches, key=key)
+
+    def fuzzy_matches(self, query, min_similarity=MIN_SIMILARITY):
+        """Genres whose trigrams are similar to the ones of `query`."""
+        query_trigrams = trigrams(normalize(query))
+        shared = defaultdict(int)
+        for trigram in query_trigrams:
+            for genre_idx in self._trigrams.get(trigram, ()):
+                shared[genre_idx] += 1
+
+        scored = []
+        for genre_idx, count in shared.items():
+            # Every name of n characters has n + 1 distinct-position
+            # trigrams, which is close enough to its trigram set size.
+            size = len(self._names[genre_idx]) + 1
+            similarity = count / (len(query_trigrams) + size - count)
+            if similarity >= min_similarity:
+                scored.append((-similarity, self._names[genre_idx], genre_idx))
+        scored.sort()
+        return [genre_idx for _, _, genre_idx in scored]
+
+    def search(self, query, limit=10):
+        results = self.prefix_matches(query, limit)
+        if len(results) < limit:
+            seen = set(results)
+            for genre_idx in self.fuzzy_matches(query):
+                if genre_idx not in seen:
+                    results.append(genre_idx)
+                    if len(results) == limit:
+                        break
+        return results
+
+    def search_names(self, query, limit=10):
+        return [self.catalog.genres[idx] for idx in self.search(query, limit)]
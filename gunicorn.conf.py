@@ -0,0 +1,22 @@
+"""gunicorn settings, see run.sh.
+
+Sets up the directory prometheus_client shares metrics through. It must
+be set before the workers import the app, and is emptied on every start
+so samples of a previous deployment are not merged into /metrics.
+"""
+import os
+import shutil
+
+METRICS_DIR = os.environ.setdefault(
+    'prometheus_multiproc_dir', '/tmp/spotigram-metrics')
+
+
+def on_starting(server):
+    shutil.rmtree(METRICS_DIR, ignore_errors=True)
+    os.makedirs(METRICS_DIR)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid, METRICS_DIR)
@@ -1 +1 @@
-gunicorn "bots.random_genre_bot:RandomGenreBot.create_app()" --log-file=-
+gunicorn -c gunicorn.conf.py "bots.random_genre_bot:RandomGenreBot.create_app()" --log-file=-
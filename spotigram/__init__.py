@@ -1,6 +1,7 @@
 from .actions import (
     spotify_action,
     spotify_multi_action,
+    spotify_multi_action_with,
 )
 from .spotify_telegram_bot import SpotigramBot
 
@@ -8,5 +9,6 @@ from .spotify_telegram_bot import SpotigramBot
 __all__ = [
     'spotify_action',
     'spotify_multi_action',
+    'spotify_multi_action_with',
     'SpotigramBot',
 ]
@@ -1,11 +1,25 @@
 import logging
+import os
+from collections import namedtuple
+from concurrent.futures import (
+    ThreadPoolExecutor,
+    TimeoutError as FutureTimeoutError,
+    wait,
+)
 from functools import wraps
-from typing import List
+from threading import Lock
+from typing import (
+    List,
+    TYPE_CHECKING,
+)
 
 import telegram
-from spotipy.client import Spotify, SpotifyException
 
-from spotigram.authorization import get_clients_or_auth_url
+from spotigram.sender import outbox
+from spotigram.sync import sync_start_playback
+
+if TYPE_CHECKING:
+    from spotipy.client import Spotify
 
 
 logging.basicConfig(
@@ -14,39 +28,144 @@ logging.basicConfig(
 
 logger = logging.getLogger(__name__)
 
+FANOUT_WORKERS = int(os.getenv('SPOTIFY_FANOUT_WORKERS', 16))
+FANOUT_TIMEOUT = float(os.getenv('SPOTIFY_FANOUT_TIMEOUT', 10))
+
+_executor = None
+_executor_lock = Lock()
+
+
+def _fanout_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=FANOUT_WORKERS,
+                thread_name_prefix='spotify-fanout',
+            )
+    return _executor
+
+
+ClientResult = namedtuple('ClientResult', ('client', 'result', 'error'))
+
+
+class FanOutResult(list):
+    """Per-client outcomes of a call made through a SpotifyClientProxy."""
+
+    @property
+    def results(self):
+        return [r.result for r in self if r.error is None]
+
+    @property
+    def errors(self):
+        return [r.error for r in self if r.error is not None]
+
 
 class SpotifyClientProxy:
 
-    def __init__(self, clients: List[Spotify]):
+    def __init__(
+        self,
+        clients: List['Spotify'],
+        concurrent: bool = True,
+        timeout: float = FANOUT_TIMEOUT,
+    ):
         self._clients = clients
+        self._concurrent = concurrent
+        self._timeout = timeout
 
     @property
     def single_client(self):
         return self._clients[-1]
 
+    def _call_sequential(self, name, *args, **kwargs):
+        outcomes = FanOutResult()
+        for client in self._clients:
+            try:
+                result = getattr(client, name)(*args, **kwargs)
+                outcomes.append(ClientResult(client, result, None))
+            except Exception as e:
+                outcomes.append(ClientResult(client, None, e))
+        return outcomes
+
+    def _call_concurrent(self, name, *args, **kwargs):
+        executor = _fanout_executor()
+        futures = [
+            executor.submit(getattr(client, name), *args, **kwargs)
+            for client in self._clients
+        ]
+        wait(futures, timeout=self._timeout)
+
+        outcomes = FanOutResult()
+        for client, future in zip(self._clients, futures):
+            if not future.done():
+                future.cancel()
+                error = FutureTimeoutError(
+                    f'{name} timed out after {self._timeout}s')
+                outcomes.append(ClientResult(client, None, error))
+            elif future.exception() is not None:
+                outcomes.append(
+                    ClientResult(client, None, future.exception()))
+            else:
+                outcomes.append(ClientResult(client, future.result(), None))
+        return outcomes
+
+    def sync_start_playback(self, **kwargs):
+        """Start playback on all clients so that they play in sync.
+
+        Returns a `spotigram.sync.SyncResult`, or None with a single client,
+        which is simply started.
+        """
+        if len(self._clients) == 1:
+            self.single_client.start_playback(**kwargs)
+            return None
+
+        result = sync_start_playback(
+            self._clients, _fanout_executor(), self._timeout, **kwargs)
+        for _, error in result.failed:
+            logger.warning(
+                f'Synchronized start failed for one client: {error}')
+        if not result.offsets_ms:
+            raise result.failed[0][1]
+        return result
+
     def __getattr__(self, name):
         if len(self._clients) > 1:
             def func(*args, **kwargs):
-                return [
-                    getattr(o, name)(*args, **kwargs)
-                    for o in self._clients
-                ]
+                call = (
+                    self._call_concurrent if self._concurrent
+                    else self._call_sequential
+                )
+                outcomes = call(name, *args, **kwargs)
+                for outcome in outcomes:
+                    if outcome.error is not None:
+                        logger.warning(
+                            f'{name} failed for one client: {outcome.error}')
+
+                # Only give up if no one in the chat could be reached.
+                if len(outcomes.errors) == len(outcomes):
+                    raise outcomes.errors[0]
+                return outcomes
             return func
         else:
             return getattr(self.single_client, name)
 
 
-def _spotify_decorator(multi_client=False):
+def _spotify_decorator(multi_client=False, prefetch=None):
 
     def decorator(func):
         @wraps(func)
         def returnfunction(bot, update, *args, **kwargs):
+            # spotipy and the token store are loaded on first use.
+            from spotipy.client import SpotifyException
+            from spotigram.authorization import get_clients_and_items
 
             chat_id = update.message.chat_id
-            clients, url = get_clients_or_auth_url(
-                chat_id)
+            clients, url, items = get_clients_and_items(
+                chat_id, (prefetch,) if prefetch else ())
+            if prefetch:
+                kwargs['prefetched'] = items.get(prefetch)
             if clients is None:
-                bot.send_message(
+                outbox(bot).send_message(
                     chat_id=chat_id,
                     text=f"[First, log in with your Spotify account]({url})",
                     parse_mode=telegram.ParseMode.MARKDOWN,
@@ -61,7 +180,13 @@ def _spotify_decorator(multi_client=False):
                     logger.info(f'Executing: {func.__name__}')
                     return func(client, bot, update, *args, **kwargs)
                 except SpotifyException as e:
-                    bot.send_message(chat_id=chat_id, text=e.msg)
+                    outbox(bot).send_message(
+                        chat_id=chat_id, text=e.msg)
+                except FutureTimeoutError:
+                    outbox(bot).send_message(
+                        chat_id=chat_id,
+                        text='Spotify did not respond in time.',
+                    )
 
         return returnfunction
     return decorator
@@ -69,3 +194,13 @@ def _spotify_decorator(multi_client=False):
 
 spotify_action = _spotify_decorator(multi_client=False)
 spotify_multi_action = _spotify_decorator(multi_client=True)
+
+
+def spotify_multi_action_with(prefix):
+    """`spotify_multi_action` that also passes the chat's hash under
+    `prefix` as `prefetched`.
+
+    The hash is read together with the tokens when the clients are not
+    cached; otherwise `prefetched` is None and the action reads it itself.
+    """
+    return _spotify_decorator(multi_client=True, prefetch=prefix)
@@ -1,5 +1,3 @@
-import multiprocessing
-
 import telegram
 from flask import (
     abort,
@@ -7,9 +5,15 @@ from flask import (
     jsonify,
     redirect,
     request,
+    Response,
 )
 
+from spotigram import metrics
 from spotigram.authorization import retrieve_token_info
+from spotigram.ingestion import ingestion_queue_from_env
+from spotigram.sender import outbox
+
+RETRY_AFTER_SECONDS = 1
 
 
 def user_link(user):
@@ -20,7 +24,7 @@ def _build_app_and_bot_for(bot_cls):
     app = Flask(__name__)
 
     bot = bot_cls.bot()
-    update_queue = multiprocessing.Queue()
+    update_queue = ingestion_queue_from_env(bot_cls.__name__)
 
     @app.route('/', methods=['POST'])
     def index():
@@ -38,7 +42,7 @@ def _build_app_and_bot_for(bot_cls):
         )
         if not token_info:
             abort(400, 'Request not valid. Try getting a new login link.')
-        bot.send_message(
+        outbox(bot).send_message(
             chat_id=context['chat_id'],
             text=f"User {user_link(context['user_id'])} logged in.",
             parse_mode=telegram.ParseMode.MARKDOWN,
@@ -46,10 +50,21 @@ def _build_app_and_bot_for(bot_cls):
         )
         return redirect("https://telegram.me/random_genre_bot", code=302)
 
+    @app.route('/metrics', methods=['GET'])
+    def metrics_endpoint():
+        data, content_type = metrics.render()
+        return Response(data, content_type=content_type)
+
+    @app.route('/queue', methods=['GET'])
+    def queue_stats():
+        return jsonify(update_queue.stats())
+
     @app.route('/hook/' + bot_cls.TOKEN, methods=['POST'])
     def webhook():
-        update = telegram.Update.de_json(request.get_json(force=True), bot)
-        update_queue.put(update)
+        # Updates are decoded by the dispatcher, so only the raw body is
+        # queued here. Telegram redelivers if we answer with an error.
+        if not update_queue.offer(request.get_data()):
+            return "Busy", 503, {'Retry-After': str(RETRY_AFTER_SECONDS)}
         return "OK"
 
     return app, bot, update_queue
@@ -4,16 +4,24 @@ from datetime import (
     datetime,
     timedelta,
 )
+from functools import lru_cache
 
-from spotipy import oauth2, Spotify
+from spotipy import oauth2
 from spotipy.oauth2 import is_token_expired
 
-from spotigram.store import get_store_from_env_for
+from spotigram.client_cache import ClientCache
+from spotigram.metrics import TOKEN_REFRESHES
+from spotigram.spotify_http import spotify_client
+from spotigram.store import (
+    get_store_from_env_for,
+    LazyStore,
+)
 
 CLIENT_ID = os.getenv('SPOTIPY_CLIENT_ID')
 CLIENT_SECRET = os.getenv('SPOTIPY_CLIENT_SECRET')
 
-CACHE = get_store_from_env_for('token')
+CACHE = LazyStore(get_store_from_env_for, 'token')
+CLIENTS = ClientCache()
 
 API_LOCATION = os.getenv('API_LOCATION', 'http://localhost:5000')
 REDIRECT_URI = f'{API_LOCATION}/callback'
@@ -45,6 +53,7 @@ def _encode_jwt(chat_id):
     ).decode('utf-8')
 
 
+@lru_cache(maxsize=None)
 def _no_cache_oauth():
     return oauth2.SpotifyOAuth(
         CLIENT_ID, CLIENT_SECRET, REDIRECT_URI,
@@ -53,14 +62,45 @@ def _no_cache_oauth():
 
 
 def _cache_token_info(chat_id, token_info):
-    client = Spotify(auth=token_info['access_token'])
+    client = spotify_client(token_info['access_token'])
     user_id = client.current_user()['id']
 
     CACHE.set(chat_id, user_id, token_info)
+    CLIENTS.invalidate(chat_id)
 
     return user_id
 
 
+def clear_token_info(chat_id, user_id=None):
+    CLIENTS.invalidate(chat_id, user_id)
+    return CACHE.clear(chat_id, user_id)
+
+
+def refresh_token_info(chat_id, user_id, token_info):
+    token_info = _no_cache_oauth().refresh_access_token(
+        token_info['refresh_token'])
+    CACHE.set(chat_id, user_id, token_info)
+    return token_info
+
+
+def _load_clients(chat_id, token_infos):
+    clients = []
+    refreshed = {}
+    for user_id, token_info in token_infos.items():
+        # Tokens are normally renewed ahead of time by the TokenRefresher,
+        # refreshing here is only the fallback.
+        if is_token_expired(token_info):
+            token_info = _no_cache_oauth().refresh_access_token(
+                token_info['refresh_token'])
+            TOKEN_REFRESHES.labels('inline', 'success').inc()
+            refreshed[user_id] = token_info
+        clients.append(CLIENTS.put(chat_id, user_id, token_info))
+
+    CACHE.set_many(chat_id, refreshed)
+    CLIENTS.set_members(chat_id, token_infos.keys())
+    return clients
+
+
 def retrieve_token_info(state, code):
 
     try:
@@ -78,31 +118,48 @@ def get_clients_or_auth_url(
     chat_id: str,
     force_reauth: bool = False
 ):
+    clients, auth_url, _ = get_clients_and_items(
+        chat_id, force_reauth=force_reauth)
+    return clients, auth_url
+
 
-    token_infos = CACHE.values_for(chat_id)
-    if not token_infos or force_reauth:
-        if token_infos:
-            CACHE.clear(chat_id)
-
-        sp_oauth = _no_cache_oauth()
-        state = _encode_jwt(chat_id)
-        auth_url = f'{sp_oauth.get_authorize_url()}&state={state}'
-        return None, auth_url
-    else:
-        non_expired_tokens = []
-        for token_info in token_infos:
-            if is_token_expired(token_info):
-                sp_oauth = _no_cache_oauth()
-                non_expired = sp_oauth.refresh_access_token(
-                    token_info['refresh_token'])
-                _cache_token_info(chat_id, non_expired)
-            else:
-                non_expired = token_info
-
-            non_expired_tokens.append(non_expired)
-
-        clients = [
-            Spotify(auth=token_info['access_token'])
-            for token_info in non_expired_tokens
-        ]
-        return clients, None
+def get_clients_and_items(
+    chat_id: str,
+    prefixes: tuple = (),
+    force_reauth: bool = False
+):
+    """Like `get_clients_or_auth_url`, also returning the hashes of the
+    chat under `prefixes` if they were read.
+
+    The hashes are only read when the tokens have to be loaded from Redis,
+    in the same round trip. When the clients come from the client cache,
+    the returned dict is empty.
+    """
+    clients = None if force_reauth else CLIENTS.clients_for(chat_id)
+    if clients:
+        return clients, None, {}
+
+    # Only one thread per chat loads and refreshes tokens, the others
+    # pick up its result from the client cache.
+    with CLIENTS.chat_lock(chat_id):
+        clients = None if force_reauth else CLIENTS.clients_for(chat_id)
+        if clients:
+            return clients, None, {}
+
+        if prefixes:
+            items = CACHE.items_for_prefixes(
+                chat_id, [CACHE.prefix, *prefixes])
+            token_infos = items.pop(CACHE.prefix)
+        else:
+            items = {}
+            token_infos = CACHE.items_for(chat_id)
+        if not token_infos or force_reauth:
+            if token_infos:
+                clear_token_info(chat_id)
+
+            sp_oauth = _no_cache_oauth()
+            state = _encode_jwt(chat_id)
+            auth_url = f'{sp_oauth.get_authorize_url()}&state={state}'
+            return None, auth_url, items
+
+        return _load_clients(chat_id, token_infos), None, items
@@ -0,0 +1,85 @@
+import os
+import time
+from collections import OrderedDict
+from threading import Lock
+
+from spotipy.oauth2 import is_token_expired
+
+from spotigram.spotify_http import spotify_client
+
+MAX_SIZE = int(os.getenv('SPOTIFY_CLIENT_CACHE_SIZE', 1024))
+MEMBERSHIP_TTL = float(os.getenv('SPOTIFY_CLIENT_CACHE_MEMBERSHIP_TTL', 30))
+LOCK_STRIPES = 64
+
+
+class ClientCache:
+    """Per-process LRU cache of live Spotify clients.
+
+    Entries are keyed by (chat_id, user_id) and dropped once their token
+    expires. Which users belong to a chat is remembered separately for
+    `membership_ttl` seconds, as logins arrive through the web process.
+    """
+
+    def __init__(self, maxsize=MAX_SIZE, membership_ttl=MEMBERSHIP_TTL):
+        self.maxsize = maxsize
+        self.membership_ttl = membership_ttl
+        self._entries = OrderedDict()
+        self._members = {}
+        self._lock = Lock()
+        self._chat_locks = [Lock() for _ in range(LOCK_STRIPES)]
+
+    def chat_lock(self, chat_id):
+        """Lock to hold while loading or refreshing tokens for a chat."""
+        return self._chat_locks[hash(str(chat_id)) % LOCK_STRIPES]
+
+    def clients_for(self, chat_id):
+        chat_id = str(chat_id)
+        with self._lock:
+            members = self._members.get(chat_id)
+            if not members:
+                return None
+            user_ids, loaded_at = members
+            if time.monotonic() - loaded_at > self.membership_ttl:
+                del self._members[chat_id]
+                return None
+
+            clients = []
+            for user_id in user_ids:
+                key = (chat_id, user_id)
+                entry = self._entries.get(key)
+                if entry is None:
+                    return None
+                client, token_info = entry
+                if is_token_expired(token_info):
+                    del self._entries[key]
+                    return None
+                self._entries.move_to_end(key)
+                clients.append(client)
+            return clients
+
+    def put(self, chat_id, user_id, token_info):
+        chat_id = str(chat_id)
+        client = spotify_client(token_info['access_token'])
+        with self._lock:
+            key = (chat_id, user_id)
+            self._entries[key] = (client, token_info)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                (old_chat_id, _), _ = self._entries.popitem(last=False)
+                self._members.pop(old_chat_id, None)
+        return client
+
+    def set_members(self, chat_id, user_ids):
+        with self._lock:
+            self._members[str(chat_id)] = (tuple(user_ids), time.monotonic())
+
+    def invalidate(self, chat_id, user_id=None):
+        chat_id = str(chat_id)
+        with self._lock:
+            self._members.pop(chat_id, None)
+            for key in list(self._entries):
+                if key[0] == chat_id and user_id in (None, key[1]):
+                    del self._entries[key]
+
+    def __len__(self):
+        return len(self._entries)
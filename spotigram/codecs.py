@@ -0,0 +1,81 @@
+"""Value encodings used by RedisStore."""
+import json
+import struct
+
+
+class JSONCodec:
+
+    @staticmethod
+    def dumps(value):
+        return json.dumps(value)
+
+    @staticmethod
+    def loads(data):
+        return json.loads(data)
+
+
+class TokenCodec:
+    """Compact, versioned binary encoding of Spotify `token_info` dicts.
+
+    A fixed header (version, expires_at, expires_in) is followed by the
+    length-prefixed string fields and, if present, a JSON object with any
+    other keys. `expires_at` can be read from the header alone. Values
+    written as JSON by earlier versions are still decoded.
+    """
+
+    VERSION = 1
+    HEADER = struct.Struct('<BQI')
+    LENGTH = struct.Struct('<H')
+    FIELDS = ('access_token', 'refresh_token', 'token_type', 'scope')
+    _NUMBERS = ('expires_at', 'expires_in')
+
+    @classmethod
+    def dumps(cls, value):
+        parts = [cls.HEADER.pack(
+            cls.VERSION,
+            int(value.get('expires_at') or 0),
+            int(value.get('expires_in') or 0),
+        )]
+        for field in cls.FIELDS:
+            data = (value.get(field) or '').encode('utf-8')
+            parts.append(cls.LENGTH.pack(len(data)))
+            parts.append(data)
+
+        extra = {
+            key: v for key, v in value.items()
+            if key not in cls.FIELDS and key not in cls._NUMBERS
+        }
+        if extra:
+            parts.append(json.dumps(extra).encode('utf-8'))
+        return b''.join(parts)
+
+    @staticmethod
+    def _is_legacy(data):
+        return data[:1] == b'{'
+
+    @classmethod
+    def loads(cls, data):
+        if cls._is_legacy(data):
+            return json.loads(data)
+
+        version, expires_at, expires_in = cls.HEADER.unpack_from(data)
+        if version != cls.VERSION:
+            raise ValueError(f'Unknown token encoding version {version}.')
+        value = {'expires_at': expires_at, 'expires_in': expires_in}
+
+        pos = cls.HEADER.size
+        for field in cls.FIELDS:
+            length, = cls.LENGTH.unpack_from(data, pos)
+            pos += cls.LENGTH.size
+            value[field] = data[pos:pos + length].decode('utf-8')
+            pos += length
+
+        if pos < len(data):
+            value.update(json.loads(data[pos:]))
+        return value
+
+    @classmethod
+    def expires_at(cls, data):
+        if cls._is_legacy(data):
+            return json.loads(data).get('expires_at')
+        return cls.HEADER.unpack_from(data)[1]
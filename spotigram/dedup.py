@@ -0,0 +1,117 @@
+"""Drop webhook updates Telegram delivers more than once.
+
+Telegram resends an update when the webhook answers slowly, and handling
+`/next` twice skips two tracks. Updates are recognized by `update_id`,
+read from the raw body without decoding the whole update.
+
+The local window remembers the last `size` ids in a ring buffer with a
+dict from each id to its newest slot for lookups. Updates may also be
+resent to another worker or node, which only a shared window in Redis can
+detect.
+"""
+import logging
+import re
+from array import array
+from threading import Lock
+
+from redis.exceptions import RedisError
+
+logger = logging.getLogger(__name__)
+
+_UPDATE_ID = re.compile(rb'"update_id"\s*:\s*(\d+)')
+
+
+def update_id_of(data: bytes):
+    match = _UPDATE_ID.search(data)
+    return int(match.group(1)) if match else None
+
+
+class UpdateWindow:
+    """The `size` most recently added update ids."""
+
+    def __init__(self, size):
+        if size < 1:
+            raise ValueError(f'Update window size must be positive: {size}.')
+        self.size = size
+        self._ring = array('q', bytes(8 * size))
+        self._ids = {}
+        self._pos = 0
+        self._filled = 0
+        self._lock = Lock()
+
+    def add(self, update_id):
+        """Add `update_id`, returning False if it is already present."""
+        with self._lock:
+            if update_id in self._ids:
+                return False
+            if self._filled == self.size:
+                evicted = self._ring[self._pos]
+                # A discarded and re-added id also has a newer slot.
+                if self._ids.get(evicted) == self._pos:
+                    del self._ids[evicted]
+            else:
+                self._filled += 1
+            self._ring[self._pos] = update_id
+            self._ids[update_id] = self._pos
+            self._pos = (self._pos + 1) % self.size
+            return True
+
+    def discard(self, update_id):
+        # The ring slot is reused as usual; only the lookup forgets it.
+        with self._lock:
+            self._ids.pop(update_id, None)
+
+    def __contains__(self, update_id):
+        return update_id in self._ids
+
+    def __len__(self):
+        return len(self._ids)
+
+
+class RedisUpdateWindow:
+    """Update ids seen by any worker within the last `ttl` seconds."""
+
+    def __init__(self, redis, ttl, prefix='update'):
+        self.redis = redis
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def _key(self, update_id):
+        return f'{self.prefix}:{update_id}'
+
+    def add(self, update_id):
+        try:
+            return bool(self.redis.set(
+                self._key(update_id), 1, nx=True, ex=self.ttl))
+        except RedisError:
+            # Rather handle a duplicate than lose an update.
+            logger.exception('Checking the shared update window failed.')
+            return True
+
+    def discard(self, update_id):
+        try:
+            self.redis.delete(self._key(update_id))
+        except RedisError:
+            logger.exception('Updating the shared update window failed.')
+
+
+class Deduplicator:
+    """Checks the local window first and the shared one, if any, second."""
+
+    def __init__(self, local, shared=None):
+        self.local = local
+        self.shared = shared
+
+    def add(self, update_id):
+        if not self.local.add(update_id):
+            return False
+        if self.shared is not None and not self.shared.add(update_id):
+            return False
+        return True
+
+    def discard(self, update_id):
+        """Forget an update that was not accepted, so its retry is not
+        taken for a duplicate."""
+        self.local.discard(update_id)
+        if self.shared is not None:
+            self.shared.discard(update_id)
@@ -0,0 +1,131 @@
+import logging
+import os
+import queue
+import time
+from threading import (
+    Lock,
+    Thread,
+)
+
+import telegram
+from telegram.ext import Dispatcher
+
+from spotigram.metrics import (
+    DISPATCHER_LANE_BUSY_SECONDS,
+    DISPATCHER_LANE_DEPTH,
+    DISPATCHER_LANE_UPDATES,
+    STARTUP_SECONDS,
+)
+
+logger = logging.getLogger(__name__)
+
+LANES = int(os.getenv('DISPATCHER_LANES', 4))
+LANE_QUEUE_SIZE = int(os.getenv('DISPATCHER_LANE_QUEUE_SIZE', 100))
+
+
+class _Lane(Thread):
+
+    def __init__(self, index, process, maxsize, on_processed=None):
+        super().__init__(name=f'dispatcher-lane-{index}', daemon=True)
+        self.queue = queue.Queue(maxsize=maxsize)
+        self._process = process
+        self._on_processed = on_processed
+        self._lock = Lock()
+        self.processed = 0
+        self.busy_seconds = 0.0
+        self._depth = DISPATCHER_LANE_DEPTH.labels(str(index))
+        self._updates = DISPATCHER_LANE_UPDATES.labels(str(index))
+        self._busy_seconds = DISPATCHER_LANE_BUSY_SECONDS.labels(str(index))
+
+    def put(self, update):
+        self.queue.put(update)
+        self._depth.set(self.queue.qsize())
+
+    def run(self):
+        while True:
+            update = self.queue.get()
+            self._depth.set(self.queue.qsize())
+            start = time.perf_counter()
+            try:
+                self._process(update)
+            except Exception:
+                logger.exception('Processing update failed.')
+            finally:
+                seconds = time.perf_counter() - start
+                self._updates.inc()
+                self._busy_seconds.inc(seconds)
+                with self._lock:
+                    self.processed += 1
+                    self.busy_seconds += seconds
+                if self._on_processed:
+                    self._on_processed(update)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'depth': self.queue.qsize(),
+                'processed': self.processed,
+                'busy_seconds': self.busy_seconds,
+            }
+
+
+class ShardedDispatcher(Dispatcher):
+    """Dispatcher that runs handlers on `lanes` threads, one lane per chat.
+
+    Updates are routed by `chat_id`, so updates of one chat are handled in
+    order while different chats run in parallel. Lane queues are bounded;
+    a full lane stops the dispatcher from taking more updates off its
+    queue, which in turn pushes back on the webhook.
+
+    With `started_at` (a `time.perf_counter()` value), the time until the
+    first update was handled is recorded as the `first_update` startup
+    phase. Queues with an `ack` method are told about each handled update.
+    """
+
+    def __init__(self, bot, update_queue, lanes=LANES,
+                 lane_queue_size=LANE_QUEUE_SIZE, started_at=None, **kwargs):
+        super().__init__(bot, update_queue, **kwargs)
+        self.started_at = started_at
+        self._first_update_lock = Lock()
+        self._first_update_seen = False
+        self.lanes = [
+            _Lane(index, super(ShardedDispatcher, self).process_update,
+                  lane_queue_size, on_processed=self._on_processed)
+            for index in range(lanes)
+        ]
+
+    def _on_processed(self, update):
+        ack = getattr(self.update_queue, 'ack', None)
+        if ack is not None:
+            ack(update)
+
+        if self._first_update_seen or self.started_at is None:
+            return
+        with self._first_update_lock:
+            if self._first_update_seen:
+                return
+            self._first_update_seen = True
+        seconds = time.perf_counter() - self.started_at
+        STARTUP_SECONDS.labels('first_update').set(seconds)
+        logger.info(f'Handled the first update {seconds:.2f}s after start.')
+
+    def start(self, *args, **kwargs):
+        # Lanes are started here rather than in __init__, as the dispatcher
+        # is usually created before forking into its own process.
+        for lane in self.lanes:
+            if not lane.is_alive():
+                lane.start()
+        super().start(*args, **kwargs)
+
+    @staticmethod
+    def _shard_key(update):
+        if isinstance(update, telegram.Update) and update.effective_chat:
+            return update.effective_chat.id
+        return getattr(update, 'update_id', 0)
+
+    def process_update(self, update):
+        lane = self.lanes[self._shard_key(update) % len(self.lanes)]
+        lane.put(update)
+
+    def stats(self):
+        return [lane.stats() for lane in self.lanes]
@@ -0,0 +1,639 @@
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import re
+import socket
+import time
+from collections import (
+    defaultdict,
+    deque,
+)
+from threading import (
+    Event,
+    Lock,
+    Thread,
+)
+
+import telegram
+from redis.exceptions import (
+    RedisError,
+    ResponseError,
+)
+
+from spotigram.dedup import (
+    Deduplicator,
+    RedisUpdateWindow,
+    update_id_of,
+    UpdateWindow,
+)
+from spotigram.metrics import (
+    UPDATE_STREAM_LAG,
+    UPDATE_STREAM_PENDING,
+    WEBHOOK_QUEUE_DEPTH,
+    WEBHOOK_UPDATES,
+)
+
+logger = logging.getLogger(__name__)
+
+QUEUE_BACKEND = os.getenv('UPDATE_QUEUE_BACKEND', 'memory')
+QUEUE_SIZE = int(os.getenv('UPDATE_QUEUE_SIZE', 1000))
+
+# Update ids remembered per worker to drop redelivered updates; 0 turns
+# deduplication off. UPDATE_DEDUP_REDIS=1 adds a window shared by all
+# workers, kept for UPDATE_DEDUP_TTL seconds.
+DEDUP_SIZE = int(os.getenv('UPDATE_DEDUP_SIZE', 4096))
+DEDUP_REDIS = os.getenv('UPDATE_DEDUP_REDIS', '') == '1'
+DEDUP_TTL = int(os.getenv('UPDATE_DEDUP_TTL', 600))
+
+STREAM = os.getenv('UPDATE_STREAM', 'spotigram-updates')
+STREAM_GROUP = os.getenv('UPDATE_STREAM_GROUP', 'dispatchers')
+STREAM_BATCH = int(os.getenv('UPDATE_STREAM_BATCH', 16))
+# Updates are split by chat into this many streams, each read by a single
+# dispatcher at a time. Changing it strands the entries left in the old
+# streams.
+STREAM_PARTITIONS = int(os.getenv('UPDATE_STREAM_PARTITIONS', 16))
+# A dispatcher that has not renewed its leases for this long is taken for
+# dead; its partitions and unacknowledged entries pass to the others.
+CLAIM_IDLE = float(os.getenv('UPDATE_STREAM_CLAIM_IDLE', 30))
+CLAIM_INTERVAL = float(os.getenv('UPDATE_STREAM_CLAIM_INTERVAL', 5))
+MAX_DELIVERIES = int(os.getenv('UPDATE_STREAM_MAX_DELIVERIES', 5))
+
+_CHAT_ID = re.compile(rb'"chat"\s*:\s*\{[^{}]*?"id"\s*:\s*(-?\d+)')
+
+# Adds an entry unless the stream already holds `maxsize` entries. Acked
+# entries are deleted, so the length is the backlog of the stream.
+_BOUNDED_XADD = """
+if redis.call('XLEN', KEYS[1]) >= tonumber(ARGV[1]) then
+    return false
+end
+return redis.call('XADD', KEYS[1], '*', 'update', ARGV[2])
+"""
+
+# Extends, respectively deletes, a lease if it is still held by ARGV[1].
+_RENEW_LEASE = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+_RELEASE_LEASE = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+def partition_of(data: bytes, partitions):
+    """The partition of a raw update, by chat and else by update id."""
+    match = _CHAT_ID.search(data)
+    if match:
+        return int(match.group(1)) % partitions
+    return (update_id_of(data) or 0) % partitions
+
+
+def partition_streams(stream, partitions):
+    return [f'{stream}:{partition}' for partition in range(partitions)]
+
+
+def _decode_update(data, bot):
+    try:
+        return telegram.Update.de_json(json.loads(data.decode('utf-8')), bot)
+    except ValueError:
+        logger.warning('Dropping undecodable update.')
+        return None
+
+
+class IngestionQueue:
+    """Bounded queue of raw webhook payloads.
+
+    The web worker only enqueues the request body; decoding into
+    `telegram.Update` happens in the dispatcher process through
+    `DecodingQueue`. `offer` never blocks and reports a full queue, so the
+    webhook can ask Telegram to retry later. With a `dedup` window, updates
+    already offered are dropped but reported as accepted.
+    """
+
+    def __init__(self, maxsize=QUEUE_SIZE, dedup=None):
+        self._queue = multiprocessing.Queue(maxsize=maxsize)
+        self._init_stats(maxsize, dedup)
+
+    def _init_stats(self, maxsize, dedup):
+        self.maxsize = maxsize
+        self.dedup = dedup
+        self._lock = Lock()
+        self.enqueued = 0
+        self.dropped = 0
+        self.duplicates = 0
+        self.enqueue_seconds = 0.0
+        self.max_enqueue_seconds = 0.0
+
+    def _put(self, data):
+        self._queue.put_nowait(data)
+
+    def offer(self, data: bytes):
+        start = time.perf_counter()
+        update_id = update_id_of(data) if self.dedup else None
+        if update_id is not None and not self.dedup.add(update_id):
+            WEBHOOK_UPDATES.labels('duplicate').inc()
+            with self._lock:
+                self.duplicates += 1
+            return True
+
+        try:
+            self._put(data)
+        except queue.Full:
+            if update_id is not None:
+                self.dedup.discard(update_id)
+            WEBHOOK_UPDATES.labels('dropped').inc()
+            with self._lock:
+                self.dropped += 1
+            return False
+
+        WEBHOOK_UPDATES.labels('enqueued').inc()
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.enqueued += 1
+            self.enqueue_seconds += elapsed
+            self.max_enqueue_seconds = max(self.max_enqueue_seconds, elapsed)
+        return True
+
+    def depth(self):
+        try:
+            return self._queue.qsize()
+        except NotImplementedError:
+            return None
+
+    def stats(self):
+        with self._lock:
+            return {
+                'depth': self.depth(),
+                'maxsize': self.maxsize,
+                'enqueued': self.enqueued,
+                'dropped': self.dropped,
+                'duplicates': self.duplicates,
+                'avg_enqueue_us': (
+                    self.enqueue_seconds / self.enqueued * 1e6
+                    if self.enqueued else 0.0
+                ),
+                'max_enqueue_us': self.max_enqueue_seconds * 1e6,
+            }
+
+    def decoding(self, bot):
+        return DecodingQueue(self._queue, bot)
+
+
+class DecodingQueue:
+    """Consumer side of an IngestionQueue, handing out `telegram.Update`s.
+
+    Implements the part of the queue interface `telegram.ext.Dispatcher`
+    uses.
+    """
+
+    def __init__(self, raw_queue, bot):
+        self._queue = raw_queue
+        self._bot = bot
+
+    def get(self, block=True, timeout=None):
+        while True:
+            try:
+                data = self._queue.get(block, timeout)
+            finally:
+                # Only the consuming side reports the depth, so the gauges
+                # of all dispatchers add up to the total backlog.
+                self._report_depth()
+            if not isinstance(data, bytes):
+                return data
+            update = _decode_update(data, self._bot)
+            if update is not None:
+                return update
+
+    def _report_depth(self):
+        try:
+            WEBHOOK_QUEUE_DEPTH.set(self._queue.qsize())
+        except NotImplementedError:
+            # sem_getvalue() is not implemented on macOS.
+            pass
+
+    def put(self, item, block=True, timeout=None):
+        self._queue.put(item, block, timeout)
+
+    def qsize(self):
+        return self._queue.qsize()
+
+
+class StreamIngestionQueue(IngestionQueue):
+    """IngestionQueue on Redis streams shared by all nodes.
+
+    Web workers `XADD` raw updates to one of `partitions` streams, chosen
+    by chat, each holding at most its share of `maxsize`. Dispatchers on
+    any node read them through the consumer group `group` and acknowledge
+    them once handled, so an update survives restarts and is delivered at
+    least once.
+    """
+
+    def __init__(self, redis, stream=STREAM, group=STREAM_GROUP,
+                 partitions=STREAM_PARTITIONS, maxsize=QUEUE_SIZE,
+                 dedup=None):
+        self.redis = redis
+        self.stream = stream
+        self.group = group
+        self.partitions = partitions
+        self.streams = partition_streams(stream, partitions)
+        self._xadd = redis.register_script(_BOUNDED_XADD)
+        self._init_stats(maxsize, dedup)
+
+    def _put(self, data):
+        stream = self.streams[partition_of(data, self.partitions)]
+        try:
+            entry_id = self._xadd(
+                keys=[stream],
+                args=[-(-self.maxsize // self.partitions), data])
+        except RedisError:
+            logger.exception('Adding an update to the stream failed.')
+            entry_id = None
+        if entry_id is None:
+            raise queue.Full
+
+    def depth(self):
+        try:
+            return sum(_stream_lengths(self.redis, self.streams))
+        except RedisError:
+            return None
+
+    def stats(self):
+        stats = super().stats()
+        stats.update(stream_stats(
+            self.redis, self.stream, self.group, self.partitions))
+        return stats
+
+    def decoding(self, bot):
+        return StreamDecodingQueue(
+            self.redis, self.stream, self.group, bot,
+            partitions=self.partitions)
+
+
+def _stream_lengths(redis, streams):
+    pipe = redis.pipeline(transaction=False)
+    for stream in streams:
+        pipe.xlen(stream)
+    return pipe.execute()
+
+
+def stream_stats(redis, stream, group, partitions=STREAM_PARTITIONS):
+    """Backlog of the streams: `lag` updates were not delivered yet and
+    `pending` were delivered but not acknowledged. `consumers` are the
+    live dispatchers."""
+    streams = partition_streams(stream, partitions)
+    pipe = redis.pipeline(transaction=False)
+    for name in streams:
+        pipe.xlen(name)
+        pipe.xpending(name, group)
+    pipe.zcount(f'{stream}:consumers', time.time() - CLAIM_IDLE, '+inf')
+    results = pipe.execute(raise_on_error=False)
+
+    lag = pending = 0
+    for length, partition_pending in zip(results[0::2], results[1::2]):
+        if isinstance(partition_pending, ResponseError):
+            # The group is created once a dispatcher reads the partition.
+            lag += length
+            continue
+        lag += length - partition_pending['pending']
+        pending += partition_pending['pending']
+    return {'lag': lag, 'pending': pending, 'consumers': results[-1]}
+
+
+class StreamDecodingQueue:
+    """Consumer side of a StreamIngestionQueue.
+
+    Each partition is read by the one dispatcher holding its lease, so the
+    updates of a chat are never handled by two dispatchers at once. Live
+    dispatchers register in a sorted set and split the partitions evenly;
+    a dispatcher hands a partition over once the updates it read from it
+    are acknowledged.
+
+    A heartbeat thread renews the leases every CLAIM_INTERVAL seconds and
+    resets the idle time of the entries being handled, so those are only
+    claimed by the next owner of the partition once this dispatcher
+    stopped for CLAIM_IDLE seconds. Entries delivered more than
+    MAX_DELIVERIES times are dropped. Call `ack` with each handled update.
+    """
+
+    def __init__(self, redis, stream, group, bot,
+                 partitions=STREAM_PARTITIONS, consumer=None,
+                 batch=STREAM_BATCH):
+        self.redis = redis
+        self.stream = stream
+        self.group = group
+        self.partitions = partitions
+        self.streams = partition_streams(stream, partitions)
+        self.consumer = consumer or f'{socket.gethostname()}-{os.getpid()}'
+        self.batch = batch
+        self._bot = bot
+        # XREADGROUP replies with str or bytes names, by redis-py version.
+        self._partition_of = {}
+        for partition, name in enumerate(self.streams):
+            self._partition_of[name] = partition
+            self._partition_of[name.encode('utf-8')] = partition
+        self._members_key = f'{stream}:consumers'
+        self._renew = redis.register_script(_RENEW_LEASE)
+        self._release = redis.register_script(_RELEASE_LEASE)
+        self._buffer = deque()
+        self._local = queue.Queue()
+
+        self._lock = Lock()
+        # Partitions read from, and those whose lease is held, which
+        # includes partitions being handed over.
+        self._owned = set()
+        self._held = set()
+        # Acquired partitions whose previous owner may have left entries.
+        self._recover = set()
+        # Entry ids read from each partition and not acknowledged yet.
+        self._pending = defaultdict(set)
+        self._entries = {}
+        self._groups = set()
+        self._next_claim = 0.0
+        self._heartbeat_pid = None
+        self._stopped = Event()
+
+    def _lease_key(self, partition):
+        return f'{self.streams[partition]}:owner'
+
+    def _ensure_group(self, partition):
+        if partition in self._groups:
+            return
+        try:
+            self.redis.xgroup_create(
+                self.streams[partition], self.group, id='0', mkstream=True)
+        except ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+        self._groups.add(partition)
+
+    def _start_heartbeat(self):
+        # Threads do not survive a fork, so every process starts its own.
+        pid = os.getpid()
+        if self._heartbeat_pid == pid:
+            return
+        self._heartbeat_pid = pid
+        self._beat()
+        Thread(
+            target=self._heartbeat, name='stream-heartbeat', daemon=True,
+        ).start()
+
+    def _heartbeat(self):
+        while not self._stopped.wait(CLAIM_INTERVAL):
+            try:
+                self._beat()
+            except RedisError:
+                logger.exception('Renewing the stream leases failed.')
+
+    def _target(self):
+        """The partitions this dispatcher should own."""
+        now = time.time()
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.zadd(self._members_key, {self.consumer: now})
+        pipe.zremrangebyscore(self._members_key, '-inf', now - CLAIM_IDLE)
+        pipe.zrange(self._members_key, 0, -1)
+        members = sorted(
+            member.decode('utf-8') for member in pipe.execute()[-1])
+        index = members.index(self.consumer)
+        return {
+            partition for partition in range(self.partitions)
+            if partition % len(members) == index
+        }
+
+    def _beat(self):
+        target = self._target()
+        lease_ms = int(CLAIM_IDLE * 1000)
+        with self._lock:
+            held = sorted(self._held)
+            pending = {
+                partition: list(self._pending[partition])
+                for partition in held if self._pending[partition]
+            }
+
+        # Reset the idle time of the entries being handled first, so they
+        # are idle for CLAIM_IDLE once the lease expires.
+        pipe = self.redis.pipeline(transaction=False)
+        for partition, entry_ids in pending.items():
+            pipe.xclaim(
+                self.streams[partition], self.group, self.consumer, 0,
+                entry_ids, justid=True)
+        for partition in held:
+            self._renew(
+                keys=[self._lease_key(partition)],
+                args=[self.consumer, lease_ms], client=pipe)
+        renewed = pipe.execute()[len(pending):]
+        lost = {
+            partition for partition, ok in zip(held, renewed) if not ok}
+        if lost:
+            logger.warning(f'Lost the leases of partitions {sorted(lost)}.')
+
+        acquired = set()
+        for partition in target.difference(held):
+            if self.redis.set(
+                self._lease_key(partition), self.consumer,
+                nx=True, px=lease_ms,
+            ):
+                self._ensure_group(partition)
+                acquired.add(partition)
+
+        with self._lock:
+            self._held = (self._held - lost) | acquired
+            self._owned = self._held & target
+            self._recover = (self._recover | acquired) & self._held
+            # Partitions handed over once their updates are acknowledged.
+            released = {
+                partition for partition in self._held - target
+                if not self._pending[partition]
+            }
+            self._held -= released
+        for partition in released:
+            self._release(
+                keys=[self._lease_key(partition)], args=[self.consumer])
+
+        stats = stream_stats(
+            self.redis, self.stream, self.group, self.partitions)
+        UPDATE_STREAM_LAG.set(stats['lag'])
+        UPDATE_STREAM_PENDING.set(stats['pending'])
+
+    def close(self):
+        """Stop the heartbeat and give up all partitions."""
+        self._stopped.set()
+        with self._lock:
+            held, self._held, self._owned = self._held, set(), set()
+        for partition in held:
+            self._release(
+                keys=[self._lease_key(partition)], args=[self.consumer])
+        self.redis.zrem(self._members_key, self.consumer)
+
+    def _claim(self, partition):
+        """Entries a previous owner of `partition` did not acknowledge."""
+        stream = self.streams[partition]
+        idle_ms = int(CLAIM_IDLE * 1000)
+        stuck, poisoned = [], []
+        for entry in self.redis.xpending_range(
+            stream, self.group, '-', '+', self.batch
+        ):
+            if (
+                entry['consumer'].decode('utf-8') == self.consumer
+                or entry['time_since_delivered'] < idle_ms
+            ):
+                continue
+            if entry['times_delivered'] >= MAX_DELIVERIES:
+                poisoned.append(entry['message_id'])
+            else:
+                stuck.append(entry['message_id'])
+
+        if poisoned:
+            logger.warning(
+                f'Dropping {len(poisoned)} updates that failed '
+                f'{MAX_DELIVERIES} times.')
+            self._ack_ids(partition, poisoned)
+        if not stuck:
+            return []
+        return [
+            (partition, entry_id, fields)
+            for entry_id, fields in self.redis.xclaim(
+                stream, self.group, self.consumer, idle_ms, stuck)
+        ]
+
+    def _read(self, block, timeout):
+        self._start_heartbeat()
+        with self._lock:
+            owned = sorted(self._owned)
+            if time.monotonic() >= self._next_claim:
+                self._next_claim = time.monotonic() + CLAIM_INTERVAL
+                claim = owned
+            else:
+                claim = sorted(self._recover.intersection(owned))
+            self._recover.difference_update(claim)
+
+        entries = []
+        for partition in claim:
+            entries.extend(self._claim(partition))
+        if entries or not owned:
+            if not entries and block:
+                # Wait for the heartbeat to hand out partitions.
+                self._stopped.wait(
+                    CLAIM_INTERVAL if timeout is None
+                    else min(timeout, CLAIM_INTERVAL))
+            return self._track(entries)
+
+        if not block:
+            block_ms = None
+        elif timeout is None:
+            block_ms = 0
+        else:
+            block_ms = max(1, int(timeout * 1000))
+        response = self.redis.xreadgroup(
+            self.group, self.consumer,
+            {self.streams[partition]: '>' for partition in owned},
+            count=self.batch, block=block_ms)
+        return self._track([
+            (self._partition_of[stream], entry_id, fields)
+            for stream, stream_entries in response or ()
+            for entry_id, fields in stream_entries
+        ])
+
+    def _track(self, entries):
+        with self._lock:
+            for partition, entry_id, _ in entries:
+                self._pending[partition].add(entry_id)
+        return entries
+
+    def _ack_ids(self, partition, entry_ids):
+        try:
+            stream = self.streams[partition]
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.xack(stream, self.group, *entry_ids)
+            pipe.xdel(stream, *entry_ids)
+            pipe.execute()
+        finally:
+            with self._lock:
+                self._pending[partition].difference_update(entry_ids)
+
+    def get(self, block=True, timeout=None):
+        try:
+            return self._local.get_nowait()
+        except queue.Empty:
+            pass
+
+        while True:
+            if not self._buffer:
+                try:
+                    self._buffer.extend(self._read(block, timeout))
+                except RedisError:
+                    logger.exception('Reading updates from the stream failed.')
+                    time.sleep(1)
+                if not self._buffer:
+                    raise queue.Empty
+
+            partition, entry_id, fields = self._buffer.popleft()
+            with self._lock:
+                if partition not in self._held:
+                    # The lease was lost; the new owner claims the entry.
+                    self._pending[partition].discard(entry_id)
+                    continue
+
+            # Claimed entries that were deleted meanwhile have no fields.
+            data = fields.get(b'update') if fields else None
+            update = _decode_update(data, self._bot) if data else None
+            if update is None:
+                self._ack_ids(partition, [entry_id])
+                continue
+
+            with self._lock:
+                self._entries[update.update_id] = (partition, entry_id)
+            return update
+
+    def ack(self, update):
+        with self._lock:
+            entry = self._entries.pop(
+                getattr(update, 'update_id', None), None)
+        if entry is not None:
+            try:
+                partition, entry_id = entry
+                self._ack_ids(partition, [entry_id])
+            except RedisError:
+                # Handled again by the next owner of the partition.
+                logger.exception('Acknowledging an update failed.')
+
+    def put(self, item, block=True, timeout=None):
+        self._local.put(item, block, timeout)
+
+    def qsize(self):
+        length = sum(_stream_lengths(self.redis, self.streams))
+        return length + self._local.qsize()
+
+
+def _dedup_from_env(namespace):
+    if DEDUP_SIZE < 0:
+        raise ValueError(
+            f'UPDATE_DEDUP_SIZE must be 0 (disabled) or more: {DEDUP_SIZE}.')
+    if not DEDUP_SIZE:
+        return None
+    shared = None
+    if DEDUP_REDIS:
+        from spotigram.store import coordination_redis
+        shared = RedisUpdateWindow(
+            coordination_redis(), DEDUP_TTL, prefix=f'update:{namespace}')
+    return Deduplicator(UpdateWindow(DEDUP_SIZE), shared)
+
+
+def ingestion_queue_from_env(namespace):
+    """The update queue configured in the environment.
+
+    `namespace` (usually the bot's name) separates the Redis keys of bots
+    sharing a Redis server, as their update ids overlap.
+    """
+    dedup = _dedup_from_env(namespace)
+    if QUEUE_BACKEND == 'stream':
+        from spotigram.store import coordination_redis
+        return StreamIngestionQueue(
+            coordination_redis(), stream=f'{STREAM}-{namespace}',
+            dedup=dedup)
+    return IngestionQueue(dedup=dedup)
@@ -0,0 +1,112 @@
+"""Turn Spotify links and URIs into playback arguments without API calls.
+
+Handles `spotify:` URIs and `open.spotify.com` links, including `intl-xx`
+path prefixes, `/embed/` and legacy `/user/<name>/playlist/` paths and
+query strings such as `?si=`. Only short links (`spotify.link`,
+`spotify.app.link`) need a network round trip, to follow their redirect;
+those are cached.
+"""
+import logging
+import os
+import re
+from collections import namedtuple
+from functools import lru_cache
+from urllib.parse import urlsplit
+
+logger = logging.getLogger(__name__)
+
+SHORT_LINK_CACHE_SIZE = int(os.getenv('SHORT_LINK_CACHE_SIZE', 4096))
+SHORT_LINK_TIMEOUT = float(os.getenv('SHORT_LINK_TIMEOUT', 5))
+
+# Played with `uris`; everything else is a context played with
+# `context_uri`.
+TRACK_KINDS = ('track', 'episode')
+CONTEXT_KINDS = ('album', 'playlist', 'artist', 'show')
+
+OPEN_HOST = 'open.spotify.com'
+SHORT_HOSTS = ('spotify.link', 'spotify.app.link')
+
+_ID = re.compile(r'^[0-9A-Za-z]{22}$')
+_IGNORED_SEGMENTS = re.compile(r'^(?:intl-[a-z]{2}(?:-[a-z]{2})?|embed)$')
+
+
+class SpotifyLink(namedtuple('SpotifyLink', ('kind', 'id'))):
+
+    __slots__ = ()
+
+    @property
+    def uri(self):
+        return f'spotify:{self.kind}:{self.id}'
+
+    @property
+    def is_context(self):
+        return self.kind in CONTEXT_KINDS
+
+    def playback_kwargs(self):
+        """Keyword arguments for `start_playback` playing this link."""
+        if self.is_context:
+            return {'context_uri': self.uri}
+        return {'uris': [self.uri]}
+
+
+def _from_segments(segments):
+    # Legacy playlist links carry the owner: user/<name>/playlist/<id>.
+    if len(segments) >= 4 and segments[0] == 'user':
+        segments = segments[2:]
+    if len(segments) < 2:
+        return None
+
+    kind, spotify_id = segments[0], segments[1]
+    if kind not in TRACK_KINDS + CONTEXT_KINDS or not _ID.match(spotify_id):
+        return None
+    return SpotifyLink(kind, spotify_id)
+
+
+def parse_uri(uri):
+    if not uri.startswith('spotify:'):
+        return None
+    return _from_segments(uri.split(':')[1:])
+
+
+def parse_url(url):
+    parts = urlsplit(url)
+    if parts.scheme not in ('http', 'https') or parts.netloc != OPEN_HOST:
+        return None
+    segments = [
+        segment for segment in parts.path.split('/')
+        if segment and not _IGNORED_SEGMENTS.match(segment)
+    ]
+    return _from_segments(segments)
+
+
+@lru_cache(maxsize=SHORT_LINK_CACHE_SIZE)
+def _resolve_short_link(url):
+    from requests import RequestException
+    from spotigram.spotify_http import session
+
+    try:
+        response = session().head(
+            url, allow_redirects=True, timeout=SHORT_LINK_TIMEOUT)
+    except RequestException:
+        logger.warning(f'Could not resolve {url}.')
+        # Raised rather than returned, so failures are not cached.
+        raise LookupError(url)
+    return parse_url(response.url)
+
+
+def resolve(text):
+    """The SpotifyLink for `text`, or None if it is not a Spotify link."""
+    text = text.strip()
+    if text.startswith('spotify:'):
+        return parse_uri(text)
+
+    parts = urlsplit(text)
+    if parts.netloc == OPEN_HOST:
+        return parse_url(text)
+    if parts.netloc in SHORT_HOSTS:
+        try:
+            return _resolve_short_link(
+                f'https://{parts.netloc}{parts.path}')
+        except LookupError:
+            return None
+    return None
@@ -0,0 +1,143 @@
+"""Prometheus metrics shared by the web workers and dispatcher processes.
+
+With `prometheus_multiproc_dir` set, prometheus_client runs in
+multiprocess mode: every process writes its samples to memory-mapped files
+in METRICS_DIR and `/metrics` merges them. gunicorn.conf.py sets it up and
+empties it when gunicorn starts, and marks exited workers dead. Without
+it, `/metrics` only reports the process serving the request.
+"""
+import os
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from prometheus_client import (
+    CollectorRegistry,
+    CONTENT_TYPE_LATEST,
+    Counter,
+    Gauge,
+    generate_latest,
+    Histogram,
+    multiprocess,
+    REGISTRY,
+)
+
+METRICS_DIR = os.getenv('prometheus_multiproc_dir')
+
+HANDLER_SECONDS = Histogram(
+    'spotigram_handler_seconds',
+    'Time spent in Telegram update handlers.',
+    ['handler'],
+)
+SPOTIFY_REQUESTS = Counter(
+    'spotigram_spotify_requests_total',
+    'Spotify Web API requests by endpoint and status.',
+    ['endpoint', 'status'],
+)
+REDIS_SECONDS = Histogram(
+    'spotigram_redis_seconds',
+    'Latency of store operations against Redis.',
+    ['operation'],
+    buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1),
+)
+STORE_CACHE_LOOKUPS = Counter(
+    'spotigram_store_cache_lookups_total',
+    'Store cache lookups by prefix and result (hit or miss).',
+    ['prefix', 'result'],
+)
+STORE_CACHE_INVALIDATIONS = Counter(
+    'spotigram_store_cache_invalidations_total',
+    'Cached chats dropped because they were written.',
+    ['prefix'],
+)
+TELEGRAM_SEND_SECONDS = Histogram(
+    'spotigram_telegram_send_seconds',
+    'Latency of outgoing Telegram API calls.',
+    ['method'],
+)
+WEBHOOK_QUEUE_DEPTH = Gauge(
+    'spotigram_webhook_queue_depth',
+    'Updates waiting in the ingestion queues.',
+    multiprocess_mode='livesum',
+)
+UPDATE_STREAM_LAG = Gauge(
+    'spotigram_update_stream_lag',
+    'Updates in the Redis stream not yet delivered to any dispatcher.',
+    multiprocess_mode='max',
+)
+UPDATE_STREAM_PENDING = Gauge(
+    'spotigram_update_stream_pending',
+    'Updates delivered to a dispatcher but not yet acknowledged.',
+    multiprocess_mode='max',
+)
+DISPATCHER_LANE_DEPTH = Gauge(
+    'spotigram_dispatcher_lane_depth',
+    'Updates waiting in a dispatcher lane.',
+    ['lane'],
+    multiprocess_mode='livesum',
+)
+DISPATCHER_LANE_UPDATES = Counter(
+    'spotigram_dispatcher_lane_updates_total',
+    'Updates handled by a dispatcher lane.',
+    ['lane'],
+)
+DISPATCHER_LANE_BUSY_SECONDS = Counter(
+    'spotigram_dispatcher_lane_busy_seconds_total',
+    'Time a dispatcher lane spent handling updates.',
+    ['lane'],
+)
+WEBHOOK_UPDATES = Counter(
+    'spotigram_webhook_updates_total',
+    'Webhook updates by outcome.',
+    ['outcome'],
+)
+STARTUP_SECONDS = Gauge(
+    'spotigram_startup_seconds',
+    'Seconds from creating the app until each startup phase completed.',
+    ['phase'],
+)
+TOKEN_REFRESHES = Counter(
+    'spotigram_token_refreshes_total',
+    'Spotify token refreshes by source and outcome.',
+    ['source', 'outcome'],
+)
+
+
+@contextmanager
+def timed(histogram, *labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.labels(*labels).observe(time.perf_counter() - start)
+
+
+def observed(histogram):
+    """Decorator recording the latency of a function, labeled by name."""
+    def decorator(func):
+        child = histogram.labels(func.__name__)
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                child.observe(time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def mark_process_dead(pid):
+    """Drop the live gauges of the exited process `pid`."""
+    if METRICS_DIR:
+        multiprocess.mark_process_dead(pid, METRICS_DIR)
+
+
+def render():
+    """Metrics of all processes in the Prometheus text format."""
+    if not METRICS_DIR:
+        return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
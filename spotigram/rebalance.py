@@ -0,0 +1,49 @@
+"""Move stored chats onto their shards after REDIS_URLS changed.
+
+    python -m spotigram.rebalance --old url1,url2,url3 --new url1,url2
+"""
+import argparse
+
+from spotigram.store import (
+    redis_for_url,
+    RedisBitset,
+    RedisStore,
+    ShardedRedisStore,
+    rebalance,
+    rebalance_bitsets,
+)
+
+PREFIXES = ('token', 'chat')
+BITSET_PREFIXES = ('history',)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--old', required=True, help='previous REDIS_URLS')
+    parser.add_argument('--new', required=True, help='new REDIS_URLS')
+    args = parser.parse_args()
+
+    old_urls = args.old.split(',')
+    new_urls = args.new.split(',')
+    all_urls = list(dict.fromkeys(old_urls + new_urls))
+
+    for prefix in PREFIXES:
+        target = ShardedRedisStore(
+            {url: redis_for_url(url) for url in new_urls}, prefix=prefix)
+        sources = [RedisStore(redis_for_url(url), prefix) for url in all_urls]
+        moved = rebalance(sources, target)
+        print(f'{prefix}: moved {moved} chats')
+
+    for prefix in BITSET_PREFIXES:
+        target = RedisBitset(
+            {url: redis_for_url(url) for url in new_urls}, prefix=prefix)
+        sources = [
+            RedisBitset({url: redis_for_url(url)}, prefix=prefix)
+            for url in all_urls
+        ]
+        moved = rebalance_bitsets(sources, target)
+        print(f'{prefix}: moved {moved} chats')
+
+
+if __name__ == '__main__':
+    main()
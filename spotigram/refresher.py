@@ -0,0 +1,137 @@
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from heapq import (
+    heappop,
+    heappush,
+)
+from random import random
+from threading import (
+    Event,
+    Lock,
+    Thread,
+)
+
+from redis.exceptions import LockError
+
+from spotigram.authorization import (
+    CACHE,
+    CLIENTS,
+    refresh_token_info,
+)
+from spotigram.metrics import TOKEN_REFRESHES
+
+logger = logging.getLogger(__name__)
+
+REFRESH_MARGIN = float(os.getenv('TOKEN_REFRESH_MARGIN', 300))
+REFRESH_JITTER = float(os.getenv('TOKEN_REFRESH_JITTER', 60))
+REFRESH_WORKERS = int(os.getenv('TOKEN_REFRESH_WORKERS', 4))
+RESCAN_INTERVAL = float(os.getenv('TOKEN_REFRESH_RESCAN_INTERVAL', 300))
+LOCK_TIMEOUT = 30
+SCAN_BATCH = 500
+
+
+class TokenRefresher(Thread):
+    """Refreshes stored tokens shortly before they expire.
+
+    All tokens in the `token` store are scanned every `rescan_interval`
+    seconds and queued by their `expires_at`, minus `margin` and a random
+    jitter. A Redis lock per token keeps several workers from refreshing
+    the same token.
+    """
+
+    def __init__(
+        self,
+        margin=REFRESH_MARGIN,
+        jitter=REFRESH_JITTER,
+        workers=REFRESH_WORKERS,
+        rescan_interval=RESCAN_INTERVAL,
+    ):
+        super().__init__(name='token-refresher', daemon=True)
+        self.margin = margin
+        self.jitter = jitter
+        self.rescan_interval = rescan_interval
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='token-refresh')
+        self._heap = []
+        self._heap_lock = Lock()
+        self._stopped = Event()
+
+    def schedule(self, chat_id, user_id, expires_at):
+        refresh_at = expires_at - self.margin - random() * self.jitter
+        with self._heap_lock:
+            heappush(self._heap, (refresh_at, str(chat_id), user_id))
+
+    def scan(self):
+        with self._heap_lock:
+            self._heap = []
+        chat_ids = CACHE.chat_ids()
+        for start in range(0, len(chat_ids), SCAN_BATCH):
+            batch = CACHE.expiries_for_many(
+                chat_ids[start:start + SCAN_BATCH])
+            for chat_id, expiries in batch.items():
+                for user_id, expires_at in expiries.items():
+                    self.schedule(chat_id, user_id, expires_at)
+
+    def _due(self, now):
+        with self._heap_lock:
+            while self._heap and self._heap[0][0] <= now:
+                _, chat_id, user_id = heappop(self._heap)
+                yield chat_id, user_id
+
+    def _next_due(self):
+        with self._heap_lock:
+            return self._heap[0][0] if self._heap else float('inf')
+
+    def refresh(self, chat_id, user_id):
+        lock = CACHE.lock(chat_id, user_id, timeout=LOCK_TIMEOUT)
+        if not lock.acquire(blocking=False):
+            return
+        try:
+            token_info = CACHE.get(chat_id, user_id)
+            if token_info is None:
+                return
+            # Scheduled up to `jitter` before the margin; a token with more
+            # time left was refreshed by someone else in the meantime.
+            remaining = token_info['expires_at'] - time.time()
+            if remaining <= self.margin + self.jitter:
+                token_info = refresh_token_info(chat_id, user_id, token_info)
+                CLIENTS.put(chat_id, user_id, token_info)
+                TOKEN_REFRESHES.labels('background', 'success').inc()
+            self.schedule(chat_id, user_id, token_info['expires_at'])
+        except Exception:
+            TOKEN_REFRESHES.labels('background', 'error').inc()
+            logger.exception(f'Refreshing token for {user_id} failed.')
+        finally:
+            try:
+                lock.release()
+            except LockError:
+                pass
+
+    def run(self):
+        next_scan = 0
+        while not self._stopped.is_set():
+            now = time.time()
+            if now >= next_scan:
+                try:
+                    self.scan()
+                except Exception:
+                    logger.exception('Scanning tokens failed.')
+                next_scan = now + self.rescan_interval
+
+            for chat_id, user_id in list(self._due(now)):
+                self._executor.submit(self.refresh, chat_id, user_id)
+
+            wait = min(self._next_due(), next_scan) - time.time()
+            self._stopped.wait(max(wait, 1))
+
+    def stop(self):
+        self._stopped.set()
+        self._executor.shutdown(wait=False)
+
+
+def start_token_refresher():
+    refresher = TokenRefresher()
+    refresher.start()
+    return refresher
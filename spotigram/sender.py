@@ -0,0 +1,430 @@
+"""Rate-limited, coalescing message sending.
+
+Telegram allows about 30 messages per second per bot and one per second
+per chat. The limits apply to the bot, not to a process: with gunicorn,
+each worker runs a web process and a dispatcher, all sending. `outbox`
+therefore keeps the token buckets and the last message of each chat in
+Redis (see `RedisLimits`), so the limits hold across processes and nodes
+and repeated messages coalesce wherever they are sent from.
+"""
+import json
+import logging
+import os
+import time
+from collections import (
+    deque,
+    namedtuple,
+)
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
+from threading import (
+    Condition,
+    Lock,
+    Thread,
+)
+
+import telegram
+from redis.exceptions import RedisError
+
+from spotigram.metrics import (
+    TELEGRAM_SEND_SECONDS,
+    timed,
+)
+
+logger = logging.getLogger(__name__)
+
+GLOBAL_RATE = float(os.getenv('TELEGRAM_GLOBAL_RATE', 30))
+CHAT_RATE = float(os.getenv('TELEGRAM_CHAT_RATE', 1))
+SEND_WORKERS = int(os.getenv('TELEGRAM_SEND_WORKERS', 4))
+COALESCE_WINDOW = float(os.getenv('TELEGRAM_COALESCE_WINDOW', 10))
+
+# Takes a token from the global bucket KEYS[1] and the chat bucket KEYS[2]
+# if both have one, using the server clock so all nodes agree. Returns the
+# microseconds to wait for each bucket, both 0 if the tokens were taken.
+_ACQUIRE = """
+redis.replicate_commands()
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1e6
+
+local function wait(key, rate, capacity)
+    local state = redis.call('HMGET', key, 'tokens', 'updated', 'blocked')
+    local tokens = tonumber(state[1]) or capacity
+    local updated = tonumber(state[2]) or now
+    local blocked = tonumber(state[3]) or 0
+    tokens = math.min(capacity, tokens + (now - updated) * rate)
+    if now < blocked then
+        return blocked - now, tokens
+    elseif tokens >= 1 then
+        return 0, tokens
+    end
+    return (1 - tokens) / rate, tokens
+end
+
+local function take(key, tokens, ttl)
+    redis.call('HMSET', key, 'tokens', tostring(tokens - 1),
+               'updated', tostring(now))
+    redis.call('PEXPIRE', key, ttl)
+end
+
+local global_rate, chat_rate = tonumber(ARGV[1]), tonumber(ARGV[2])
+local global_wait, global_tokens = wait(KEYS[1], global_rate, global_rate)
+local chat_wait, chat_tokens = wait(KEYS[2], chat_rate, 1)
+if global_wait > 0 or chat_wait > 0 then
+    return {math.ceil(global_wait * 1e6), math.ceil(chat_wait * 1e6)}
+end
+take(KEYS[1], global_tokens, math.ceil(1000 * ARGV[3]))
+take(KEYS[2], chat_tokens, math.ceil(1000 * ARGV[3]))
+return {0, 0}
+"""
+
+# Blocks the bucket KEYS[1] for ARGV[1] seconds from now.
+_BLOCK = """
+redis.replicate_commands()
+local time = redis.call('TIME')
+local until_ = tonumber(time[1]) + tonumber(time[2]) / 1e6 + tonumber(ARGV[1])
+local blocked = tonumber(redis.call('HGET', KEYS[1], 'blocked')) or 0
+if until_ > blocked then
+    redis.call('HSET', KEYS[1], 'blocked', tostring(until_))
+end
+redis.call('PEXPIRE', KEYS[1], math.ceil(1000 * (ARGV[1] + ARGV[2])))
+"""
+
+
+class TokenBucket:
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _fill(self, now):
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        """Seconds until a token is available, 0 if one is now."""
+        self._fill(now)
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._fill(now)
+        self.tokens -= 1
+
+    def block(self, now, seconds):
+        self.blocked_until = max(self.blocked_until, now + seconds)
+
+
+class _Message:
+
+    __slots__ = ('text', 'kwargs', 'coalesce', 'count')
+
+    def __init__(self, text, kwargs, coalesce):
+        self.text = text
+        self.kwargs = kwargs
+        self.coalesce = coalesce
+        self.count = 1
+
+    def merges_with(self, other):
+        return (
+            self.coalesce and other.coalesce
+            and self.text == other.text and self.kwargs == other.kwargs
+        )
+
+
+_Sent = namedtuple('_Sent', ('text', 'message_id', 'count'))
+
+
+class LocalLimits:
+    """Rate limits and last messages of this process only."""
+
+    def __init__(self, rate, chat_rate, coalesce_window):
+        self.chat_rate = chat_rate
+        self.coalesce_window = coalesce_window
+        self._global = TokenBucket(rate)
+        self._buckets = {}
+        self._last = {}
+        self._lock = Lock()
+
+    def acquire(self, chat_id):
+        """Take a token for `chat_id`, returning (0, 0), or the seconds
+        to wait for the global and the chat bucket."""
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(chat_id)
+            if bucket is None:
+                bucket = self._buckets[chat_id] = TokenBucket(
+                    self.chat_rate, capacity=1)
+            global_wait = self._global.wait_time(now)
+            chat_wait = bucket.wait_time(now)
+            if global_wait or chat_wait:
+                return global_wait, chat_wait
+            self._global.take(now)
+            bucket.take(now)
+            return 0.0, 0.0
+
+    def block(self, seconds):
+        with self._lock:
+            self._global.block(time.monotonic(), seconds)
+
+    def last(self, chat_id):
+        with self._lock:
+            entry = self._last.get(chat_id)
+            if entry is None or entry[1] < time.monotonic():
+                return None
+            return entry[0]
+
+    def set_last(self, chat_id, sent):
+        with self._lock:
+            if sent is None:
+                self._last.pop(chat_id, None)
+            else:
+                self._last[chat_id] = (
+                    sent, time.monotonic() + self.coalesce_window)
+
+    def forget(self, chat_id):
+        """Drop the state of a chat with nothing left to send."""
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(chat_id)
+            if bucket is not None and bucket.wait_time(now) == 0:
+                del self._buckets[chat_id]
+            entry = self._last.get(chat_id)
+            if entry is not None and entry[1] < now:
+                del self._last[chat_id]
+
+
+class RedisLimits:
+    """Rate limits and last messages shared through Redis.
+
+    If Redis fails, the limits of this process are used until it is back.
+    """
+
+    def __init__(self, redis, namespace, rate, chat_rate, coalesce_window):
+        self.redis = redis
+        self.prefix = f'sender:{namespace}'
+        self.rate = rate
+        self.chat_rate = chat_rate
+        self.coalesce_window = coalesce_window
+        self._acquire = redis.register_script(_ACQUIRE)
+        self._block = redis.register_script(_BLOCK)
+        self._fallback = LocalLimits(rate, chat_rate, coalesce_window)
+        # Idle buckets are full again after this long.
+        self._bucket_ttl = max(1.0, 1 / chat_rate)
+
+    def acquire(self, chat_id):
+        try:
+            global_us, chat_us = self._acquire(
+                keys=[f'{self.prefix}:global',
+                      f'{self.prefix}:chat:{chat_id}'],
+                args=[self.rate, self.chat_rate, self._bucket_ttl])
+        except RedisError:
+            logger.exception('Shared rate limits are unavailable.')
+            return self._fallback.acquire(chat_id)
+        return global_us / 1e6, chat_us / 1e6
+
+    def block(self, seconds):
+        try:
+            self._block(
+                keys=[f'{self.prefix}:global'],
+                args=[seconds, self._bucket_ttl])
+        except RedisError:
+            logger.exception('Shared rate limits are unavailable.')
+            self._fallback.block(seconds)
+
+    def _last_key(self, chat_id):
+        return f'{self.prefix}:last:{chat_id}'
+
+    def last(self, chat_id):
+        try:
+            data = self.redis.get(self._last_key(chat_id))
+        except RedisError:
+            logger.exception('Reading the last message failed.')
+            return self._fallback.last(chat_id)
+        return _Sent(*json.loads(data.decode('utf-8'))) if data else None
+
+    def set_last(self, chat_id, sent):
+        try:
+            if sent is None:
+                self.redis.delete(self._last_key(chat_id))
+            else:
+                self.redis.set(
+                    self._last_key(chat_id), json.dumps(sent),
+                    px=int(self.coalesce_window * 1000))
+        except RedisError:
+            logger.exception('Storing the last message failed.')
+            self._fallback.set_last(chat_id, sent)
+
+    def forget(self, chat_id):
+        self._fallback.forget(chat_id)
+
+
+class _Chat:
+
+    __slots__ = ('pending', 'in_flight', 'not_before')
+
+    def __init__(self):
+        self.pending = deque()
+        self.in_flight = False
+        self.not_before = 0.0
+
+
+def _label(text, count):
+    return f'{text} (x{count})' if count > 1 else text
+
+
+class MessageSender:
+    """Asynchronous, rate-limited replacement for `bot.send_message`.
+
+    Messages are queued per chat and sent by a background thread, obeying a
+    global and a per-chat token bucket and backing off on `RetryAfter`.
+    Identical messages sent with `coalesce=True` are merged while queued,
+    or edited into the previous message if it was sent within
+    `coalesce_window` seconds. The buckets and the previous messages are
+    kept by `limits`, by default only for this process.
+    """
+
+    def __init__(self, bot, rate=GLOBAL_RATE, chat_rate=CHAT_RATE,
+                 workers=SEND_WORKERS, coalesce_window=COALESCE_WINDOW,
+                 limits=None):
+        self.bot = bot
+        self.coalesce_window = coalesce_window
+        self.workers = workers
+        self.limits = limits or LocalLimits(rate, chat_rate, coalesce_window)
+        self._not_before = 0.0
+        self._chats = {}
+        self._cond = Condition()
+        self._pid = None
+        self._executor = None
+
+    def _ensure_started(self):
+        # Threads do not survive a fork, start them in the sending process.
+        if self._pid == os.getpid():
+            return
+        with self._cond:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix='telegram-send')
+            Thread(
+                target=self._schedule, name='telegram-sender', daemon=True
+            ).start()
+
+    def send_message(self, chat_id, text, coalesce=False, **kwargs):
+        self._ensure_started()
+        message = _Message(text, kwargs, coalesce)
+        with self._cond:
+            chat = self._chats.get(chat_id)
+            if chat is None:
+                chat = self._chats[chat_id] = _Chat()
+            if chat.pending and chat.pending[-1].merges_with(message):
+                chat.pending[-1].count += 1
+            else:
+                chat.pending.append(message)
+            self._cond.notify()
+
+    def _next_ready(self, now):
+        """Pick a chat that may send now and take its tokens, or return
+        the time to wait for one.
+
+        Waits the limits asked for are remembered, so chats are not asked
+        about again before they may send.
+        """
+        wait = None
+        for chat_id, chat in list(self._chats.items()):
+            if chat.in_flight:
+                continue
+            if not chat.pending:
+                del self._chats[chat_id]
+                self.limits.forget(chat_id)
+                continue
+
+            not_before = max(chat.not_before, self._not_before)
+            if not_before <= now:
+                global_wait, chat_wait = self.limits.acquire(chat_id)
+                if not global_wait and not chat_wait:
+                    return chat_id, None
+                self._not_before = now + global_wait
+                chat.not_before = now + chat_wait
+                not_before = now + max(global_wait, chat_wait)
+            chat_wait = not_before - now
+            wait = chat_wait if wait is None else min(wait, chat_wait)
+        return None, wait
+
+    def _schedule(self):
+        with self._cond:
+            while True:
+                chat_id, wait = self._next_ready(time.monotonic())
+                if chat_id is None:
+                    self._cond.wait(wait)
+                    continue
+
+                chat = self._chats[chat_id]
+                chat.in_flight = True
+                message = chat.pending.popleft()
+                self._executor.submit(self._deliver, chat_id, chat, message)
+
+    def _deliver(self, chat_id, chat, message):
+        try:
+            last = self.limits.last(chat_id) if message.coalesce else None
+            if last and last.text == message.text:
+                count = last.count + message.count
+                with timed(TELEGRAM_SEND_SECONDS, 'editMessageText'):
+                    self.bot.edit_message_text(
+                        text=_label(message.text, count),
+                        chat_id=chat_id,
+                        message_id=last.message_id,
+                        parse_mode=message.kwargs.get('parse_mode'),
+                        disable_web_page_preview=message.kwargs.get(
+                            'disable_web_page_preview'),
+                    )
+                self.limits.set_last(chat_id, last._replace(count=count))
+            else:
+                with timed(TELEGRAM_SEND_SECONDS, 'sendMessage'):
+                    sent = self.bot.send_message(
+                        chat_id=chat_id,
+                        text=_label(message.text, message.count),
+                        **message.kwargs
+                    )
+                # Any other message ends the run of coalesced ones.
+                self.limits.set_last(chat_id, (
+                    _Sent(message.text, sent.message_id, message.count)
+                    if message.coalesce else None
+                ))
+        except telegram.error.RetryAfter as e:
+            self.limits.block(e.retry_after)
+            with self._cond:
+                chat.pending.appendleft(message)
+        except telegram.error.TelegramError:
+            logger.exception(f'Sending message to {chat_id} failed.')
+        finally:
+            with self._cond:
+                chat.in_flight = False
+                self._cond.notify()
+
+
+_senders = {}
+
+
+def outbox(bot):
+    """The process-wide MessageSender for `bot`, with limits shared by
+    all processes through the coordination Redis."""
+    sender = _senders.get(bot.token)
+    if sender is None:
+        from spotigram.store import coordination_redis
+
+        # The token is a secret, so only its hash goes into the keys.
+        namespace = sha256(bot.token.encode('utf-8')).hexdigest()[:16]
+        limits = RedisLimits(
+            coordination_redis(), namespace, GLOBAL_RATE, CHAT_RATE,
+            COALESCE_WINDOW)
+        sender = _senders.setdefault(
+            bot.token, MessageSender(bot, limits=limits))
+    return sender
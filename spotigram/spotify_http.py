@@ -0,0 +1,161 @@
+import logging
+import os
+import re
+import time
+from threading import Lock
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from spotipy import Spotify, SpotifyException
+
+from spotigram.metrics import SPOTIFY_REQUESTS
+
+logger = logging.getLogger(__name__)
+
+POOL_SIZE = int(os.getenv('SPOTIFY_POOL_SIZE', 32))
+MAX_RETRIES = int(os.getenv('SPOTIFY_MAX_RETRIES', 3))
+MAX_RETRY_AFTER = float(os.getenv('SPOTIFY_MAX_RETRY_AFTER', 10))
+BREAKER_THRESHOLD = int(os.getenv('SPOTIFY_BREAKER_THRESHOLD', 5))
+BREAKER_COOLDOWN = float(os.getenv('SPOTIFY_BREAKER_COOLDOWN', 30))
+API_URL = os.getenv('SPOTIFY_API_URL')
+
+_ID_SEGMENT = re.compile(r'/(?:[0-9A-Za-z]{22}|\d+)(?=/|$)')
+
+
+def endpoint_of(method, url):
+    """`GET /v1/tracks/{id}` style name of the endpoint `url` belongs to."""
+    return f'{method.upper()} {_ID_SEGMENT.sub("/{id}", urlsplit(url).path)}'
+
+
+class CircuitBreaker:
+    """Fails fast after `threshold` consecutive server errors.
+
+    After `cooldown` seconds a single trial request is let through; it
+    closes the breaker again if it succeeds.
+    """
+
+    def __init__(self, threshold=BREAKER_THRESHOLD, cooldown=BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self._lock = Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.cooldown:
+                # Half open: let this request through, keep others out.
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+    def record(self, success):
+        with self._lock:
+            if success:
+                self.failures = 0
+                self.opened_at = None
+            else:
+                self.failures += 1
+                if self.failures >= self.threshold:
+                    self.opened_at = time.monotonic()
+
+
+class SpotifySession(requests.Session):
+    """Shared session for all Spotify clients of a process.
+
+    Keeps a bounded pool of keep-alive connections, retries 429 responses
+    after their `Retry-After` and guards each endpoint with a
+    CircuitBreaker.
+    """
+
+    def __init__(self, pool_size=POOL_SIZE, max_retries=MAX_RETRIES,
+                 breaker_threshold=BREAKER_THRESHOLD,
+                 breaker_cooldown=BREAKER_COOLDOWN):
+        super().__init__()
+        self.max_retries = max_retries
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+        self._breakers = {}
+        self._breakers_lock = Lock()
+
+    def breaker(self, endpoint):
+        with self._breakers_lock:
+            breaker = self._breakers.get(endpoint)
+            if breaker is None:
+                breaker = self._breakers[endpoint] = CircuitBreaker(
+                    self.breaker_threshold, self.breaker_cooldown)
+            return breaker
+
+    def request(self, method, url, *args, **kwargs):
+        endpoint = endpoint_of(method, url)
+        breaker = self.breaker(endpoint)
+        if not breaker.allow():
+            SPOTIFY_REQUESTS.labels(endpoint, 'circuit_open').inc()
+            raise SpotifyException(
+                503, -1, f'{endpoint} is unavailable, try again later.')
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = super().request(method, url, *args, **kwargs)
+            except requests.exceptions.RequestException:
+                SPOTIFY_REQUESTS.labels(endpoint, 'error').inc()
+                breaker.record(success=False)
+                raise
+            SPOTIFY_REQUESTS.labels(endpoint, str(response.status_code)).inc()
+
+            if response.status_code != 429 or attempt == self.max_retries:
+                break
+            retry_after = float(response.headers.get('Retry-After', 1))
+            if retry_after > MAX_RETRY_AFTER:
+                break
+            logger.info(f'{endpoint} rate limited, retrying in {retry_after}s')
+            time.sleep(retry_after)
+
+        breaker.record(success=response.status_code < 500)
+        return response
+
+
+class SpotifyClient(Spotify):
+    """Spotify client with the Web API parameters spotipy does not take."""
+
+    def start_playback_at(self, position_ms, context_uri=None, uris=None,
+                          offset=None):
+        """Like `start_playback`, but `position_ms` into the first track."""
+        payload = {'position_ms': position_ms}
+        if context_uri is not None:
+            payload['context_uri'] = context_uri
+        if uris is not None:
+            payload['uris'] = uris
+        if offset is not None:
+            payload['offset'] = offset
+        return self._put('me/player/play', payload=payload)
+
+
+_session = None
+_session_pid = None
+_session_lock = Lock()
+
+
+def session():
+    """The SpotifySession of the current process."""
+    global _session, _session_pid
+    with _session_lock:
+        # Connections must not be shared with a forked parent.
+        if _session_pid != os.getpid():
+            _session = SpotifySession()
+            _session_pid = os.getpid()
+        return _session
+
+
+def spotify_client(access_token):
+    client = SpotifyClient(auth=access_token, requests_session=session())
+    if API_URL:
+        client.prefix = API_URL
+    return client
@@ -1,7 +1,10 @@
+import atexit
+import logging
 import os
 import multiprocessing
+import signal
 import time
-from random import random
+from threading import Thread
 
 import telegram
 from telegram.ext import (
@@ -10,13 +13,23 @@ from telegram.ext import (
 )
 
 from spotigram import spotify_multi_action
-from spotigram.app import _build_app_and_bot_for, user_link
-from spotigram.authorization import (
-    CACHE,
-    get_clients_or_auth_url,
+from spotigram.metrics import (
+    HANDLER_SECONDS,
+    mark_process_dead,
+    observed,
+    STARTUP_SECONDS,
 )
+from spotigram.sender import outbox
+
+# Flask, spotipy, jwt and Redis are imported where they are first needed,
+# so importing a bot module stays cheap and free of side effects. See
+# `python -m spotigram.startup`.
+
+logger = logging.getLogger(__name__)
 
 API_LOCATION = os.environ.get('API_LOCATION')
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL')
+DISPATCHER_STOP_TIMEOUT = float(os.getenv('DISPATCHER_STOP_TIMEOUT', 5))
 
 
 class classproperty(object):
@@ -27,6 +40,26 @@ class classproperty(object):
         return self.getter(owner)
 
 
+def _run_dispatcher(bot_cls, dispatcher):
+    # Forked from a gunicorn worker, whose handlers would only flag the
+    # worker copy as stopping.
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    bot_cls.start_background_tasks()
+    dispatcher.start()
+
+
+def _stop_dispatcher(process):
+    # Runs before multiprocessing's own exit handler, which would wait for
+    # the dispatcher forever.
+    process.terminate()
+    process.join(DISPATCHER_STOP_TIMEOUT)
+    if process.is_alive():
+        os.kill(process.pid, signal.SIGKILL)
+        process.join()
+    mark_process_dead(process.pid)
+
+
 class SpotigramBot:
 
     _TOKEN = None
@@ -45,10 +78,14 @@ class SpotigramBot:
 
     @classmethod
     def bot(cls):
+        if TELEGRAM_API_URL:
+            return telegram.Bot(cls.TOKEN, base_url=TELEGRAM_API_URL)
         return telegram.Bot(cls.TOKEN)
 
     @classmethod
     def run(cls):
+        from spotigram.app import _build_app_and_bot_for
+
         app, _, _ = _build_app_and_bot_for(cls)
 
         updater = Updater(token=cls.TOKEN)
@@ -59,38 +96,59 @@ class SpotigramBot:
         process = multiprocessing.Process(
             target=app.run)
         process.start()
+        cls.start_background_tasks()
         updater.start_polling()
 
     @classmethod
     def create_app(cls):
+        started_at = time.perf_counter()
+        from spotigram.app import _build_app_and_bot_for
+        from spotigram.dispatcher import ShardedDispatcher
+
         app, bot, update_queue = _build_app_and_bot_for(cls)
-        dispatcher = telegram.ext.Dispatcher(bot, update_queue)
+        dispatcher = ShardedDispatcher(
+            bot, update_queue.decoding(bot), started_at=started_at)
 
         for handler in cls.handlers():
             dispatcher.add_handler(handler)
 
         process = multiprocessing.Process(
-            target=dispatcher.start)
+            target=_run_dispatcher, args=(cls, dispatcher))
         process.start()
+        atexit.register(_stop_dispatcher, process)
 
-        # To avoid concurrent calls when starting multiple workers,
-        # retry with random jitter.
-        webhook_set = False
-        while not webhook_set:
-            try:
-                webhook_set = bot.set_webhook(
-                    f'{API_LOCATION}/hook/{cls.TOKEN}')
-            except telegram.error.RetryAfter as e:
-                time.sleep(e.retry_after + random() * 5)
+        # Registration must not hold up the worker: updates are queued as
+        # soon as the webhook route is served.
+        Thread(
+            target=cls.register_webhook, args=(bot, started_at),
+            name='webhook-registration', daemon=True,
+        ).start()
 
+        STARTUP_SECONDS.labels('app').set(time.perf_counter() - started_at)
         return app
 
+    @classmethod
+    def register_webhook(cls, bot, started_at):
+        from spotigram.store import coordination_redis
+        from spotigram.webhook import register_webhook
+
+        try:
+            register_webhook(
+                bot, f'{API_LOCATION}/hook/{cls.TOKEN}', coordination_redis())
+        except Exception:
+            logger.exception('Registering the webhook failed.')
+            return
+        STARTUP_SECONDS.labels('webhook').set(
+            time.perf_counter() - started_at)
+
     @staticmethod
     def force_authorization(bot, update):
+        from spotigram.authorization import get_clients_or_auth_url
+
         chat_id = update.message.chat_id
         _, auth_url = get_clients_or_auth_url(
             chat_id, force_reauth=True)
-        bot.send_message(
+        outbox(bot).send_message(
             chat_id=chat_id,
             text=f'[Log in with your Spotify account]({auth_url})',
             parse_mode=telegram.ParseMode.MARKDOWN,
@@ -99,12 +157,15 @@ class SpotigramBot:
 
     @staticmethod
     def list_users(bot, update):
+        from spotigram.app import user_link
+        from spotigram.authorization import CACHE
+
         chat_id = update.message.chat_id
         users_markdown = '\n'.join([
             user_link(user)
             for user in CACHE.keys_for(chat_id)
         ])
-        bot.send_message(
+        outbox(bot).send_message(
             chat_id=chat_id,
             text=(
                 f'Authenticated users:\n{users_markdown}'
@@ -117,11 +178,14 @@ class SpotigramBot:
 
     @staticmethod
     def logout(bot, update, args):
+        from spotigram.app import user_link
+        from spotigram.authorization import clear_token_info
+
         chat_id = update.message.chat_id
         try:
             user = args.pop(0)
-            logged_out = CACHE.clear(chat_id, user)
-            bot.send_message(
+            logged_out = clear_token_info(chat_id, user)
+            outbox(bot).send_message(
                 chat_id=chat_id,
                 text=(
                     f'User {user_link(user)} logged out.' if logged_out
@@ -131,44 +195,63 @@ class SpotigramBot:
                 disable_web_page_preview=True,
             )
         except IndexError:
-            bot.send_message(
+            outbox(bot).send_message(
                 chat_id=chat_id,
                 text='Which user should I log out?',
             )
 
     @staticmethod
     def logout_all(bot, update):
+        from spotigram.authorization import clear_token_info
+
         chat_id = update.message.chat_id
-        CACHE.clear(chat_id)
-        bot.send_message(chat_id=chat_id, text='Logged out all users.')
+        clear_token_info(chat_id)
+        outbox(bot).send_message(
+            chat_id=chat_id, text='Logged out all users.')
 
     @staticmethod
     @spotify_multi_action
     def pause(multi_client, bot, update):
         multi_client.pause_playback()
-        bot.send_message(
-            chat_id=update.message.chat_id, text='I paused your playback.')
+        outbox(bot).send_message(
+            chat_id=update.message.chat_id, text='I paused your playback.',
+            coalesce=True)
 
     @staticmethod
     @spotify_multi_action
     def play(multi_client, bot, update):
         multi_client.start_playback()
-        bot.send_message(
-            chat_id=update.message.chat_id, text='Playing...')
+        outbox(bot).send_message(
+            chat_id=update.message.chat_id, text='Playing...',
+            coalesce=True)
 
     @staticmethod
     @spotify_multi_action
     def next_track(multi_client, bot, update):
         multi_client.next_track()
-        bot.send_message(
-            chat_id=update.message.chat_id, text='Next song...')
+        outbox(bot).send_message(
+            chat_id=update.message.chat_id, text='Next song...',
+            coalesce=True)
 
     @classmethod
     def custom_handlers(cls):
         return []
 
+    @classmethod
+    def start_background_tasks(cls):
+        from spotigram.refresher import start_token_refresher
+
+        start_token_refresher()
+
     @classmethod
     def handlers(cls):
+        handlers = cls._handlers()
+        for handler in handlers:
+            handler.callback = observed(HANDLER_SECONDS)(handler.callback)
+        return handlers
+
+    @classmethod
+    def _handlers(cls):
         return (
             CommandHandler('login', cls.force_authorization),
             CommandHandler('users', cls.list_users),
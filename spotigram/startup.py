@@ -0,0 +1,135 @@
+"""Profile the startup of a bot: module import times and first-use init.
+
+    python -m spotigram.startup                     # RandomGenreBot
+    python -m spotigram.startup --bot listen_together --top 30
+
+Import times come from `python -X importtime` in a fresh interpreter;
+`self` is the time spent executing a module's own body, `cumulative`
+includes its imports. `-X importtime` needs Python 3.7; older versions
+only report the total import time of the bot module. The init steps then
+create the resources that are deferred until first use, such as the Redis
+stores, the genre catalog and the Flask app, and report the time and peak
+RSS after each one.
+"""
+import argparse
+import importlib
+import os
+import resource
+import subprocess
+import sys
+import time
+from collections import namedtuple
+
+BOTS = {
+    'random_genre': ('bots.random_genre_bot', 'RandomGenreBot'),
+    'listen_together': ('bots.listen_together_bot', 'ListenTogetherBot'),
+}
+
+ImportTime = namedtuple('ImportTime', ('module', 'self_us', 'cumulative_us'))
+
+
+_TIMED_IMPORT = '''
+import importlib, time
+start = time.perf_counter()
+importlib.import_module({module!r})
+print(int((time.perf_counter() - start) * 1e6))
+'''
+
+
+def import_times(module):
+    """Import times of `module` and everything it imports, in import order.
+
+    Before Python 3.7 only `module` itself is timed, without `self_us`.
+    """
+    if sys.version_info < (3, 7):
+        stdout = subprocess.run(
+            [sys.executable, '-c', _TIMED_IMPORT.format(module=module)],
+            stdout=subprocess.PIPE, check=True,
+        ).stdout.decode('utf-8')
+        cumulative_us = int(stdout.strip().splitlines()[-1])
+        return [ImportTime(module, None, cumulative_us)]
+
+    stderr = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        stderr=subprocess.PIPE, check=True,
+    ).stderr.decode('utf-8')
+
+    times = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        times.append(ImportTime(
+            name.strip(), int(self_us), int(cumulative_us)))
+    return times
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def init_steps(bot_module, bot_cls):
+    """Named callables creating the resources `bot_cls` defers."""
+    from spotigram.authorization import CACHE
+
+    steps = [('token store', lambda: CACHE.redis.ping())]
+    if hasattr(bot_module, 'CHAT_DATA'):
+        steps.append(('chat store', lambda: bot_module.CHAT_DATA.redis.ping()))
+    if hasattr(bot_module, 'HISTORY'):
+        steps.append(('history bitsets', lambda: bot_module.HISTORY.get(0)))
+    if bot_module.__name__ == 'bots.random_genre_bot':
+        import genres
+        steps.append(('genre catalog', genres.catalog))
+        steps.append(('genre search index', genres.search_index))
+
+    def build_app():
+        from spotigram.app import _build_app_and_bot_for
+        _build_app_and_bot_for(bot_cls)
+
+    steps.append(('flask app', build_app))
+    return steps
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--bot', choices=BOTS, default='random_genre')
+    parser.add_argument('--top', type=int, default=20)
+    args = parser.parse_args()
+
+    # Only needed to build the app; no request is made with it.
+    os.environ.setdefault('TELEGRAM_TOKEN', '123:startup-profile')
+
+    module_name, cls_name = BOTS[args.bot]
+    times = import_times(module_name)
+    total = next(t for t in times if t.module == module_name)
+    print(
+        f'Importing {module_name}: {total.cumulative_us / 1e3:.1f}ms, '
+        f'{len(times)} modules')
+    if total.self_us is None:
+        print('Per-module import times need Python 3.7 or later.')
+    else:
+        print(f'{"module":<48} {"self ms":>8} {"cumul. ms":>10}')
+        for t in sorted(times, key=lambda t: -t.self_us)[:args.top]:
+            print(
+                f'{t.module:<48} {t.self_us / 1e3:8.1f} '
+                f'{t.cumulative_us / 1e3:10.1f}')
+
+    def report(name, start):
+        print(
+            f'{name:<40} {(time.perf_counter() - start) * 1e3:8.1f}ms  '
+            f'peak RSS {_peak_rss_mb():6.1f}MB')
+
+    print()
+    start = time.perf_counter()
+    bot_module = importlib.import_module(module_name)
+    report(f'import {module_name}', start)
+
+    for name, step in init_steps(bot_module, getattr(bot_module, cls_name)):
+        start = time.perf_counter()
+        step()
+        report(f'init {name}', start)
+
+
+if __name__ == '__main__':
+    main()
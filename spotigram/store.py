@@ -1,16 +1,53 @@
-import json
+import logging
 import os
+import time
 from abc import (
     ABC,
     abstractmethod,
 )
+from bisect import bisect
+from collections import OrderedDict
+from hashlib import md5
+from functools import lru_cache
+from threading import Lock
 
 import redis
 import redislite
 
+from spotigram.codecs import (
+    JSONCodec,
+    TokenCodec,
+)
+from spotigram.metrics import (
+    observed,
+    REDIS_SECONDS,
+    STORE_CACHE_INVALIDATIONS,
+    STORE_CACHE_LOOKUPS,
+)
+
+logger = logging.getLogger(__name__)
+
+INVALIDATION_CHANNEL = 'store-invalidate'
+
+CACHE_ENABLED = os.getenv('STORE_CACHE', '') == '1'
+CACHE_SIZE = int(os.getenv('STORE_CACHE_SIZE', 4096))
+CACHE_TTLS = {
+    'token': float(os.getenv('STORE_CACHE_TTL_TOKEN', 60)),
+    'chat': float(os.getenv('STORE_CACHE_TTL_CHAT', 10)),
+}
+NEGATIVE_CACHE_TTL = float(os.getenv('STORE_CACHE_NEGATIVE_TTL', 5))
+
+CODECS = {
+    'token': TokenCodec,
+}
+
 
 class Store(ABC):
 
+    @abstractmethod
+    def chat_ids():
+        pass
+
     @abstractmethod
     def values_for(chat_id: str):
         pass
@@ -19,14 +56,34 @@ class Store(ABC):
     def keys_for(chat_id: str):
         pass
 
+    @abstractmethod
+    def items_for(chat_id: str):
+        pass
+
+    @abstractmethod
+    def items_for_many(chat_ids: list):
+        pass
+
+    @abstractmethod
+    def items_for_prefixes(chat_id: str, prefixes: list):
+        pass
+
     @abstractmethod
     def set(chat_id: str, user: str, value: dict):
         pass
 
+    @abstractmethod
+    def set_many(chat_id: str, values: dict):
+        pass
+
     @abstractmethod
     def get(chat_id: str, user: str):
         pass
 
+    @abstractmethod
+    def get_many(chat_id: str, users: list):
+        pass
+
     @abstractmethod
     def clear(chat_id: str, user: str = None):
         pass
@@ -34,40 +91,129 @@ class Store(ABC):
 
 class RedisStore(Store):
 
-    def __init__(self, redis_or_url, prefix):
+    def __init__(self, redis_or_url, prefix, codec=None):
         if isinstance(redis_or_url, redis.Redis):
             self.redis = redis_or_url
         elif isinstance(redis_or_url, str):
-            self.redis = redis.Redis.from_url(redis_or_url)
+            self.redis = redis_for_url(redis_or_url)
         else:
             raise RuntimeError(
                 f'{self.__class__} must be initialized with '
                 'str or redis client.')
 
         self.prefix = prefix
+        self.codec = codec or CODECS.get(prefix, JSONCodec)
 
-    def _key(self, chat_id):
-        return f'{self.prefix}-{chat_id}'
+    def _key(self, chat_id, prefix=None):
+        return f'{prefix or self.prefix}-{chat_id}'
 
+    def _decode_items(self, items, codec=None):
+        loads = (codec or self.codec).loads
+        return {
+            key.decode('utf-8'): loads(value)
+            for key, value in items.items()
+        }
+
+    @observed(REDIS_SECONDS)
+    def chat_ids(self):
+        offset = len(self._key(''))
+        return [
+            key.decode('utf-8')[offset:] for key
+            in self.redis.scan_iter(match=self._key('*'))
+        ]
+
+    def lock(self, chat_id: str, user_id: str, timeout: float):
+        # Lock keys must not match the `prefix-*` pattern of chat_ids.
+        return self.redis.lock(
+            f'lock:{self._key(chat_id)}-{user_id}', timeout=timeout)
+
+    @observed(REDIS_SECONDS)
     def values_for(self, chat_id: str):
         return [
-            json.loads(t)
+            self.codec.loads(t)
             for t in self.redis.hvals(self._key(chat_id))
         ]
 
+    @observed(REDIS_SECONDS)
     def keys_for(self, chat_id: str):
         return [
             key.decode('utf-8') for key
             in self.redis.hkeys(self._key(chat_id))
         ]
 
+    @observed(REDIS_SECONDS)
+    def items_for(self, chat_id: str):
+        return self._decode_items(self.redis.hgetall(self._key(chat_id)))
+
+    @observed(REDIS_SECONDS)
+    def items_for_many(self, chat_ids: list):
+        pipe = self.redis.pipeline(transaction=False)
+        for chat_id in chat_ids:
+            pipe.hgetall(self._key(chat_id))
+        return {
+            chat_id: self._decode_items(items)
+            for chat_id, items in zip(chat_ids, pipe.execute())
+        }
+
+    @observed(REDIS_SECONDS)
+    def items_for_prefixes(self, chat_id: str, prefixes: list):
+        """Read the hashes of `chat_id` under several prefixes at once.
+
+        Stores created by `get_store_from_env_for` share one connection,
+        so this also covers the data of the other stores.
+        """
+        pipe = self.redis.pipeline(transaction=False)
+        for prefix in prefixes:
+            pipe.hgetall(self._key(chat_id, prefix))
+        return {
+            prefix: self._decode_items(
+                items, CODECS.get(prefix, JSONCodec))
+            for prefix, items in zip(prefixes, pipe.execute())
+        }
+
+    @observed(REDIS_SECONDS)
+    def expiries_for_many(self, chat_ids: list):
+        """`expires_at` of every user, without decoding the tokens."""
+        pipe = self.redis.pipeline(transaction=False)
+        for chat_id in chat_ids:
+            pipe.hgetall(self._key(chat_id))
+        return {
+            chat_id: {
+                key.decode('utf-8'): self.codec.expires_at(value)
+                for key, value in items.items()
+            }
+            for chat_id, items in zip(chat_ids, pipe.execute())
+        }
+
+    @observed(REDIS_SECONDS)
     def set(self, chat_id: str, user_id: str, value: dict):
-        return self.redis.hset(self._key(chat_id), user_id, json.dumps(value))
+        return self.redis.hset(
+            self._key(chat_id), user_id, self.codec.dumps(value))
+
+    @observed(REDIS_SECONDS)
+    def set_many(self, chat_id: str, values: dict):
+        if not values:
+            return False
+        return self.redis.hmset(self._key(chat_id), {
+            user_id: self.codec.dumps(value)
+            for user_id, value in values.items()
+        })
 
+    @observed(REDIS_SECONDS)
     def get(self, chat_id: str, user_id: str):
         data = self.redis.hget(self._key(chat_id), user_id)
-        return json.loads(data) if data else None
+        return self.codec.loads(data) if data else None
 
+    @observed(REDIS_SECONDS)
+    def get_many(self, chat_id: str, user_ids: list):
+        if not user_ids:
+            return []
+        return [
+            self.codec.loads(data) if data else None
+            for data in self.redis.hmget(self._key(chat_id), user_ids)
+        ]
+
+    @observed(REDIS_SECONDS)
     def clear(self, chat_id: str, user: str = None):
         if user:
             return self.redis.hdel(self._key(chat_id), user)
@@ -75,9 +221,496 @@ class RedisStore(Store):
             return self.redis.delete(self._key(chat_id))
 
 
-def get_store_from_env_for(prefix):
+class HashRing:
+    """Consistent hash ring mapping keys onto named nodes.
+
+    Each node is placed on the ring `replicas` times, so adding or removing
+    a node only moves about 1/n of the keys.
+    """
+
+    def __init__(self, nodes, replicas=100):
+        self.nodes = list(nodes)
+        ring = sorted(
+            (self._hash(f'{node}#{replica}'), node)
+            for node in self.nodes
+            for replica in range(replicas)
+        )
+        self._hashes = [h for h, _ in ring]
+        self._nodes = [node for _, node in ring]
+
+    @staticmethod
+    def _hash(key):
+        return int.from_bytes(md5(key.encode('utf-8')).digest()[:8], 'big')
+
+    def node_for(self, key):
+        pos = bisect(self._hashes, self._hash(str(key)))
+        return self._nodes[pos % len(self._nodes)]
+
+
+class ShardedRedisStore(Store):
+    """RedisStore spread over several Redis nodes by consistent hashing.
+
+    `nodes` maps node names to a Redis client or URL; a list of URLs uses
+    the URLs as names. Shards are chosen by chat_id only, so the hashes of
+    one chat under different prefixes live on the same node.
+    """
+
+    def __init__(self, nodes, prefix, replicas=100):
+        if not isinstance(nodes, dict):
+            nodes = {url: url for url in nodes}
+        self.prefix = prefix
+        self.shards = {
+            name: RedisStore(redis_or_url, prefix)
+            for name, redis_or_url in nodes.items()
+        }
+        self.ring = HashRing(self.shards, replicas=replicas)
+
+    @property
+    def redis(self):
+        # Used for cluster-wide concerns such as pub/sub invalidation.
+        return self.shards[self.ring.nodes[0]].redis
+
+    def shard_for(self, chat_id):
+        return self.shards[self.ring.node_for(chat_id)]
+
+    def _group(self, chat_ids):
+        groups = {}
+        for chat_id in chat_ids:
+            groups.setdefault(self.ring.node_for(chat_id), []).append(chat_id)
+        return groups
+
+    def chat_ids(self):
+        return [
+            chat_id
+            for shard in self.shards.values()
+            for chat_id in shard.chat_ids()
+        ]
+
+    def lock(self, chat_id: str, user_id: str, timeout: float):
+        return self.shard_for(chat_id).lock(chat_id, user_id, timeout)
+
+    def values_for(self, chat_id: str):
+        return self.shard_for(chat_id).values_for(chat_id)
+
+    def keys_for(self, chat_id: str):
+        return self.shard_for(chat_id).keys_for(chat_id)
+
+    def items_for(self, chat_id: str):
+        return self.shard_for(chat_id).items_for(chat_id)
+
+    def items_for_many(self, chat_ids: list):
+        # One pipeline per shard.
+        result = {}
+        for node, node_chat_ids in self._group(chat_ids).items():
+            result.update(self.shards[node].items_for_many(node_chat_ids))
+        return result
+
+    def items_for_prefixes(self, chat_id: str, prefixes: list):
+        return self.shard_for(chat_id).items_for_prefixes(chat_id, prefixes)
+
+    def expiries_for_many(self, chat_ids: list):
+        result = {}
+        for node, node_chat_ids in self._group(chat_ids).items():
+            result.update(
+                self.shards[node].expiries_for_many(node_chat_ids))
+        return result
+
+    def set(self, chat_id: str, user_id: str, value: dict):
+        return self.shard_for(chat_id).set(chat_id, user_id, value)
+
+    def set_many(self, chat_id: str, values: dict):
+        return self.shard_for(chat_id).set_many(chat_id, values)
+
+    def get(self, chat_id: str, user_id: str):
+        return self.shard_for(chat_id).get(chat_id, user_id)
+
+    def get_many(self, chat_id: str, user_ids: list):
+        return self.shard_for(chat_id).get_many(chat_id, user_ids)
+
+    def clear(self, chat_id: str, user: str = None):
+        return self.shard_for(chat_id).clear(chat_id, user)
+
+
+class RedisBitset:
+    """Per-chat bitsets, one Redis string per chat.
+
+    Bits are numbered the way SETBIT numbers them, most significant bit of
+    the first byte first. `nodes` maps node names to Redis clients; chats
+    are placed on them like in ShardedRedisStore.
+    """
+
+    def __init__(self, nodes, prefix, replicas=100):
+        self.prefix = prefix
+        self.nodes = nodes
+        self.ring = HashRing(nodes, replicas=replicas)
+
+    def _key(self, chat_id):
+        return f'{self.prefix}-{chat_id}'
+
+    def _redis(self, chat_id):
+        return self.nodes[self.ring.node_for(chat_id)]
+
+    def _group(self, chat_ids):
+        groups = {}
+        for chat_id in chat_ids:
+            groups.setdefault(self.ring.node_for(chat_id), []).append(chat_id)
+        return groups
+
+    def chat_ids(self):
+        offset = len(self._key(''))
+        return [
+            key.decode('utf-8')[offset:]
+            for redis_client in self.nodes.values()
+            for key in redis_client.scan_iter(match=self._key('*'))
+        ]
+
+    @observed(REDIS_SECONDS)
+    def get(self, chat_id: str):
+        return self._redis(chat_id).get(self._key(chat_id)) or b''
+
+    @observed(REDIS_SECONDS)
+    def get_many(self, chat_ids: list):
+        result = {}
+        for node, node_chat_ids in self._group(chat_ids).items():
+            values = self.nodes[node].mget(
+                [self._key(chat_id) for chat_id in node_chat_ids])
+            result.update(zip(node_chat_ids, (v or b'' for v in values)))
+        return result
+
+    @observed(REDIS_SECONDS)
+    def set_bits(self, chat_id: str, positions: list):
+        pipe = self._redis(chat_id).pipeline(transaction=False)
+        for position in positions:
+            pipe.setbit(self._key(chat_id), position, 1)
+        pipe.execute()
+
+    @observed(REDIS_SECONDS)
+    def merge_many(self, values: dict):
+        """Set the bits of each chat's bitset in `values` as well."""
+        for node, node_chat_ids in self._group(values).items():
+            pipe = self.nodes[node].pipeline(transaction=False)
+            for chat_id in node_chat_ids:
+                key = self._key(chat_id)
+                # Must not match the `prefix-*` pattern of chat_ids.
+                scratch = f'merge:{key}'
+                pipe.set(scratch, values[chat_id], ex=60)
+                pipe.bitop('OR', key, key, scratch)
+                pipe.delete(scratch)
+            pipe.execute()
+
+    @observed(REDIS_SECONDS)
+    def clear(self, chat_id: str):
+        return self._redis(chat_id).delete(self._key(chat_id))
+
+
+def _server_of(client):
+    # Clients for the same URL may be distinct objects, so shards are told
+    # apart by where they connect to.
+    kwargs = client.connection_pool.connection_kwargs
+    return (kwargs.get('host'), kwargs.get('port'), kwargs.get('path'),
+            kwargs.get('db', 0))
+
+
+def rebalance(sources, target, batch_size=500):
+    """Move the keys of `target`'s prefix onto the shards they belong to.
+
+    `sources` are all RedisStores that may hold keys, including nodes that
+    are being removed from `target`. Returns the number of moved keys.
+    """
+    moved = 0
+    for source in sources:
+        chat_ids = source.chat_ids()
+        server = _server_of(source.redis)
+        for start in range(0, len(chat_ids), batch_size):
+            batch = [
+                chat_id for chat_id in chat_ids[start:start + batch_size]
+                if _server_of(target.shard_for(chat_id).redis) != server
+            ]
+            if not batch:
+                continue
+            for chat_id, items in source.items_for_many(batch).items():
+                target.set_many(chat_id, items)
+            pipe = source.redis.pipeline(transaction=False)
+            for chat_id in batch:
+                pipe.delete(source._key(chat_id))
+            pipe.execute()
+            moved += len(batch)
+    return moved
+
+
+def rebalance_bitsets(sources, target, batch_size=500):
+    """`rebalance` for the RedisBitset `target`.
+
+    `sources` are RedisBitsets of one node each. Bits the target node
+    already has for a moved chat are kept.
+    """
+    moved = 0
+    for source in sources:
+        chat_ids = source.chat_ids()
+        for start in range(0, len(chat_ids), batch_size):
+            batch = [
+                chat_id for chat_id in chat_ids[start:start + batch_size]
+                if _server_of(target._redis(chat_id))
+                != _server_of(source._redis(chat_id))
+            ]
+            if not batch:
+                continue
+            target.merge_many(source.get_many(batch))
+            pipe = source._redis(batch[0]).pipeline(transaction=False)
+            for chat_id in batch:
+                pipe.delete(source._key(chat_id))
+            pipe.execute()
+            moved += len(batch)
+    return moved
+
+
+class CachedStore(Store):
+    """Read-through LRU cache in front of a RedisStore.
+
+    Whole chat hashes are cached for `ttl` seconds, empty ones for
+    `negative_ttl`. Writes drop the local entry and publish the chat on
+    INVALIDATION_CHANNEL so other processes drop theirs as well.
+
+    Every invalidation is numbered. A read only caches what it read if the
+    chat was not invalidated since the read started, so a slow read cannot
+    write data back that a concurrent write has made stale.
+    """
+
+    def __init__(self, store, ttl, negative_ttl=NEGATIVE_CACHE_TTL,
+                 maxsize=CACHE_SIZE):
+        self.store = store
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._hit_counter = STORE_CACHE_LOOKUPS.labels(store.prefix, 'hit')
+        self._miss_counter = STORE_CACHE_LOOKUPS.labels(store.prefix, 'miss')
+        self._invalidation_counter = STORE_CACHE_INVALIDATIONS.labels(
+            store.prefix)
+        self._entries = OrderedDict()
+        # The number of the last invalidation, and of the last one of each
+        # recently invalidated chat. Older chats are forgotten; for those
+        # the newest forgotten number is assumed.
+        self._generation = 0
+        self._invalidated = OrderedDict()
+        self._forgotten = 0
+        self._lock = Lock()
+        self._listener_lock = Lock()
+        self._listener_pid = None
+
+    def __getattr__(self, name):
+        return getattr(self.store, name)
+
+    @property
+    def prefix(self):
+        return self.store.prefix
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'size': len(self._entries)}
+
+    def _listen(self):
+        # Subscriber threads do not survive a fork, so every process
+        # starts its own on first use.
+        pid = os.getpid()
+        if self._listener_pid == pid:
+            return
+        with self._listener_lock:
+            if self._listener_pid == pid:
+                return
+            pubsub = self.store.redis.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(**{INVALIDATION_CHANNEL: self._on_invalidate})
+            pubsub.run_in_thread(sleep_time=1, daemon=True)
+            self._listener_pid = pid
+
+    def _on_invalidate(self, message):
+        prefix, _, chat_id = message['data'].decode('utf-8').partition(':')
+        if prefix == self.prefix:
+            self._drop(chat_id)
+
+    def _drop(self, chat_id):
+        key = str(chat_id)
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self._invalidation_counter.inc()
+            self._generation += 1
+            self._invalidated[key] = self._generation
+            self._invalidated.move_to_end(key)
+            while len(self._invalidated) > self.maxsize:
+                _, self._forgotten = self._invalidated.popitem(last=False)
+
+    def _invalidate(self, chat_id):
+        self._drop(chat_id)
+        try:
+            self.store.redis.publish(
+                INVALIDATION_CHANNEL, f'{self.prefix}:{chat_id}')
+        except redis.RedisError:
+            logger.exception('Publishing store invalidation failed.')
+
+    def _cached(self, chat_id):
+        """The cached items of `chat_id`, or None and the generation to
+        pass to `_remember` once they are read."""
+        key = str(chat_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                self._hit_counter.inc()
+                return entry[1], None
+            self.misses += 1
+            self._miss_counter.inc()
+            return None, self._generation
+
+    def _remember(self, chat_id, items, generation):
+        ttl = self.ttl if items else self.negative_ttl
+        key = str(chat_id)
+        with self._lock:
+            if self._invalidated.get(key, self._forgotten) > generation:
+                # Invalidated while being read; the items may be stale.
+                return
+            self._entries[key] = (time.monotonic() + ttl, items)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def chat_ids(self):
+        return self.store.chat_ids()
+
+    def items_for(self, chat_id: str):
+        self._listen()
+        items, generation = self._cached(chat_id)
+        if items is None:
+            items = self.store.items_for(chat_id)
+            self._remember(chat_id, items, generation)
+        return dict(items)
+
+    def items_for_many(self, chat_ids: list):
+        self._listen()
+        result = {}
+        missing = []
+        generation = None
+        for chat_id in chat_ids:
+            items, miss_generation = self._cached(chat_id)
+            if items is None:
+                missing.append(chat_id)
+                # The first miss is the oldest, so it covers them all.
+                if generation is None:
+                    generation = miss_generation
+            else:
+                result[chat_id] = dict(items)
+        for chat_id, items in self.store.items_for_many(missing).items():
+            self._remember(chat_id, items, generation)
+            result[chat_id] = dict(items)
+        return result
+
+    def items_for_prefixes(self, chat_id: str, prefixes: list):
+        with self._lock:
+            generation = self._generation
+        result = self.store.items_for_prefixes(chat_id, prefixes)
+        if self.prefix in result:
+            self._remember(chat_id, result[self.prefix], generation)
+        return result
+
+    def values_for(self, chat_id: str):
+        return list(self.items_for(chat_id).values())
+
+    def keys_for(self, chat_id: str):
+        return list(self.items_for(chat_id).keys())
+
+    def get(self, chat_id: str, user_id: str):
+        return self.items_for(chat_id).get(user_id)
+
+    def get_many(self, chat_id: str, user_ids: list):
+        items = self.items_for(chat_id)
+        return [items.get(user_id) for user_id in user_ids]
+
+    def set(self, chat_id: str, user_id: str, value: dict):
+        result = self.store.set(chat_id, user_id, value)
+        self._invalidate(chat_id)
+        return result
+
+    def set_many(self, chat_id: str, values: dict):
+        result = self.store.set_many(chat_id, values)
+        if values:
+            self._invalidate(chat_id)
+        return result
+
+    def clear(self, chat_id: str, user: str = None):
+        result = self.store.clear(chat_id, user)
+        self._invalidate(chat_id)
+        return result
+
+
+class LazyStore:
+    """Creates a store with `factory(*args)` on first use.
+
+    Lets modules define their stores at import time without connecting to
+    Redis, or starting redislite, before a store is actually used.
+    """
+
+    __slots__ = ('_factory', '_args', '_store', '_lock')
+
+    def __init__(self, factory, *args):
+        self._factory = factory
+        self._args = args
+        self._store = None
+        self._lock = Lock()
+
+    def _get(self):
+        if self._store is None:
+            with self._lock:
+                if self._store is None:
+                    self._store = self._factory(*self._args)
+        return self._store
+
+    def __getattr__(self, name):
+        return getattr(self._get(), name)
+
+
+@lru_cache(maxsize=None)
+def redis_for_url(url):
+    return redis.Redis.from_url(url)
+
+
+@lru_cache(maxsize=None)
+def _redis_from_env():
     url = os.getenv('REDIS_URL', None)
     if url:
-        return RedisStore(url, prefix=prefix)
+        return redis_for_url(url)
+    else:
+        return redislite.Redis(os.getenv('REDISLITE_PATH', '/tmp/redis.db'))
+
+
+def coordination_redis():
+    """Redis client for state shared by the whole deployment, like locks
+    that are not tied to a chat. With several nodes, this is the first."""
+    urls = os.getenv('REDIS_URLS', None)
+    if urls:
+        return redis_for_url(urls.split(',')[0])
+    return _redis_from_env()
+
+
+def get_store_from_env_for(prefix):
+    # All stores share their clients and therefore the connection pools.
+    urls = os.getenv('REDIS_URLS', None)
+    if urls:
+        store = ShardedRedisStore({
+            url: redis_for_url(url) for url in urls.split(',')
+        }, prefix=prefix)
+    else:
+        store = RedisStore(_redis_from_env(), prefix=prefix)
+    if CACHE_ENABLED:
+        return CachedStore(store, ttl=CACHE_TTLS.get(prefix, 10))
+    return store
+
+
+def get_bitset_from_env_for(prefix):
+    urls = os.getenv('REDIS_URLS', None)
+    if urls:
+        nodes = {url: redis_for_url(url) for url in urls.split(',')}
     else:
-        return RedisStore(redislite.Redis('/tmp/redis.db'), prefix=prefix)
+        nodes = {'default': _redis_from_env()}
+    return RedisBitset(nodes, prefix=prefix)
@@ -0,0 +1,146 @@
+"""Start playback on several Spotify clients so they play in sync.
+
+Each client's round-trip time is measured with `current_playback` probes.
+The `start_playback` requests are then sent so they should all reach
+Spotify at the same moment: clients with a slow connection are sent to
+first. A request sent later than planned, for example because the fan-out
+pool was busy, starts `position_ms` further into the track to make up for
+it. Afterwards every client is probed again to measure the skew that was
+actually achieved.
+
+The probes add four requests per listener, so ListenTogetherBot only
+starts playback this way with `SYNC_START=1`.
+"""
+import logging
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import (
+    TimeoutError as FutureTimeoutError,
+    wait,
+)
+
+logger = logging.getLogger(__name__)
+
+ENABLED = os.getenv('SYNC_START', '') == '1'
+PROBES = int(os.getenv('SYNC_PROBES', 3))
+TARGET_SKEW_MS = float(os.getenv('SYNC_TARGET_SKEW_MS', 50))
+# Extra time for the scheduler threads to wake up before the first send.
+LEAD = float(os.getenv('SYNC_LEAD', 0.02))
+
+
+class SyncResult(namedtuple('SyncResult', (
+    'skew_ms',
+    'target_skew_ms',
+    'rtts_ms',
+    'offsets_ms',
+    'failed',
+))):
+
+    __slots__ = ()
+
+    @property
+    def within_target(self):
+        return (
+            self.skew_ms is not None
+            and self.skew_ms <= self.target_skew_ms
+        )
+
+
+def measure_rtt(client, probes=PROBES):
+    """Smallest `current_playback` round-trip time of `client`, in seconds.
+
+    The minimum is the probe least affected by queueing along the way.
+    """
+    rtts = []
+    for _ in range(probes):
+        start = time.perf_counter()
+        client.current_playback()
+        rtts.append(time.perf_counter() - start)
+    return min(rtts)
+
+
+def playback_origin(client):
+    """Local time at which `client`'s current playback was at position 0."""
+    start = time.perf_counter()
+    playback = client.current_playback()
+    received = time.perf_counter()
+    if not playback or playback.get('progress_ms') is None:
+        return None
+    # Spotify reports the progress at about the middle of the round trip.
+    return (start + received) / 2 - playback['progress_ms'] / 1000
+
+
+def _collect(futures, timeout, name):
+    """Results of `futures` by client, and `(client, error)` failures."""
+    wait(futures.values(), timeout=timeout)
+    results, failed = {}, []
+    for client, future in futures.items():
+        if not future.done():
+            future.cancel()
+            failed.append((client, FutureTimeoutError(f'{name} timed out')))
+        elif future.exception() is not None:
+            failed.append((client, future.exception()))
+        else:
+            results[client] = future.result()
+    return results, failed
+
+
+def sync_start_playback(
+    clients,
+    executor,
+    timeout,
+    position_ms=0,
+    target_skew_ms=TARGET_SKEW_MS,
+    probes=PROBES,
+    **kwargs
+):
+    """Start playback on all `clients` at the same position.
+
+    Returns a SyncResult; `failed` holds the `(client, error)` pairs of
+    clients that could not be probed or started.
+    """
+    rtts, failed = _collect({
+        client: executor.submit(measure_rtt, client, probes)
+        for client in clients
+    }, timeout, 'current_playback')
+    if not rtts:
+        return SyncResult(None, target_skew_ms, {}, {}, failed)
+
+    one_way = {client: rtt / 2 for client, rtt in rtts.items()}
+    land_at = time.perf_counter() + max(one_way.values()) + LEAD
+
+    def start(client):
+        delay = land_at - one_way[client] - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        lateness = time.perf_counter() + one_way[client] - land_at
+        offset_ms = max(0, int(round(lateness * 1000)))
+        client.start_playback_at(position_ms + offset_ms, **kwargs)
+        return offset_ms
+
+    offsets_ms, start_failed = _collect({
+        client: executor.submit(start, client) for client in one_way
+    }, timeout, 'start_playback')
+    failed.extend(start_failed)
+
+    # Failed probes only make the reported skew less certain.
+    origins, _ = _collect({
+        client: executor.submit(playback_origin, client)
+        for client in offsets_ms
+    }, timeout, 'current_playback')
+    origins = [origin for origin in origins.values() if origin is not None]
+    skew_ms = (max(origins) - min(origins)) * 1000 if origins else None
+
+    result = SyncResult(
+        skew_ms,
+        target_skew_ms,
+        {client: rtt * 1000 for client, rtt in rtts.items()},
+        offsets_ms,
+        failed,
+    )
+    if not result.within_target:
+        logger.warning(
+            f'Synchronized start missed the target skew of '
+            f'{target_skew_ms}ms: {skew_ms}ms.')
+    return result
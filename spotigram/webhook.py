@@ -0,0 +1,90 @@
+"""Webhook registration shared by all workers of a deployment.
+
+Every gunicorn worker creates the app, but the webhook only needs to be
+set once. Workers take turns holding a Redis lock; the first compares the
+webhook Telegram has with the wanted URL and only calls `set_webhook` if
+they differ. The others wait for the lock and find the URL registered, or
+try themselves if the first one failed. The registered URL is remembered
+in Redis for CHECK_INTERVAL, so workers started in the meantime skip even
+the comparison.
+"""
+import logging
+import os
+import time
+from hashlib import sha256
+
+import telegram
+from redis.exceptions import LockError
+
+logger = logging.getLogger(__name__)
+
+LOCK_TIMEOUT = float(os.getenv('WEBHOOK_LOCK_TIMEOUT', 60))
+CHECK_INTERVAL = int(os.getenv('WEBHOOK_CHECK_INTERVAL', 3600))
+SET_ATTEMPTS = int(os.getenv('WEBHOOK_SET_ATTEMPTS', 5))
+RETRY_BACKOFF = float(os.getenv('WEBHOOK_RETRY_BACKOFF', 1))
+
+
+def _key(token):
+    # The token is a secret, so only its hash goes into the key.
+    return f'webhook:{sha256(token.encode("utf-8")).hexdigest()[:16]}'
+
+
+def _registered_url(redis, key):
+    url = redis.get(key)
+    return url.decode('utf-8') if url is not None else None
+
+
+def _set_webhook(bot, url):
+    """Call `set_webhook` until it succeeds, at most SET_ATTEMPTS times."""
+    for attempt in range(SET_ATTEMPTS):
+        delay = RETRY_BACKOFF * 2 ** attempt
+        try:
+            if bot.set_webhook(url):
+                return True
+            logger.warning('Telegram did not accept the webhook.')
+        except telegram.error.RetryAfter as e:
+            delay = e.retry_after
+        except telegram.error.TelegramError as e:
+            logger.warning(f'Setting the webhook failed: {e}')
+        if attempt < SET_ATTEMPTS - 1:
+            time.sleep(delay)
+    return False
+
+
+def register_webhook(bot, url, redis):
+    """Make `url` the webhook of `bot`, once across all workers.
+
+    Returns True if this call set the webhook, False if it was already set,
+    another worker set it or setting it failed.
+    """
+    key = _key(bot.token)
+    if _registered_url(redis, key) == url:
+        return False
+
+    lock = redis.lock(f'lock:{key}', timeout=LOCK_TIMEOUT)
+    if not lock.acquire(blocking_timeout=LOCK_TIMEOUT):
+        logger.warning('Timed out waiting for the webhook registration.')
+        return False
+
+    try:
+        if _registered_url(redis, key) == url:
+            return False
+
+        registered = False
+        if bot.get_webhook_info().url != url:
+            registered = _set_webhook(bot, url)
+            if not registered:
+                # Not remembered, so the next worker tries again.
+                logger.error(
+                    f'Could not set the webhook in {SET_ATTEMPTS} attempts.')
+                return False
+            logger.info('Registered webhook.')
+
+        redis.set(key, url, ex=CHECK_INTERVAL)
+        return registered
+    finally:
+        try:
+            lock.release()
+        except LockError:
+            # Expired while registering; the next worker checks again.
+            pass
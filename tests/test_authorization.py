@@ -0,0 +1,67 @@
+import time
+
+import pytest
+import redislite
+
+from spotigram import authorization
+from spotigram.client_cache import ClientCache
+from spotigram.store import RedisStore
+
+TOKEN = {
+    'access_token': 'access',
+    'refresh_token': 'refresh',
+    'expires_at': int(time.time()) + 3600,
+}
+
+
+@pytest.fixture
+def redis(tmp_path, monkeypatch):
+    server = redislite.Redis(str(tmp_path / 'redis.db'))
+    monkeypatch.setattr(authorization, 'CACHE', RedisStore(server, 'token'))
+    monkeypatch.setattr(authorization, 'CLIENTS', ClientCache())
+
+    # Every command and every pipeline takes one connection.
+    server.round_trips = 0
+    get_connection = server.connection_pool.get_connection
+
+    def counting(*args, **kwargs):
+        server.round_trips += 1
+        return get_connection(*args, **kwargs)
+
+    monkeypatch.setattr(server.connection_pool, 'get_connection', counting)
+    return server
+
+
+def test_chat_data_is_read_with_the_tokens(redis):
+    RedisStore(redis, 'token').set(1, 'user', TOKEN)
+    RedisStore(redis, 'chat').set(1, 'playlists', ['a', 'b'])
+    redis.round_trips = 0
+
+    clients, url, items = authorization.get_clients_and_items(1, ('chat',))
+
+    assert len(clients) == 1 and url is None
+    assert items == {'chat': {'playlists': ['a', 'b']}}
+    assert redis.round_trips == 1
+
+    # Cached clients need no Redis at all.
+    clients, url, items = authorization.get_clients_and_items(1, ('chat',))
+    assert len(clients) == 1 and items == {}
+    assert redis.round_trips == 1
+
+
+@pytest.fixture
+def oauth(monkeypatch):
+    monkeypatch.setattr(authorization, 'CLIENT_ID', 'client')
+    monkeypatch.setattr(authorization, 'CLIENT_SECRET', 'secret')
+    monkeypatch.setattr(authorization, 'SECRET_KEY', 'secret')
+    authorization._no_cache_oauth.cache_clear()
+    yield
+    authorization._no_cache_oauth.cache_clear()
+
+
+def test_auth_url_without_tokens(redis, oauth):
+    clients, url, items = authorization.get_clients_and_items(1, ('chat',))
+
+    assert clients is None
+    assert 'state=' in url
+    assert items == {'chat': {}}
@@ -0,0 +1,120 @@
+import json
+
+import pytest
+import requests
+from spotipy import Spotify
+
+from benchmarks.fakes import FakeSpotify
+from genres import create_genre_list
+from genres.create_genre_list import (
+    _crawl,
+    create_genre_file,
+)
+
+SOUNDS = 'GET users/thesoundsofspotify/playlists'
+PARTICLES = 'GET users/particledetector/playlists'
+
+
+def _playlist(number, name):
+    return {
+        'name': name,
+        'uri': f'spotify:playlist:{number:022d}',
+        'snapshot_id': f'snapshot-{number}',
+    }
+
+
+# Two playlists per page. Only the last page of each user is never read.
+PLAYLISTS = {
+    'thesoundsofspotify': [
+        _playlist(1, 'The Sound of Ambient'),
+        _playlist(2, 'The Pulse of Ambient'),
+        _playlist(3, 'The Sound of Blues'),
+        _playlist(4, 'Not a genre'),
+        _playlist(5, 'The Sound of Zouk'),
+        # City playlists follow the genres and end the crawl.
+        _playlist(6, 'The Sound of Berlin DE'),
+        _playlist(7, 'The Sound of Cologne DE'),
+        _playlist(8, 'The Sound of Dance'),
+        _playlist(9, 'The Sound of Last Page'),
+    ],
+    'particledetector': [
+        _playlist(10, 'The Edge of Ambient'),
+        _playlist(11, 'The Sound of Polka'),
+        _playlist(12, 'The Sound of Last Page'),
+    ],
+}
+
+GENRES = {
+    'Ambient': {
+        'Sound': f'{1:022d}', 'Pulse': f'{2:022d}', 'Edge': f'{10:022d}'},
+    'Blues': {'Sound': f'{3:022d}'},
+    'Zouk': {'Sound': f'{5:022d}'},
+    'Polka': {'Sound': f'{11:022d}'},
+}
+
+
+@pytest.fixture
+def spotify(monkeypatch, tmp_path):
+    monkeypatch.setattr(create_genre_list, 'LIMIT', 2)
+    monkeypatch.setattr(
+        create_genre_list, 'alpha2_country_codes', (' DE', ' US'))
+    for name in ('GENRE_IDS_FILE', 'PLAYLISTS_FILE', 'COMPILED_FILE'):
+        path = getattr(create_genre_list, name)
+        monkeypatch.setattr(create_genre_list, name, tmp_path / path.name)
+
+    fake = FakeSpotify(playlists=PLAYLISTS)
+    yield fake
+    fake.stop()
+
+
+@pytest.fixture
+def client(spotify):
+    client = Spotify(auth='crawler', requests_session=requests.Session())
+    client.prefix = spotify.api_url
+    return client
+
+
+def test_genre_map_matches_the_sequential_crawler(client, spotify, tmp_path):
+    create_genre_file(
+        client, workers=4, checkpoint_dir=tmp_path / 'crawl',
+        state_file=tmp_path / 'state.json')
+
+    with open(create_genre_list.PLAYLISTS_FILE) as f:
+        assert json.load(f) == GENRES
+    # The sequential crawler stopped at the page with the first city.
+    # All pages but the last are fetched now, the last city page too.
+    assert spotify.calls[SOUNDS] == 4
+    assert spotify.calls[PARTICLES] == 1
+    assert not list((tmp_path / 'crawl').iterdir())
+
+
+def test_crawl_resumes_from_checkpoints(client, spotify, tmp_path):
+    checkpoint_dir = tmp_path / 'crawl'
+    _crawl(client, 4, checkpoint_dir)
+
+    # As if the crawl was interrupted before the page at offset 4.
+    path = checkpoint_dir / 'thesoundsofspotify.json'
+    with open(path) as f:
+        data = json.load(f)
+    del data['pages']['4']
+    with open(path, 'w') as f:
+        json.dump(data, f)
+    spotify.calls.clear()
+
+    checkpoints = _crawl(client, 4, checkpoint_dir)
+
+    assert spotify.calls == {SOUNDS: 1}
+    assert [p['name'] for p in checkpoints['thesoundsofspotify'].pages[4]] \
+        == ['The Sound of Zouk', 'The Sound of Berlin DE']
+
+
+def test_rate_limited_pages_are_retried(client, spotify, tmp_path):
+    spotify.inject(429, {'Retry-After': '0'}, {'error': {'status': 429}})
+
+    create_genre_file(
+        client, workers=4, checkpoint_dir=tmp_path / 'crawl',
+        state_file=tmp_path / 'state.json')
+
+    with open(create_genre_list.PLAYLISTS_FILE) as f:
+        assert json.load(f) == GENRES
+    assert spotify.calls[SOUNDS] + spotify.calls[PARTICLES] == 6
@@ -0,0 +1,40 @@
+import pytest
+
+from spotigram.dedup import (
+    update_id_of,
+    UpdateWindow,
+)
+
+
+def test_update_id_of():
+    assert update_id_of(b'{"update_id": 42, "message": {}}') == 42
+    assert update_id_of(b'{"message": {}}') is None
+
+
+def test_window_forgets_the_oldest_ids():
+    window = UpdateWindow(3)
+    assert all(window.add(update_id) for update_id in (1, 2, 3, 4))
+    assert not window.add(4)
+    assert 1 not in window
+    assert len(window) == 3
+
+
+def test_stale_slot_does_not_evict_a_readded_id():
+    window = UpdateWindow(3)
+    window.add(1)
+    window.discard(1)
+    assert window.add(1)
+    window.add(2)
+    window.add(3)
+
+    # The first slot of 1 was reused, its newer slot still holds it.
+    assert 1 in window
+    assert not window.add(1)
+    window.add(4)
+    assert 1 not in window
+
+
+@pytest.mark.parametrize('size', (0, -1))
+def test_window_size_must_be_positive(size):
+    with pytest.raises(ValueError):
+        UpdateWindow(size)
@@ -0,0 +1,35 @@
+import queue
+import time
+from types import SimpleNamespace
+
+from prometheus_client import REGISTRY
+
+from spotigram.dispatcher import ShardedDispatcher
+
+
+def _sample(name, lane):
+    return REGISTRY.get_sample_value(name, {'lane': str(lane)}) or 0
+
+
+def test_lane_stats_are_exported():
+    dispatcher = ShardedDispatcher(bot=None, update_queue=queue.Queue(),
+                                   lanes=2)
+    dispatcher.lanes[0]._process = lambda update: time.sleep(0.01)
+    before = _sample('spotigram_dispatcher_lane_updates_total', 0)
+    busy_before = _sample('spotigram_dispatcher_lane_busy_seconds_total', 0)
+
+    for update_id in (0, 2, 4):
+        dispatcher.process_update(SimpleNamespace(update_id=update_id))
+    assert _sample('spotigram_dispatcher_lane_depth', 0) == 3
+
+    dispatcher.lanes[0].start()
+    deadline = time.monotonic() + 5
+    while dispatcher.lanes[0].stats()['processed'] < 3:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+    assert _sample('spotigram_dispatcher_lane_updates_total', 0) == before + 3
+    assert _sample(
+        'spotigram_dispatcher_lane_busy_seconds_total', 0) >= busy_before + .03
+    assert _sample('spotigram_dispatcher_lane_depth', 0) == 0
+    assert _sample('spotigram_dispatcher_lane_depth', 1) == 0
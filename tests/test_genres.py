@@ -0,0 +1,58 @@
+import json
+
+import pytest
+
+import genres
+from genres import GenreCatalog
+
+PLAYLISTS = {
+    'Ambient': {'Sound': f'{1:022d}', 'Edge': f'{4:022d}'},
+    'Blues': {'Sound': f'{3:022d}'},
+    'Zouk': {'Pulse': f'{2:022d}'},
+}
+
+
+@pytest.fixture
+def files(tmp_path, monkeypatch):
+    source = tmp_path / 'genre_playlists.json'
+    with open(source, 'w') as f:
+        json.dump(PLAYLISTS, f)
+    compiled = tmp_path / 'genre_playlists.bin'
+    monkeypatch.setattr(genres, 'PLAYLISTS_FILE', source)
+    monkeypatch.setattr(genres, 'COMPILED_FILE', compiled)
+    monkeypatch.setattr(genres, 'GENRE_IDS_FILE', tmp_path / 'ids.json')
+    return source, compiled
+
+
+@pytest.mark.parametrize('compiled', [False, True])
+def test_lookup(files, compiled):
+    catalog = (
+        genres._load_catalog() if compiled
+        else GenreCatalog.from_file(files[0]))
+    assert isinstance(catalog._ids, list) != compiled
+
+    for genre, playlists in PLAYLISTS.items():
+        for pl_type, uri in playlists.items():
+            assert uri in catalog
+            assert catalog[uri] == (pl_type, genre)
+    for missing in (f'{0:022d}', f'{5:022d}', '1', 'é' * 22):
+        assert missing not in catalog
+        with pytest.raises(KeyError):
+            catalog[missing]
+
+
+@pytest.mark.parametrize('size', [0, 10, 40])
+def test_truncated_catalog_is_rebuilt(files, size):
+    source, compiled = files
+    genres._load_catalog()
+    with open(compiled, 'rb') as f:
+        data = f.read()
+    with open(compiled, 'wb') as f:
+        f.write(data[:size])
+
+    catalog = genres._load_catalog()
+
+    assert not isinstance(catalog._ids, list)
+    assert catalog[f'{3:022d}'] == ('Sound', 'Blues')
+    with open(compiled, 'rb') as f:
+        assert f.read() == data
@@ -0,0 +1,176 @@
+import json
+import queue
+import time
+
+import pytest
+import redislite
+
+from spotigram import ingestion
+from spotigram.ingestion import (
+    IngestionQueue,
+    partition_of,
+    StreamIngestionQueue,
+)
+
+
+def _payload(update_id, chat_id=None):
+    update = {'update_id': update_id}
+    if chat_id is not None:
+        update['message'] = {
+            'message_id': update_id, 'date': 0, 'text': 'text',
+            'chat': {'type': 'private', 'id': chat_id},
+        }
+    return json.dumps(update).encode('utf-8')
+
+
+def test_get_works_without_qsize(monkeypatch):
+    ingestion = IngestionQueue(maxsize=10)
+    consumer = ingestion.decoding(bot=None)
+
+    def qsize():
+        # As on macOS.
+        raise NotImplementedError
+
+    monkeypatch.setattr(ingestion._queue, 'qsize', qsize)
+    ingestion.offer(_payload(1))
+
+    assert consumer.get(timeout=1).update_id == 1
+    assert ingestion.stats()['depth'] is None
+
+
+def test_partition_of():
+    assert partition_of(_payload(1, chat_id=-1005), 4) == -1005 % 4
+    assert partition_of(_payload(2, chat_id=-1005), 4) == -1005 % 4
+    assert partition_of(_payload(7), 4) == 3
+    assert partition_of(b'{}', 4) == 0
+
+
+@pytest.fixture
+def stream(tmp_path, monkeypatch):
+    # Heartbeats are driven by the tests.
+    monkeypatch.setattr(ingestion, 'CLAIM_INTERVAL', 60)
+    monkeypatch.setattr(ingestion, 'CLAIM_IDLE', 0.5)
+    server = redislite.Redis(str(tmp_path / 'stream.db'))
+    consumers = []
+
+    def consumer(name, partitions):
+        producer = StreamIngestionQueue(
+            server, stream='updates', partitions=partitions, maxsize=100)
+        consumers.append(producer.decoding(bot=None))
+        consumers[-1].consumer = name
+        return producer, consumers[-1]
+
+    yield consumer
+    for started in consumers:
+        started.close()
+
+
+def _drain(consumer):
+    updates = []
+    while True:
+        try:
+            updates.append(consumer.get(block=False))
+        except queue.Empty:
+            return updates
+
+
+def test_offer_consume_ack(stream):
+    producer, consumer = stream('c1', partitions=2)
+    for update_id in range(3):
+        assert producer.offer(_payload(update_id, chat_id=update_id))
+
+    updates = _drain(consumer)
+    assert sorted(u.update_id for u in updates) == [0, 1, 2]
+    assert producer.stats()['pending'] == 3
+    assert producer.stats()['consumers'] == 1
+
+    for update in updates:
+        consumer.ack(update)
+    stats = producer.stats()
+    assert (stats['depth'], stats['lag'], stats['pending']) == (0, 0, 0)
+
+
+def test_partitions_hold_their_share(stream):
+    producer, _ = stream('c1', partitions=50)
+    assert all(producer.offer(_payload(i, chat_id=1)) for i in range(2))
+    assert not producer.offer(_payload(2, chat_id=1))
+    assert producer.offer(_payload(3, chat_id=2))
+
+
+def test_each_chat_is_read_by_one_consumer(stream):
+    producer, c1 = stream('c1', partitions=4)
+    _, c2 = stream('c2', partitions=4)
+    c1._start_heartbeat()
+    c2._start_heartbeat()
+    # c1 took all partitions first and hands half of them over.
+    assert c2._held == set()
+    c1._beat()
+    c2._beat()
+    assert (c1._held, c2._held) == ({0, 2}, {1, 3})
+
+    for update_id in range(16):
+        producer.offer(_payload(update_id, chat_id=update_id % 8))
+    chats = {}
+    for consumer in (c1, c2):
+        for update in _drain(consumer):
+            chats.setdefault(update.effective_chat.id, set()).add(
+                consumer.consumer)
+            consumer.ack(update)
+
+    assert chats == {
+        chat_id: {'c1' if chat_id % 2 == 0 else 'c2'} for chat_id in range(8)
+    }
+
+
+def test_busy_consumer_keeps_its_updates(stream):
+    producer, c1 = stream('c1', partitions=1)
+    _, c2 = stream('c2', partitions=1)
+    producer.offer(_payload(0, chat_id=1))
+    assert c1.get(block=False).update_id == 0
+
+    # Still being handled after CLAIM_IDLE.
+    time.sleep(0.3)
+    c1._beat()
+    time.sleep(0.3)
+    c2._start_heartbeat()
+
+    assert c2._held == set()
+    assert c2._claim(0) == []
+    assert producer.stats()['pending'] == 1
+
+
+def test_updates_of_a_dead_consumer_are_claimed(stream):
+    producer, c1 = stream('c1', partitions=1)
+    _, c2 = stream('c2', partitions=1)
+    producer.offer(_payload(0, chat_id=1))
+    assert c1.get(block=False).update_id == 0
+    producer.offer(_payload(1, chat_id=1))
+    # c1 stops without acknowledging update 0 or releasing its lease.
+    c1._stopped.set()
+
+    c2._start_heartbeat()
+    assert c2._held == set()
+    time.sleep(0.6)
+    c2._beat()
+
+    updates = _drain(c2)
+    assert [u.update_id for u in updates] == [0, 1]
+    for update in updates:
+        c2.ack(update)
+    assert producer.stats()['pending'] == 0
+
+
+def test_poisoned_updates_are_dropped(stream, monkeypatch):
+    monkeypatch.setattr(ingestion, 'MAX_DELIVERIES', 1)
+    producer, c1 = stream('c1', partitions=1)
+    _, c2 = stream('c2', partitions=1)
+    producer.offer(_payload(0, chat_id=1))
+    c1.get(block=False)
+    c1._stopped.set()
+
+    time.sleep(0.6)
+    c2._start_heartbeat()
+
+    assert _drain(c2) == []
+    assert producer.stats()['pending'] == 0
+    assert producer.depth() == 0
@@ -0,0 +1,95 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+import redislite
+
+from spotigram.sender import (
+    MessageSender,
+    RedisLimits,
+)
+
+
+@pytest.fixture
+def limits(tmp_path):
+    server = redislite.Redis(str(tmp_path / 'redis.db'))
+
+    def create(rate=2, chat_rate=1, coalesce_window=10):
+        return RedisLimits(server, 'bot', rate, chat_rate, coalesce_window)
+
+    return create
+
+
+def test_limits_are_shared(limits):
+    # As in two processes.
+    first, second = limits(), limits()
+
+    assert first.acquire(1) == (0, 0)
+    global_wait, chat_wait = second.acquire(1)
+    assert global_wait == 0 and 0.9 < chat_wait <= 1
+    assert second.acquire(2) == (0, 0)
+    global_wait, chat_wait = first.acquire(3)
+    assert 0.4 < global_wait <= 0.5 and chat_wait == 0
+
+
+def test_retry_after_blocks_everyone(limits):
+    first, second = limits(), limits()
+    first.block(5)
+
+    global_wait, _ = second.acquire(1)
+    assert 4.9 < global_wait <= 5
+
+
+class _Bot:
+
+    def __init__(self):
+        self.calls = []
+
+    def send_message(self, chat_id, text, **kwargs):
+        self.calls.append(('send', chat_id, text))
+        return SimpleNamespace(message_id=len(self.calls))
+
+    def edit_message_text(self, text, chat_id, message_id, **kwargs):
+        self.calls.append(('edit', chat_id, text))
+
+
+def _wait_for(bot, calls):
+    deadline = time.monotonic() + 5
+    while len(bot.calls) < calls and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def test_messages_coalesce_across_senders(limits):
+    bot = _Bot()
+    first = MessageSender(bot, limits=limits(rate=100, chat_rate=100))
+    second = MessageSender(bot, limits=limits(rate=100, chat_rate=100))
+
+    first.send_message(1, 'Skipped.', coalesce=True)
+    _wait_for(bot, 1)
+    second.send_message(1, 'Skipped.', coalesce=True)
+    _wait_for(bot, 2)
+    second.send_message(1, 'Paused.')
+    _wait_for(bot, 3)
+    first.send_message(1, 'Skipped.', coalesce=True)
+    _wait_for(bot, 4)
+
+    assert bot.calls == [
+        ('send', 1, 'Skipped.'),
+        ('edit', 1, 'Skipped. (x2)'),
+        ('send', 1, 'Paused.'),
+        ('send', 1, 'Skipped.'),
+    ]
+
+
+def test_sends_wait_for_the_shared_chat_bucket(limits):
+    bot = _Bot()
+    first = MessageSender(bot, limits=limits(rate=100, chat_rate=5))
+    second = MessageSender(bot, limits=limits(rate=100, chat_rate=5))
+
+    start = time.monotonic()
+    for sender in (first, second, first):
+        sender.send_message(1, 'Hello')
+    _wait_for(bot, 3)
+
+    assert len(bot.calls) == 3
+    assert time.monotonic() - start >= 0.35
@@ -0,0 +1,65 @@
+import time
+
+import pytest
+from spotipy import SpotifyException
+
+from benchmarks.fakes import FakeSpotify
+from spotigram import spotify_http
+from spotigram.spotify_http import SpotifySession, spotify_client
+
+
+@pytest.fixture
+def spotify():
+    fake = FakeSpotify()
+    yield fake
+    fake.stop()
+
+
+def test_connection_is_reused(spotify, monkeypatch):
+    monkeypatch.setattr(spotify_http, 'API_URL', spotify.api_url)
+    clients = [spotify_client(f'token-{n}') for n in range(3)]
+    for _ in range(5):
+        for client in clients:
+            client.me()
+
+    assert spotify.calls['GET me'] == 15
+    assert spotify.connections == 1
+
+
+def test_rate_limited_request_is_retried(spotify):
+    spotify.inject(429, {'Retry-After': '0.2'}, {'error': {'status': 429}})
+    session = SpotifySession()
+
+    start = time.monotonic()
+    response = session.get(f'{spotify.api_url}me')
+
+    assert response.status_code == 200
+    assert time.monotonic() - start >= 0.2
+    assert spotify.calls['GET me'] == 2
+
+
+def test_breaker_opens_and_half_opens(spotify):
+    session = SpotifySession(breaker_threshold=2, breaker_cooldown=0.2)
+    url = f'{spotify.api_url}me'
+    spotify.inject(500, times=2)
+
+    for _ in range(2):
+        assert session.get(url).status_code == 500
+    with pytest.raises(SpotifyException):
+        session.get(url)
+    assert spotify.calls['GET me'] == 2
+    # Other endpoints are not affected.
+    assert session.get(f'{spotify.api_url}tracks/1').status_code == 200
+
+    time.sleep(0.2)
+    spotify.inject(500)
+    # A single trial request; it fails and the breaker opens again.
+    assert session.get(url).status_code == 500
+    with pytest.raises(SpotifyException):
+        session.get(url)
+    assert spotify.calls['GET me'] == 3
+
+    time.sleep(0.2)
+    assert session.get(url).status_code == 200
+    assert session.get(url).status_code == 200
+    assert spotify.calls['GET me'] == 5
@@ -0,0 +1,153 @@
+import redis
+import redislite
+from prometheus_client import REGISTRY
+
+from spotigram.store import (
+    CachedStore, RedisBitset, RedisStore, ShardedRedisStore, rebalance,
+    rebalance_bitsets, redis_for_url,
+)
+
+
+def test_redis_for_url_shares_clients():
+    url = 'redis://localhost:6379/0'
+    assert redis_for_url(url) is redis_for_url(url)
+
+
+def test_rebalance_keeps_keys_on_their_shard(tmp_path):
+    servers = {
+        name: redislite.Redis(str(tmp_path / f'{name}.db'))
+        for name in ('a', 'b')
+    }
+    old = RedisStore(servers['a'], prefix='chat')
+    for chat_id in range(50):
+        old.set(chat_id, 'user', {'chat': chat_id})
+
+    # Separate clients for the same servers, as with several processes.
+    target = ShardedRedisStore({
+        name: redis.Redis(unix_socket_path=server.socket_file)
+        for name, server in servers.items()
+    }, prefix='chat')
+    moved = rebalance([old], target)
+
+    assert 0 < moved < 50
+    for chat_id in range(50):
+        assert target.get(chat_id, 'user') == {'chat': chat_id}
+
+
+def test_rebalance_bitsets_merges_into_the_target(tmp_path):
+    servers = {
+        name: redislite.Redis(str(tmp_path / f'{name}.db'))
+        for name in ('a', 'b')
+    }
+    old = RedisBitset({'a': servers['a']}, prefix='history')
+    for chat_id in range(50):
+        old.set_bits(chat_id, [chat_id])
+
+    target = RedisBitset({
+        name: redis.Redis(unix_socket_path=server.socket_file)
+        for name, server in servers.items()
+    }, prefix='history')
+    moved_chat = next(
+        chat_id for chat_id in range(50)
+        if target.ring.node_for(chat_id) == 'b')
+    # Seen on the new node after the switch, before the rebalance ran.
+    target.set_bits(moved_chat, [60])
+    moved = rebalance_bitsets([old], target)
+
+    assert 0 < moved < 50
+    for chat_id in range(50):
+        assert target.get(chat_id)[chat_id // 8] & (0x80 >> chat_id % 8)
+    assert target.get(moved_chat)[60 // 8] & (0x80 >> 60 % 8)
+    assert sorted(old.chat_ids(), key=int) == [
+        str(chat_id) for chat_id in range(50)
+        if target.ring.node_for(chat_id) == 'a'
+    ]
+    assert not servers['b'].keys('merge:*')
+
+
+class _SlowStore(RedisStore):
+    """Runs `during_read` after reading, before the cache stores it."""
+
+    during_read = None
+
+    def items_for(self, chat_id):
+        items = super().items_for(chat_id)
+        if self.during_read is not None:
+            self.during_read()
+        return items
+
+
+def _cache(tmp_path, **kwargs):
+    store = _SlowStore(redislite.Redis(str(tmp_path / 'cache.db')), 'chat')
+    cache = CachedStore(store, ttl=60, **kwargs)
+    # The published invalidations would come back and drop entries at
+    # random times.
+    cache._listen = lambda: None
+    return store, cache
+
+
+def test_cache_keeps_no_read_older_than_an_invalidation(tmp_path):
+    store, cache = _cache(tmp_path)
+    cache.set(1, 'user', {'v': 1})
+
+    store.during_read = lambda: cache.set(1, 'user', {'v': 2})
+    assert cache.get(1, 'user') == {'v': 1}
+    store.during_read = None
+
+    assert cache.get(1, 'user') == {'v': 2}
+    assert cache.get(1, 'user') == {'v': 2}
+    assert cache.stats() == {'hits': 1, 'misses': 2, 'size': 1}
+
+
+def test_cache_assumes_forgotten_chats_were_invalidated(tmp_path):
+    store, cache = _cache(tmp_path, maxsize=2)
+
+    # Invalidates so many other chats that chat 1 is forgotten.
+    store.during_read = lambda: [cache.set(c, 'user', {}) for c in (2, 3, 4)]
+    cache.items_for(1)
+    store.during_read = None
+
+    assert cache.stats()['size'] == 0
+    cache.items_for(1)
+    assert cache.stats()['size'] == 1
+
+
+def test_cache_stats_are_exported(tmp_path):
+    store = RedisStore(redislite.Redis(str(tmp_path / 'cache.db')), 'metered')
+    cache = CachedStore(store, ttl=60)
+    cache._listen = lambda: None
+
+    def sample(name, **labels):
+        return REGISTRY.get_sample_value(
+            f'spotigram_store_cache_{name}_total',
+            dict(prefix='metered', **labels))
+
+    cache.get(1, 'user')
+    cache.get(1, 'user')
+    cache.set(1, 'user', {})
+    cache.set(1, 'user', {})
+
+    assert sample('lookups', result='hit') == 1
+    assert sample('lookups', result='miss') == 1
+    assert sample('invalidations') == 1
+
+
+def test_get_many_and_items_for_prefixes(tmp_path):
+    server = redislite.Redis(str(tmp_path / 'many.db'))
+    chats = RedisStore(server, 'chat')
+    chats.set_many(1, {'a': {'n': 1}, 'b': {'n': 2}})
+    RedisStore(server, 'other').set(1, 'playlists', ['x'])
+
+    assert chats.get_many(1, ['b', 'c', 'a']) == [{'n': 2}, None, {'n': 1}]
+    assert chats.get_many(1, []) == []
+    assert chats.items_for_prefixes(1, ['chat', 'other', 'empty']) == {
+        'chat': {'a': {'n': 1}, 'b': {'n': 2}},
+        'other': {'playlists': ['x']},
+        'empty': {},
+    }
+
+    cache = CachedStore(chats, ttl=60)
+    cache._listen = lambda: None
+    cache.items_for_prefixes(1, ['chat', 'other'])
+    assert cache.get_many(1, ['a']) == [{'n': 1}]
+    assert cache.stats() == {'hits': 1, 'misses': 0, 'size': 1}
@@ -0,0 +1,46 @@
+from concurrent.futures import (
+    ThreadPoolExecutor,
+    TimeoutError as FutureTimeoutError,
+)
+
+import pytest
+
+from benchmarks.fakes import FakeSpotify
+from spotigram import spotify_http
+from spotigram.spotify_http import spotify_client
+from spotigram.sync import sync_start_playback, TARGET_SKEW_MS
+
+URIS = ['spotify:track:4uLU6hMCjMI75M1A2tKUQC']
+
+
+@pytest.fixture
+def spotify(monkeypatch):
+    fake = FakeSpotify(
+        latency_by_token={'near': 0.01, 'far': 0.15, 'slow': 1.0})
+    monkeypatch.setattr(spotify_http, 'API_URL', fake.api_url)
+    yield fake
+    fake.stop()
+
+
+def test_listeners_start_at_the_same_position(spotify):
+    clients = [spotify_client(token) for token in ('near', 'far')]
+    with ThreadPoolExecutor(4) as executor:
+        result = sync_start_playback(
+            clients, executor, timeout=5, position_ms=1000, uris=URIS)
+
+    assert not result.failed
+    assert set(spotify.playback) == {'near', 'far'}
+    assert all(
+        position_ms >= 1000 for _, position_ms in spotify.playback.values())
+    assert spotify.skew_ms() <= TARGET_SKEW_MS
+
+
+def test_timed_out_listener_is_reported_as_failed(spotify):
+    clients = [spotify_client(token) for token in ('a', 'slow')]
+    with ThreadPoolExecutor(4) as executor:
+        result = sync_start_playback(
+            clients, executor, timeout=0.5, probes=1, uris=URIS)
+
+    assert [client for client, _ in result.failed] == [clients[1]]
+    assert isinstance(result.failed[0][1], FutureTimeoutError)
+    assert set(spotify.playback) == {'a'}
@@ -0,0 +1,84 @@
+from threading import Thread
+
+import pytest
+import redislite
+import telegram
+
+from spotigram import webhook
+from spotigram.webhook import (
+    _key,
+    register_webhook,
+)
+
+URL = 'https://example.com/hook/123:token'
+
+
+class Bot:
+
+    def __init__(self, results):
+        self.token = '123:token'
+        self.url = ''
+        self.results = list(results)
+        self.calls = 0
+
+    def get_webhook_info(self):
+        return telegram.WebhookInfo(self.url, False, 0)
+
+    def set_webhook(self, url):
+        self.calls += 1
+        result = self.results.pop(0) if self.results else True
+        if isinstance(result, Exception):
+            raise result
+        if result:
+            self.url = url
+        return result
+
+
+@pytest.fixture
+def redis(tmp_path, monkeypatch):
+    monkeypatch.setattr(webhook, 'SET_ATTEMPTS', 3)
+    monkeypatch.setattr(webhook, 'RETRY_BACKOFF', 0)
+    return redislite.Redis(str(tmp_path / 'redis.db'))
+
+
+def test_registers_once(redis):
+    bot = Bot([])
+    assert register_webhook(bot, URL, redis)
+    assert not register_webhook(bot, URL, redis)
+    assert bot.calls == 1
+
+
+def test_retries_failed_attempts(redis):
+    bot = Bot([telegram.error.NetworkError('reset'),
+               telegram.error.RetryAfter(0), True])
+    assert register_webhook(bot, URL, redis)
+    assert bot.url == URL
+    assert bot.calls == 3
+
+
+def test_gives_up_and_lets_the_next_worker_try(redis):
+    bot = Bot([False] * 3)
+    assert not register_webhook(bot, URL, redis)
+    assert bot.calls == 3
+    assert bot.url == ''
+
+    assert register_webhook(bot, URL, redis)
+    assert bot.url == URL
+
+
+def test_waits_for_the_worker_holding_the_lock(redis):
+    bot = Bot([])
+    lock = redis.lock(f'lock:{_key(bot.token)}')
+    lock.acquire()
+    results = []
+    waiting = Thread(
+        target=lambda: results.append(register_webhook(bot, URL, redis)))
+    waiting.start()
+
+    waiting.join(0.2)
+    assert waiting.is_alive()
+    # The lock holder fails; the waiting worker registers instead.
+    lock.release()
+    waiting.join(5)
+    assert results == [True]
+    assert bot.url == URL